@@ -1,17 +1,43 @@
 from dotenv import load_dotenv
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import (Flask, render_template, request, jsonify, redirect, url_for, flash, Response, stream_with_context,
+                   g, abort)
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user
+from flask_login import LoginManager, UserMixin, current_user, login_user, login_required, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import logging
-from openai import AzureOpenAI
-from sqlalchemy.sql import func
-from vector import (clean_collection_name, process_pdf_and_add_to_collection, create_embedding, chroma_client)
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.sql import func, text
+from vector import EMBEDDING_BACKENDS, clean_collection_name, process_pdf_and_add_to_collection
+from vector_store import forget_collection, get_chroma_client
+from response_cache import RESPONSE_CACHE_SEMANTIC_ENABLED, response_cache
+from embedding_cache import embedding_cache
+from embedding_service import EMBEDDING_PREWARM_COUNT, query_embedder
+import metrics
+from config_cache import CachedValue, load_json_file, SYSTEM_PROMPT_CACHE_TTL
+from retrieval import collection_query_embedder, retrieve_federated, retrieve_many_federated
+from llm_router import llm_router
+from context_assembly import (AZURE_CONTEXT_TOKENS, OLLAMA_CONTEXT_TOKENS, assemble_context, context_budget,
+                              count_message_tokens)
+from chat_context import (CHAT_HISTORY_MAX_TOKENS, CHAT_HISTORY_PAGE_SIZE, CHAT_SUMMARY_MAX_TOKENS,
+                          build_summary_messages, history_entry, split_history, summary_batches,
+                          summary_message)
+from batch_generation import (BATCH_CONCURRENCY, BATCH_MAX_PROMPTS, BATCH_REQUESTS_PER_MINUTE, RateLimiter,
+                              parse_prompt_file, parse_prompt_list, results_to_csv)
+from database import copy_tables, database_url, engine_options
+import lexical_index
+import compact_index
+import local_embeddings
 import os
-import ollama
+import hmac
 import json
 import tempfile
+import threading
+import time
+import uuid
+import click
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # Konfiguriere Logging
 logging.basicConfig(level=logging.DEBUG)
@@ -22,7 +48,8 @@ load_dotenv()
 # Initialisiere Flask-App
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
 # Initialisiere Datenbank
@@ -36,21 +63,19 @@ login_manager.login_view = 'login'
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 
+# Einstellungen für die Hintergrund-Indexierung
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))
+INGESTION_POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", "2"))
+INGESTION_STALE_SECONDS = int(os.getenv("INGESTION_STALE_SECONDS", "600"))
+
 # Lade Konfigurationsvariablen aus Umgebungsvariablen
 AZURE_EMBEDDING_MODEL = os.getenv("AZURE_EMBEDDING_MODEL")
-AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
-AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
-AZURE_API_VERSION = os.getenv("AZURE_API_VERSION")
 AZURE_MODEL = os.getenv("AZURE_MODEL", "gpt-35-turbo")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3-gradient:latest")
 LABEL_OWNER = os.getenv("LABLE_OWNER", "labels_arvato.json")
-
-# Initialisiere Azure OpenAI Client
-azure_openai_client = AzureOpenAI(
-    api_key=AZURE_OPENAI_KEY,
-    api_version=AZURE_API_VERSION,
-    azure_endpoint=AZURE_ENDPOINT
-)
+# Reservierte Antwortlänge in Tokens, wird beim Kontext-Budget abgezogen
+INDEX_COMPLETION_TOKENS = 4096
+CHAT_COMPLETION_TOKENS = 800
 
 
 # Definiere Datenbankmodelle
@@ -60,17 +85,23 @@ class User(UserMixin, db.Model):
     password = db.Column(db.String(60), nullable=False)
 
 
+# Katalog der Chroma-Collections, wird beim Indexieren und Löschen gepflegt
 class Collection(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, unique=True, index=True)
     description = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
 
 
 class File(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(100), nullable=False)
-    collection_id = db.Column(db.Integer, db.ForeignKey('collection.id'), nullable=False)
-    collection = db.relationship('Collection', backref=db.backref('files', lazy=True))
+    collection_id = db.Column(db.Integer, db.ForeignKey('collection.id'), nullable=False, index=True)
+    collection = db.relationship('Collection', backref=db.backref('files', lazy=True, cascade='all, delete-orphan'))
+    hash = db.Column(db.String(64))
+    chunk_count = db.Column(db.Integer, default=0)
+    page_count = db.Column(db.Integer, default=0)
+    updated_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
 
 class SystemPrompt(db.Model):
@@ -92,11 +123,20 @@ class Conversation(db.Model):
 
 class ChatSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
-    updated_at = db.Column(db.DateTime(timezone=True), onupdate=func.now())
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), index=True)
+    updated_at = db.Column(db.DateTime(timezone=True), onupdate=func.now(), index=True)
+    # Fortlaufende Zusammenfassung aller Nachrichten bis einschließlich summary_until_id
+    summary = db.Column(db.Text)
+    summary_until_id = db.Column(db.Integer)
 
 
 class ChatMessage(db.Model):
+    # Nachrichten werden immer je Sitzung gelesen, chronologisch bzw. seitenweise nach ID
+    __table_args__ = (
+        db.Index('ix_chat_message_session_id_created_at', 'session_id', 'created_at'),
+        db.Index('ix_chat_message_session_id_id', 'session_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('chat_session.id'), nullable=False)
     role = db.Column(db.String(10), nullable=False)  # 'user' oder 'assistant'
@@ -107,13 +147,71 @@ class ChatMessage(db.Model):
                               backref=db.backref('messages', lazy=True, order_by='ChatMessage.created_at'))
 
 
+class IngestionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    collection_name = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    # Embedding-Backend einer neu anzulegenden Kollektion (azure, local); leer bei Aktualisierungen
+    embedding_backend = db.Column(db.String(20))
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    finished_at = db.Column(db.DateTime(timezone=True))
+
+
+class IngestionFile(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('ingestion_job.id'), nullable=False, index=True)
+    filename = db.Column(db.String(255), nullable=False)
+    file_path = db.Column(db.String(500), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done, unchanged, failed
+    total_pages = db.Column(db.Integer, default=0)
+    pages_parsed = db.Column(db.Integer, default=0)
+    chunks_total = db.Column(db.Integer, default=0)
+    chunks_embedded = db.Column(db.Integer, default=0)
+    chunks_written = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    heartbeat = db.Column(db.Float)  # Zeitstempel der letzten Aktivität des Workers
+
+    job = db.relationship('IngestionJob', backref=db.backref('files', lazy=True, order_by='IngestionFile.id'))
+
+
+# Erstellt fehlende Tabellen und ergänzt neue Spalten und Indizes in bestehenden Tabellen
+# Mehrere Prozesse (gunicorn/uvicorn-Worker) dürfen das gleichzeitig tun
+def init_db():
+    try:
+        db.create_all()
+    except DBAPIError as e:
+        # Ein anderer Prozess hat die Tabellen gleichzeitig angelegt; fehlende legt der zweite Versuch an
+        logging.info(f"Retrying table creation: {e}")
+        db.create_all()
+    inspector = inspect(db.engine)
+    quote = db.engine.dialect.identifier_preparer.quote
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                try:
+                    db.session.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}"))
+                    db.session.commit()
+                    logging.info(f"Added column {table.name}.{column.name}")
+                except DBAPIError:
+                    db.session.rollback()
+                    if column.name not in {c['name'] for c in inspect(db.engine).get_columns(table.name)}:
+                        raise
+                    logging.info(f"Column {table.name}.{column.name} was added by another process")
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                logging.warning(f"Could not create index {index.name}: {e}")
+
+
 # Initialisiere Wartungsmodus-Variable
 maintenance_mode = False
 
 
 def load_options():
-    with open('config/options.json', 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return load_json_file('config/options.json')
 
 
 # Füge Labels zum Template-Kontext hinzu
@@ -122,43 +220,521 @@ def inject_labels():
     return dict(labels=load_labels())
 
 
-# Lade Labels aus JSON-Datei
+# Lade Labels aus JSON-Datei (zwischengespeichert, bis sich die Datei ändert)
 def load_labels():
     label_name = "labels_" + os.getenv("LABEL_OWNER", "") + ".json"
-    with open(label_name, 'r', encoding='utf-8') as file:
-        return json.load(file)
-
-
-# Funktion zur Textgenerierung (Azure oder Ollama)
-def generate_text(service, system_message, user_message):
-    if service == 'azure':
-        print("Azure")
-        response = azure_openai_client.chat.completions.create(
-            model=AZURE_MODEL,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message},
-            ],
-            temperature=0.7,
-            max_tokens=4096,
-        )
-        print(response.choices[0].message.content)
-        return response.choices[0].message.content
-    else:  # Ollama
-        print("Ollama:", OLLAMA_MODEL)
-        response = ollama.chat(model=OLLAMA_MODEL, messages=[
-            {'role': 'system', 'content': system_message},
-            {'role': 'user', 'content': user_message}
-        ])
-        return response['message']['content']
+    return load_json_file(label_name)
+
+
+# System-Prompts werden für alle Anfragen zwischengespeichert und bei Änderungen über die Routen verworfen
+def _load_system_prompts():
+    return [{'id': p.id, 'name': p.name, 'content': p.content} for p in SystemPrompt.query.order_by(SystemPrompt.id)]
+
+
+system_prompt_cache = CachedValue(_load_system_prompts, SYSTEM_PROMPT_CACHE_TTL)
+
+
+def get_system_prompts():
+    return system_prompt_cache.get()
+
+
+def get_system_prompt(system_prompt_id):
+    if not system_prompt_id:
+        return None
+    return next((p for p in get_system_prompts() if str(p['id']) == str(system_prompt_id)), None)
+
+
+# Textgenerierung über den LLM-Router: bevorzugt das gewählte Backend, weicht bei Ausfall auf das andere aus.
+# Liefert (Text, genutztes Backend).
+def generate_text(service, messages, max_tokens=INDEX_COMPLETION_TOKENS, temperature=0.7):
+    return llm_router.complete(service, messages, max_tokens, temperature)
+
+
+# Quellenangabe mit Seitenbereich, ältere Chunks kennen nur page_number
+def format_citation(meta, collection=None):
+    page_start = meta.get('page_start', meta.get('page_number', 'N/A'))
+    page_end = meta.get('page_end', page_start)
+    pages = f"{page_start}-{page_end}" if page_end != page_start else page_start
+    citation = f"{meta.get('source', 'Unknown')} - S. {pages}"
+    # Bei der Suche über mehrere Kollektionen die Herkunft mit angeben
+    return f"{collection}: {citation}" if collection else citation
+
+
+# Eine oder mehrere Kollektionen: wiederholtes Formularfeld, JSON-Liste oder durch Kommas getrennte Namen
+def requested_collections(data):
+    values = data.getlist('collection_name') if hasattr(data, 'getlist') else data.get('collection_name')
+    if not isinstance(values, list):
+        values = [values]
+    names = []
+    for value in values:
+        for name in str(value or '').split(','):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+    return names
+
+
+def model_name(service):
+    return AZURE_MODEL if service == 'azure' else OLLAMA_MODEL
+
+
+# Packt die nach Relevanz sortierten Treffer in das Token-Budget, das neben base_messages (Prompt ohne Kontext)
+# und der reservierten Antwortlänge im Kontextfenster des Modells bleibt
+def assemble_prompt_context(service, hits, base_messages, completion_tokens):
+    model_context_tokens = AZURE_CONTEXT_TOKENS if service == 'azure' else OLLAMA_CONTEXT_TOKENS
+    budget = context_budget(base_messages, model_name(service), model_context_tokens, completion_tokens)
+    with metrics.timed("assemble"):
+        context, used_hits, report = assemble_context(hits, budget, model_name(service))
+    report.update(model_context_tokens=model_context_tokens, completion_tokens=completion_tokens)
+    return context, used_hits, report
+
+
+# Streaming-Variante der Textgenerierung, liefert die Antwort Stück für Stück.
+# route erhält unter "service" das Backend, das tatsächlich antwortet.
+def stream_text(service, messages, max_tokens=INDEX_COMPLETION_TOKENS, route=None):
+    return llm_router.stream(service, messages, max_tokens, route=route)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Hintergrund-Indexierung: Die Warteschlange liegt in der SQLite-Datenbank (IngestionFile),
+# Worker-Threads holen sich die nächste wartende Datei und verarbeiten sie
+ingestion_wakeup = threading.Event()
+ingestion_workers_lock = threading.Lock()
+ingestion_workers_started = False
+
+
+def ingestion_file_to_dict(ingestion_file):
+    return {
+        'id': ingestion_file.id,
+        'filename': ingestion_file.filename,
+        'status': ingestion_file.status,
+        'total_pages': ingestion_file.total_pages,
+        'pages_parsed': ingestion_file.pages_parsed,
+        'chunks_total': ingestion_file.chunks_total,
+        'chunks_embedded': ingestion_file.chunks_embedded,
+        'chunks_written': ingestion_file.chunks_written,
+        'error': ingestion_file.error
+    }
+
+
+def ingestion_job_to_dict(job):
+    return {
+        'id': job.id,
+        'collection_name': job.collection_name,
+        'status': job.status,
+        'embedding_backend': job.embedding_backend,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'files': [ingestion_file_to_dict(f) for f in job.files]
+    }
+
+
+def requeue_stale_ingestion_files():
+    # Dateien, deren Worker abgestürzt ist, wieder in die Warteschlange stellen
+    stale_before = time.time() - INGESTION_STALE_SECONDS
+    IngestionFile.query.filter(IngestionFile.status == 'running',
+                               IngestionFile.heartbeat < stale_before).update({'status': 'queued'})
+    db.session.commit()
+
+
+def claim_next_ingestion_file():
+    while True:
+        candidate = IngestionFile.query.filter_by(status='queued').order_by(IngestionFile.id).first()
+        if candidate is None:
+            return None
+        # Bedingtes Update, damit nur ein Worker die Datei übernimmt
+        claimed = IngestionFile.query.filter_by(id=candidate.id, status='queued').update(
+            {'status': 'running', 'heartbeat': time.time()})
+        db.session.commit()
+        if claimed:
+            return candidate.id
+
+
+def update_ingestion_job_status(job):
+    statuses = [f.status for f in job.files]
+    if any(status in ('queued', 'running') for status in statuses):
+        job.status = 'running'
+    else:
+        job.status = 'failed' if statuses and all(status == 'failed' for status in statuses) else 'done'
+        job.finished_at = func.now()
+    db.session.commit()
+    if job.status == 'done':
+        rebuild_compact_index(job.collection_name)
+    elif job.status == 'failed' and job.embedding_backend:
+        remove_failed_collection(job.collection_name)
+
+
+def remove_failed_collection(collection_name):
+    # Neue Kollektion, deren Dateien alle fehlgeschlagen sind: die bereits angelegte Chroma-Collection
+    # (ggf. mit Chunks aus Teilen der Dateien) wieder entfernen, damit der Name erneut verwendet werden kann
+    catalog_collection = Collection.query.filter_by(name=collection_name).first()
+    if catalog_collection and catalog_collection.files:
+        return
+    try:
+        remove_collection(collection_name)
+        logging.info(f"Removed collection {collection_name} after all files failed")
+    except Exception as e:
+        logging.error(f"Removing failed collection {collection_name} failed: {e}", exc_info=True)
+
+
+def remove_collection(collection_name):
+    # Einträge im Katalog ohne Chroma-Collection (z.B. Indexierung nie gestartet) lassen sich ebenso löschen
+    if any(collection.name == collection_name for collection in get_chroma_client().list_collections()):
+        get_chroma_client().delete_collection(name=collection_name)
+    lexical_index.drop_collection(collection_name)
+    compact_index.drop_collection(collection_name)
+    forget_collection(collection_name)
+    if response_cache:
+        response_cache.invalidate_collection(collection_name)
+    catalog_collection = Collection.query.filter_by(name=collection_name).first()
+    if catalog_collection:
+        db.session.delete(catalog_collection)
+        db.session.commit()
+
+
+def rebuild_compact_index(collection_name):
+    # Snapshot nach Abschluss eines Jobs neu erstellen, sofern geänderte Dateien ihn verworfen haben
+    if not compact_index.COMPACT_INDEX_ENABLED or compact_index.has_snapshot(collection_name):
+        return
+    try:
+        compact_index.rebuild_from_chroma(get_chroma_client().get_collection(name=collection_name))
+    except Exception as e:
+        logging.error(f"Building compact index for collection {collection_name} failed: {e}", exc_info=True)
+
+
+def get_or_create_catalog_collection(collection_name, description=None):
+    collection = Collection.query.filter_by(name=collection_name).first()
+    if collection is not None:
+        return collection
+    try:
+        collection = Collection(name=collection_name, description=description)
+        db.session.add(collection)
+        db.session.commit()
+        return collection
+    except IntegrityError:
+        # Ein anderer Worker hat den Eintrag gleichzeitig angelegt
+        db.session.rollback()
+        return Collection.query.filter_by(name=collection_name).first()
+
+
+def update_catalog(collection_name, filename, result):
+    collection = get_or_create_catalog_collection(collection_name, result.get('description'))
+    if not collection.description:
+        collection.description = result.get('description')
+    catalog_file = File.query.filter_by(collection_id=collection.id, filename=filename).first()
+    if catalog_file is None:
+        catalog_file = File(collection=collection, filename=filename)
+        db.session.add(catalog_file)
+    catalog_file.hash = result.get('hash')
+    catalog_file.chunk_count = result.get('chunk_count', 0)
+    catalog_file.page_count = result.get('page_count', 0)
+    db.session.commit()
+
+
+def read_catalog_sources(chroma_collection):
+    # Dateien einer Chroma-Collection mit Chunk- und Seitenzahl sowie die Beschreibung aus den Metadaten
+    sources = {}
+    description = None
+    offset, page_size = 0, 10000
+    while True:
+        batch = chroma_collection.get(include=['metadatas'], limit=page_size, offset=offset)
+        for metadata in batch['metadatas']:
+            source = sources.setdefault(metadata.get('source', 'Unknown'),
+                                        {'chunk_count': 0, 'hash': None, 'page_count': 0})
+            source['chunk_count'] += 1
+            source['hash'] = metadata.get('hash')
+            source['page_count'] = max(source['page_count'],
+                                       metadata.get('page_end', metadata.get('page_number', 0)) or 0)
+            description = description or metadata.get('description')
+        if len(batch['ids']) < page_size:
+            break
+        offset += page_size
+    return sources, description
+
+
+def rebuild_catalog(only_missing=False):
+    # Baut den Katalog vollständig aus den Metadaten in Chroma neu auf. Mit only_missing werden nur
+    # Collections ohne Katalogeintrag ergänzt; das dürfen mehrere Prozesse gleichzeitig tun.
+    chroma_collections = get_chroma_client().list_collections()
+    if not only_missing:
+        chroma_names = {collection.name for collection in chroma_collections}
+        for collection in Collection.query.all():
+            if collection.name not in chroma_names:
+                db.session.delete(collection)
+        db.session.commit()
+
+    for chroma_collection in chroma_collections:
+        if only_missing and Collection.query.filter_by(name=chroma_collection.name).first() is not None:
+            continue
+        sources, description = read_catalog_sources(chroma_collection)
+        if only_missing:
+            # Eintrag und Dateien in einer Transaktion, damit ein gleichzeitig laufender Prozess nichts doppelt anlegt
+            collection = Collection(name=chroma_collection.name, description=description)
+            db.session.add(collection)
+        else:
+            collection = get_or_create_catalog_collection(chroma_collection.name, description)
+            collection.description = description
+            File.query.filter_by(collection_id=collection.id).delete()
+        for filename, source in sources.items():
+            db.session.add(File(collection=collection, filename=filename, **source))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            logging.info(f"Catalog entry for collection {chroma_collection.name} was created by another process")
+            continue
+        logging.info(f"Rebuilt catalog for collection {chroma_collection.name}: {len(sources)} files")
+
+
+@app.cli.command('rebuild-catalog')
+def rebuild_catalog_command():
+    init_db()
+    rebuild_catalog()
+
+
+# Übernimmt die Daten einer bestehenden Datenbank (z.B. sqlite:///instance/site.db, auch im Schema von init.sql)
+# in die leere Datenbank unter DATABASE_URL
+@app.cli.command('copy-database')
+@click.argument('source_url')
+def copy_database_command(source_url):
+    init_db()
+    source_engine = create_engine(source_url)
+    try:
+        copied = copy_tables(db.metadata, source_engine, db.engine)
+    finally:
+        source_engine.dispose()
+    for table_name, count in copied.items():
+        click.echo(f"{table_name}: {count} rows")
+
+
+@app.cli.command('rebuild-lexical-index')
+def rebuild_lexical_index_command():
+    for collection in get_chroma_client().list_collections():
+        lexical_index.rebuild_from_chroma(collection)
+
+
+@app.cli.command('rebuild-compact-index')
+def rebuild_compact_index_command():
+    if not compact_index.COMPACT_INDEX_ENABLED:
+        click.echo("COMPACT_INDEX_ENABLED is not set")
+        return
+    for collection in get_chroma_client().list_collections():
+        compact_index.rebuild_from_chroma(collection)
+
+
+def process_ingestion_file(file_id):
+    ingestion_file = db.session.get(IngestionFile, file_id)
+    job = ingestion_file.job
+    if job.status == 'queued':
+        job.status = 'running'
+        db.session.commit()
+
+    def report_progress(**counts):
+        for key, value in counts.items():
+            setattr(ingestion_file, key, value)
+        ingestion_file.heartbeat = time.time()
+        db.session.commit()
+
+    start = time.perf_counter()
+    changed = False
+    try:
+        result = process_pdf_and_add_to_collection(ingestion_file.file_path, job.collection_name,
+                                                   progress_callback=report_progress,
+                                                   source_name=ingestion_file.filename,
+                                                   embedding_backend=job.embedding_backend)
+        ingestion_file.status = 'unchanged' if result.get('skipped') else 'done'
+        metrics.record_ingestion(ingestion_file.status,
+                                 chunks=0 if result.get('skipped') else result.get('chunk_count', 0),
+                                 pages=0 if result.get('skipped') else result.get('page_count', 0),
+                                 seconds=time.perf_counter() - start)
+        changed = not result.get('skipped')
+        update_catalog(job.collection_name, ingestion_file.filename, result)
+        logging.debug(f"Processed file '{ingestion_file.filename}' and added to collection '{job.collection_name}'")
+    except Exception as e:
+        logging.error(f"Ingestion of '{ingestion_file.filename}' failed: {e}", exc_info=True)
+        db.session.rollback()
+        ingestion_file.status = 'failed'
+        ingestion_file.error = str(e)
+        metrics.record_ingestion('failed', seconds=time.perf_counter() - start)
+        # Chunks werden fensterweise geschrieben; ab dem ersten Fenster kann die Kollektion verändert sein
+        changed = bool(ingestion_file.chunks_total)
+    finally:
+        # Geänderte Inhalte machen gespeicherte Antworten und den Snapshot dieser Kollektion ungültig
+        if changed:
+            if response_cache:
+                response_cache.invalidate_collection(job.collection_name)
+            compact_index.drop_collection(job.collection_name)
+        if os.path.exists(ingestion_file.file_path):
+            os.remove(ingestion_file.file_path)
+        db.session.commit()
+        update_ingestion_job_status(job)
+
+
+def enqueue_ingestion_job(collection_name, files, embedding_backend=None):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Die Kollektion erscheint sofort in der Übersicht und lässt sich dort auch wieder löschen
+    get_or_create_catalog_collection(collection_name)
+    job = IngestionJob(collection_name=collection_name, embedding_backend=embedding_backend)
+    db.session.add(job)
+    for file in files:
+        filename = secure_filename(file.filename)
+        # Eindeutiger Dateiname, damit sich gleichnamige Uploads nicht überschreiben
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{filename}")
+        file.save(file_path)
+        logging.debug(f"Saved file '{filename}' to '{file_path}'")
+        db.session.add(IngestionFile(job=job, filename=filename, file_path=file_path))
+    db.session.commit()
+    ingestion_wakeup.set()
+    return job
+
+
+def ingestion_worker():
+    while True:
+        try:
+            with app.app_context():
+                file_id = claim_next_ingestion_file()
+                if file_id is not None:
+                    process_ingestion_file(file_id)
+                    continue
+        except Exception as e:
+            logging.error(f"Ingestion worker error: {e}", exc_info=True)
+        ingestion_wakeup.wait(INGESTION_POLL_INTERVAL)
+        ingestion_wakeup.clear()
+
+
+def build_missing_lexical_indexes():
+    # Collections aus der Zeit vor der hybriden Suche nachträglich in den Volltextindex aufnehmen
+    try:
+        for collection in get_chroma_client().list_collections():
+            if not lexical_index.has_index(collection.name):
+                lexical_index.rebuild_from_chroma(collection)
+    except Exception as e:
+        logging.error(f"Building lexical indexes failed: {e}", exc_info=True)
+
+
+def prewarm_query_embeddings():
+    # Die häufigsten bisherigen Prompts vorab einbetten, damit wiederkehrende Fragen ohne API-Aufruf suchen
+    try:
+        with app.app_context():
+            rows = db.session.query(Conversation.input).group_by(Conversation.input) \
+                .order_by(func.count(Conversation.id).desc()).limit(EMBEDDING_PREWARM_COUNT).all()
+        query_embedder.prewarm([row.input for row in rows])
+    except Exception as e:
+        logging.error(f"Prewarming query embeddings failed: {e}", exc_info=True)
+
+
+def build_missing_compact_indexes():
+    # Snapshots für kleine Collections anlegen, damit die Suche nach einem Neustart ohne HNSW-Index auskommt
+    try:
+        for collection in get_chroma_client().list_collections():
+            rebuild_compact_index(collection.name)
+    except Exception as e:
+        logging.error(f"Building compact indexes failed: {e}", exc_info=True)
+
+
+def start_ingestion_workers():
+    global ingestion_workers_started
+    with ingestion_workers_lock:
+        if ingestion_workers_started:
+            return
+        ingestion_workers_started = True
+    try:
+        with app.app_context():
+            init_db()
+            requeue_stale_ingestion_files()
+            # Katalog beim ersten Start nach dem Update aus Chroma aufbauen
+            if Collection.query.first() is None and get_chroma_client().list_collections():
+                rebuild_catalog(only_missing=True)
+    except Exception as e:
+        # Die Worker trotzdem starten; die Tabellen legt dann z.B. ein gleichzeitig startender Prozess an
+        logging.error(f"Initializing the database failed: {e}", exc_info=True)
+    for i in range(INGESTION_WORKERS):
+        threading.Thread(target=ingestion_worker, name=f"ingestion-worker-{i}", daemon=True).start()
+    threading.Thread(target=build_missing_lexical_indexes, name="lexical-index-builder", daemon=True).start()
+    if EMBEDDING_PREWARM_COUNT > 0:
+        threading.Thread(target=prewarm_query_embeddings, name="embedding-prewarm", daemon=True).start()
+    if compact_index.COMPACT_INDEX_ENABLED:
+        threading.Thread(target=build_missing_compact_indexes, name="compact-index-builder", daemon=True).start()
+    logging.info(f"Started {INGESTION_WORKERS} ingestion workers")
+
+
+@app.before_request
+def ensure_ingestion_workers():
+    if not ingestion_workers_started:
+        start_ingestion_workers()
+
+
+# Messung der Antwortzeiten je Route; Stufenzeiten optional als Server-Timing-Header
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def finish_request_metrics(response):
+    if 'request_start' in g and request.endpoint != 'prometheus_metrics':
+        metrics.record_request(request.endpoint or 'unknown', request.method, response.status_code,
+                               time.perf_counter() - g.request_start)
+        server_timing = metrics.server_timing_header()
+        if server_timing:
+            response.headers['Server-Timing'] = server_timing
+    return response
+
+
+def cache_metrics():
+    values = []
+    if embedding_cache:
+        stats = embedding_cache.stats()
+        values += [
+            ('app_embedding_cache_hits', 'Embedding cache hits since start', {}, stats['hits']),
+            ('app_embedding_cache_misses', 'Embedding cache misses since start', {}, stats['misses']),
+            ('app_embedding_cache_size_bytes', 'Size of the embedding cache', {}, stats['size_bytes']),
+        ]
+    stats = query_embedder.stats()
+    values += [
+        ('app_query_embedding_memory_entries', 'Query embeddings held in memory', {}, stats['entries']),
+        ('app_query_embedding_batches', 'Micro-batched embedding requests since start', {}, stats['batches']),
+        ('app_query_embedding_batched_texts', 'Texts embedded in micro-batches since start', {},
+         stats['batched_texts']),
+    ]
+    if response_cache:
+        stats = response_cache.stats()
+        values += [
+            ('app_response_cache_entries', 'Entries in the response cache', {}, stats['entries']),
+            ('app_response_cache_hit_rate', 'Response cache hit rate since start', {}, stats['hit_rate']),
+        ]
+    return values
+
+
+metrics.register_collector(cache_metrics)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.METRICS_ENABLED:
+        abort(404)
+    # Zugriff mit dem Token (für Prometheus) oder als angemeldeter Benutzer
+    token_valid = bool(metrics.METRICS_TOKEN) and hmac.compare_digest(
+        request.headers.get('Authorization', ''), f"Bearer {metrics.METRICS_TOKEN}")
+    if not token_valid and not current_user.is_authenticated:
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 # Route zum Auflisten der System-Prompts
 @app.route('/system_prompts', methods=['GET'])
 @login_required
 def list_system_prompts():
-    prompts = SystemPrompt.query.all()
-    return jsonify([{'id': p.id, 'name': p.name, 'content': p.content} for p in prompts])
+    return jsonify(get_system_prompts())
 
 
 # Route zum Erstellen eines neuen System-Prompts
@@ -169,6 +745,7 @@ def create_system_prompt():
     new_prompt = SystemPrompt(name=data['name'], content=data['content'])
     db.session.add(new_prompt)
     db.session.commit()
+    system_prompt_cache.invalidate()
     return jsonify({'id': new_prompt.id, 'name': new_prompt.name, 'content': new_prompt.content}), 201
 
 
@@ -186,6 +763,9 @@ def system_prompt(prompt_id):
         prompt.name = data['name']
         prompt.content = data['content']
         db.session.commit()
+        system_prompt_cache.invalidate()
+        if response_cache:
+            response_cache.invalidate_system_prompt(prompt_id)
         return jsonify({'id': prompt.id, 'name': prompt.name, 'content': prompt.content})
 
 
@@ -196,6 +776,9 @@ def delete_system_prompt(prompt_id):
     prompt = SystemPrompt.query.get_or_404(prompt_id)
     db.session.delete(prompt)
     db.session.commit()
+    system_prompt_cache.invalidate()
+    if response_cache:
+        response_cache.invalidate_system_prompt(prompt_id)
     return '', 204
 
 
@@ -212,13 +795,19 @@ def create_collection():
             app.logger.warning("Collection name is missing")
             return jsonify({"error": "Collection name is required"}), 400
 
-        existing_collections = chroma_client.list_collections()
+        existing_collections = get_chroma_client().list_collections()
         logging.debug(f"Existing collections: {[collection.name for collection in existing_collections]}")
 
         if any(collection.name == collection_name for collection in existing_collections):
             logging.debug(f"Collection '{collection_name}' already exists")
             return jsonify({"error": f"Collection '{collection_name}' already exists"}), 400
 
+        embedding_backend = request.form.get('embedding_backend') or 'azure'
+        if embedding_backend not in EMBEDDING_BACKENDS:
+            return jsonify({"error": f"Unknown embedding backend '{embedding_backend}'"}), 400
+        if embedding_backend == 'local' and not local_embeddings.model_available():
+            return jsonify({"error": f"No local embedding model found in {local_embeddings.LOCAL_EMBEDDING_MODEL_PATH}"}), 400
+
         if 'pdfs' not in request.files:
             logging.debug("No PDF files provided")
             return jsonify({"error": "No PDF files provided"}), 400
@@ -230,40 +819,78 @@ def create_collection():
             logging.debug("No selected PDF files")
             return jsonify({"error": "No selected PDF files"}), 400
 
-        processed_files = []
         for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                logging.debug(f"Saved file '{filename}' to '{file_path}'")
+            if not (file and allowed_file(file.filename)):
+                logging.debug(f"Invalid file: {file.filename}")
+                return jsonify({"error": f"Invalid file: {file.filename}"}), 400
 
-                process_pdf_and_add_to_collection(file_path, collection_name)
-                logging.debug(f"Processed file '{filename}' and added to collection '{collection_name}'")
+        if IngestionJob.query.filter(IngestionJob.collection_name == collection_name,
+                                     IngestionJob.status.in_(['queued', 'running'])).first():
+            logging.debug(f"Collection '{collection_name}' is already being created")
+            return jsonify({"error": f"Collection '{collection_name}' is already being created"}), 400
 
-                processed_files.append(filename)
-                os.remove(file_path)  # Optional: remove the file after processing
-                logging.debug(f"Removed file '{file_path}' after processing")
+        job = enqueue_ingestion_job(collection_name, files, embedding_backend)
 
-            else:
-                logging.debug(f"Invalid file: {file.filename}")
+        return jsonify({
+            "message": f"Collection '{collection_name}' wird erstellt",
+            "job_id": job.id,
+            "files": [f.filename for f in job.files]
+        }), 202
+    except Exception as e:
+        logging.error(f"An error occurred: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+# Route zum erneuten Einlesen von Dateien in eine bestehende Kollektion.
+# Unveränderte Dateien werden übersprungen, geänderte nur auf Chunk-Ebene aktualisiert.
+@app.route('/update_collection/<collection_name>', methods=['POST'])
+@login_required
+def update_collection(collection_name):
+    try:
+        if not any(collection.name == collection_name for collection in get_chroma_client().list_collections()):
+            return jsonify({"error": f"Collection '{collection_name}' does not exist"}), 404
+
+        files = request.files.getlist('pdfs')
+        if not files or all(file.filename == '' for file in files):
+            return jsonify({"error": "No selected PDF files"}), 400
+
+        for file in files:
+            if not (file and allowed_file(file.filename)):
                 return jsonify({"error": f"Invalid file: {file.filename}"}), 400
 
+        job = enqueue_ingestion_job(collection_name, files)
+
         return jsonify({
-            "message": f"Collection '{collection_name}' created successfully",
-            "processed_files": processed_files
-        })
+            "message": f"Collection '{collection_name}' wird aktualisiert",
+            "job_id": job.id,
+            "files": [f.filename for f in job.files]
+        }), 202
     except Exception as e:
         logging.error(f"An error occurred: {e}")
         return jsonify({"error": str(e)}), 500
 
 
+# Route zum Abfragen des Fortschritts eines Indexierungsauftrags
+@app.route('/ingestion_jobs/<int:job_id>')
+@login_required
+def ingestion_job(job_id):
+    job = IngestionJob.query.get_or_404(job_id)
+    return jsonify(ingestion_job_to_dict(job))
+
+
+@app.route('/ingestion_jobs')
+@login_required
+def list_ingestion_jobs():
+    jobs = IngestionJob.query.order_by(IngestionJob.id.desc()).limit(20).all()
+    return jsonify({'jobs': [ingestion_job_to_dict(job) for job in jobs]})
+
+
 # Route zum Löschen einer Kollektion
 @app.route('/delete_collection/<collection_name>', methods=['POST'])
 @login_required
 def delete_collection(collection_name):
     try:
-        chroma_client.delete_collection(name=collection_name)
+        remove_collection(collection_name)
         return jsonify({'message': f'Collection "{collection_name}" wurde erfolgreich gelöscht.'}), 200
     except Exception as e:
         return jsonify({'message': f'Fehler beim Löschen der Collection: {str(e)}'}), 500
@@ -288,7 +915,7 @@ def get_maintenance_status():
 def index():
     global maintenance_mode
     labels = load_labels()
-    system_prompts = SystemPrompt.query.all()
+    system_prompts = get_system_prompts()
     options = load_options()  # Optionen laden
 
     if maintenance_mode and request.method == 'GET':
@@ -298,65 +925,57 @@ def index():
         try:
             # Verarbeite POST-Anfrage für Textgenerierung
             form_data = request.form
-            prompt = form_data.get('prompt')
-            collection_name = form_data.get('collection_name')
-            length = form_data.get('text_length', 'mittel')
-            tone = form_data.get('tone', 'professionell')
-            service = form_data.get('service', 'azure')
-            system_prompt_id = form_data.get('system_prompt_id')
-            formality = form_data.get('formality', 'formal')
-
             logging.info(f"Received form data: {form_data}")
 
-            if not collection_name:
-                raise ValueError("No collection selected")
-
-            # Suche relevante Dokumente in der ausgewählten Kollektion
-            collection = chroma_client.get_collection(name=collection_name)
-            results = collection.query(
-                query_embeddings=[create_embedding(prompt)],
-                n_results=5,
-                include=["documents", "metadatas", "distances"]
-            )
-
-            context = "\n".join(results["documents"][0])
-            citations = [f"{meta.get('source', 'Unknown')} - S. {meta.get('page_number', 'N/A')}"
-                         for meta in results["metadatas"][0]]
-
-            selected_system_prompt = SystemPrompt.query.get(system_prompt_id)
-            system_message = selected_system_prompt.content if selected_system_prompt else "You are a helpful AI assistant."
-
-            user_message = f"""
-Use this context if it's helpful: {context}
-
-Now, respond in German to the following prompt: {prompt}
-
-Keep the text {length}, stick to this tone of voice: {tone}, and use a {formality} level of formality.
-""".strip()
+            generation = build_index_request(form_data)
+            service = generation['service']
+            prompt = generation['prompt']
+            system_prompt_id = generation['system_prompt_id']
+            citations = generation['citations']
+
+            cached = generation['cached']
+            if cached:
+                logging.info(f"Serving response from cache ({cached['match']} match)")
+                save_conversation(prompt, cached['response'], system_prompt_id)
+                if form_data.get('stream') == 'true':
+                    return sse_response(cached_index_events(generation, recent_conversations()))
+                return jsonify({
+                    'generated_text': cached['response'],
+                    'citations': citations,
+                    'conversations': recent_conversations(),
+                    'selected_service': service,
+                    'cached': cached['match'],
+                    'token_budget': generation['token_budget']
+                })
+
+            if form_data.get('stream') == 'true':
+                return sse_response(stream_index_response(service, generation['messages'], prompt, system_prompt_id,
+                                                          citations, generation))
 
             # Generiere Text basierend auf dem Prompt und Kontext
-            generated_text = generate_text(service, system_message, user_message)
+            generated_text, used_service = generate_text(service, generation['messages'])
 
             logging.info(f"Generated text: {generated_text[:100]}...")  # Log first 100 characters
 
             # Speichere die Konversation in der Datenbank
-            conversation = Conversation(input=prompt, output=generated_text, system_prompt_id=system_prompt_id)
-            db.session.add(conversation)
-            db.session.commit()
-
-            conversations = Conversation.query.order_by(Conversation.id.desc()).limit(10).all()
-            conversations_data = [{'input': conv.input, 'output': conv.output} for conv in conversations]
+            save_conversation(prompt, generated_text, system_prompt_id)
+            cache_index_response(generation, generated_text, used_service)
 
             response_data = {
                 'generated_text': generated_text,
                 'citations': citations,
-                'conversations': conversations_data,
-                'selected_service': service
+                'conversations': recent_conversations(),
+                'selected_service': used_service,
+                'cached': None,
+                'token_budget': generation['token_budget']
             }
 
             logging.info(f"Sending response: {str(response_data)[:500]}...")  # Log first 500 characters of response
             return jsonify(response_data)
 
+        except InvalidRequestError as e:
+            logging.warning(f"Invalid index request: {str(e)}")
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             logging.error(f"Error in index: {str(e)}", exc_info=True)
             error_response = {'error': str(e)}
@@ -365,7 +984,7 @@ Keep the text {length}, stick to this tone of voice: {tone}, and use a {formalit
 
     # GET request
     try:
-        collections = chroma_client.list_collections()
+        collections = get_chroma_client().list_collections()
         conversations = Conversation.query.order_by(Conversation.id.desc()).limit(10).all()
         conversations_data = [{'input': conv.input, 'output': conv.output} for conv in conversations]
 
@@ -382,6 +1001,282 @@ Keep the text {length}, stick to this tone of voice: {tone}, and use a {formalit
         return jsonify({'error': 'An error occurred while loading the page'}), 500
 
 
+# Bereitet eine Textgenerierung der Startseite vor: Suche in der Kollektion, System-Prompt und Prompt-Vorlage.
+# Wird von der Flask-Route und vom ASGI-Einstiegspunkt (asgi.py) gemeinsam genutzt.
+def build_index_request(form_data):
+    settings = index_settings(form_data)
+    prompt = form_data.get('prompt')
+
+    # Suche relevante Dokumente in den ausgewählten Kollektionen
+    hits = retrieve_federated(settings['collection_names'], prompt, n_results=5)
+    return prepare_index_generation(prompt, hits, settings)
+
+
+# Ungültige Eingaben des Clients; die Routen antworten darauf mit 400 statt 500
+class InvalidRequestError(ValueError):
+    pass
+
+
+# Der gewählte LLM-Dienst muss im Router bekannt sein (fehlt er, wird Azure verwendet)
+def requested_service(data):
+    service = data.get('service', 'azure')
+    if service not in llm_router.backends:
+        raise InvalidRequestError(f"Unknown service: {service!r}")
+    return service
+
+
+# Einstellungen der Startseite, die für alle Prompts einer Anfrage gelten (auch bei /batch_generate)
+def index_settings(form_data):
+    collection_names = requested_collections(form_data)
+    if not collection_names:
+        raise InvalidRequestError("No collection selected")
+
+    system_prompt_id = form_data.get('system_prompt_id')
+    selected_system_prompt = get_system_prompt(system_prompt_id)
+    return {
+        'collection_names': collection_names,
+        'length': form_data.get('text_length', 'mittel'),
+        'tone': form_data.get('tone', 'professionell'),
+        'formality': form_data.get('formality', 'formal'),
+        'service': requested_service(form_data),
+        'system_prompt_id': system_prompt_id,
+        'system_message': selected_system_prompt['content'] if selected_system_prompt
+        else "You are a helpful AI assistant."
+    }
+
+
+# Prompt-Vorlage, Kontext-Budget und Antwort-Cache für einen Prompt mit bereits gefundenen Treffern
+def prepare_index_generation(prompt, hits, settings):
+    # Unter diesem Namen speichert der Antwort-Cache, damit Änderungen jeder beteiligten Kollektion ihn leeren
+    collection_name = ",".join(settings['collection_names'])
+    length = settings['length']
+    tone = settings['tone']
+    formality = settings['formality']
+    service = settings['service']
+    system_prompt_id = settings['system_prompt_id']
+    system_message = settings['system_message']
+
+    def render_user_message(context):
+        return f"""
+Use this context if it's helpful: {context}
+
+Now, respond in German to the following prompt: {prompt}
+
+Keep the text {length}, stick to this tone of voice: {tone}, and use a {formality} level of formality.
+""".strip()
+
+    # Kontext nur so weit aufnehmen, wie er neben Prompt und Antwort ins Kontextfenster passt
+    context, hits, token_budget = assemble_prompt_context(service, hits, [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": render_user_message("")},
+    ], INDEX_COMPLETION_TOKENS)
+    citations = [format_citation(hit["metadata"], hit.get("collection")) for hit in hits]
+    user_message = render_user_message(context)
+    messages = [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_message},
+    ]
+    token_budget['prompt_tokens'] = count_message_tokens(messages, model_name(service))
+
+    # Gleiche Anfragen mit denselben Fundstellen aus dem Antwort-Cache bedienen
+    cache_keys = None
+    cached = None
+    # Für die semantische Stufe wird der Prompt mit dem Modell der (ersten) Kollektion eingebettet
+    cache_embedder = None
+    if response_cache:
+        params = {
+            'prompt': prompt,
+            'collection': collection_name,
+            'system_message': system_message,
+            'length': length,
+            'tone': tone,
+            'formality': formality,
+            'service': service,
+            'model': model_name(service)
+        }
+        try:
+            if RESPONSE_CACHE_SEMANTIC_ENABLED:
+                cache_embedder = collection_query_embedder(settings['collection_names'][0])
+                params['embedding_model'] = cache_embedder.model
+            cache_keys = response_cache.make_keys(params, [hit["id"] for hit in hits])
+            cached = response_cache.lookup(*cache_keys, embedding_fn=lambda: cache_embedder.embed(prompt))
+            metrics.record_cache('response', cached['match'] if cached else 'miss')
+        except Exception as e:
+            logging.warning(f"Response cache lookup failed: {e}")
+
+    return {
+        'prompt': prompt,
+        'collection_name': collection_name,
+        'service': service,
+        'system_prompt_id': system_prompt_id,
+        'system_message': system_message,
+        'user_message': user_message,
+        'messages': messages,
+        'citations': cached['citations'] if cached else citations,
+        'token_budget': token_budget,
+        'cache_keys': cache_keys,
+        'cache_embedder': cache_embedder,
+        'cached': cached
+    }
+
+
+def cache_index_response(generation, generated_text, used_service):
+    # Antworten eines Ausweich-Backends passen nicht zu den Parametern im Cache-Schlüssel
+    if not response_cache or not generation['cache_keys'] or used_service != generation['service']:
+        return
+    try:
+        # Das Embedding des Prompts liegt nach der Suche bereits im Speicher-Cache des Embedders
+        cache_embedder = generation['cache_embedder']
+        embedding = cache_embedder.embed(generation['prompt']) if cache_embedder else None
+        response_cache.put(*generation['cache_keys'], collection=generation['collection_name'],
+                           system_prompt_id=generation['system_prompt_id'], embedding=embedding,
+                           response=generated_text, citations=generation['citations'])
+    except Exception as e:
+        logging.warning(f"Could not store response in cache: {e}")
+
+
+def cached_index_events(generation, conversations):
+    cached = generation['cached']
+    yield sse_event('meta', {'citations': generation['citations'], 'selected_service': generation['service'],
+                             'cached': cached['match'], 'token_budget': generation['token_budget']})
+    yield sse_event('token', {'text': cached['response']})
+    yield sse_event('done', {'generated_text': cached['response'], 'conversations': conversations})
+
+
+def save_conversation(prompt, generated_text, system_prompt_id):
+    with metrics.timed("persist"):
+        conversation = Conversation(input=prompt, output=generated_text, system_prompt_id=system_prompt_id)
+        db.session.add(conversation)
+        db.session.commit()
+
+
+def recent_conversations():
+    conversations = Conversation.query.order_by(Conversation.id.desc()).limit(10).all()
+    return [{'input': conv.input, 'output': conv.output} for conv in conversations]
+
+
+def stream_index_response(service, messages, prompt, system_prompt_id, citations, generation=None):
+    parts = []
+    completed = False
+    route = {'service': service}
+    try:
+        yield sse_event('meta', {'citations': citations, 'selected_service': service, 'cached': None,
+                                 'token_budget': generation['token_budget'] if generation else None})
+        for token in stream_text(service, messages, route=route):
+            parts.append(token)
+            yield sse_event('token', {'text': token})
+        completed = True
+    except GeneratorExit:
+        logging.info("Client disconnected during streaming generation")
+        raise
+    except Exception as e:
+        logging.error(f"Error while streaming in index: {str(e)}", exc_info=True)
+        yield sse_event('error', {'error': str(e)})
+    finally:
+        # Auch bei Verbindungsabbruch wird der bis dahin erzeugte Text gespeichert
+        generated_text = "".join(parts)
+        if generated_text:
+            save_conversation(prompt, generated_text, system_prompt_id)
+    if completed:
+        # Nur vollständige Antworten kommen in den Antwort-Cache
+        if generation:
+            cache_index_response(generation, generated_text, route['service'])
+        yield sse_event('done', {'generated_text': generated_text, 'conversations': recent_conversations(),
+                                 'selected_service': route['service']})
+
+
+# Beantwortet viele Fragen (z.B. eines Ausschreibungsfragebogens) mit gemeinsamen Einstellungen der Startseite.
+# Eingabe: Datei "file" (CSV/JSONL) oder "prompts" (JSON-Liste bzw. eine Frage pro Zeile), per Formular oder JSON.
+# Ausgabe: NDJSON-Stream in Fertigstellungsreihenfolge (Standard) oder mit format=csv als Download.
+@app.route('/batch_generate', methods=['POST'])
+@login_required
+def batch_generate():
+    try:
+        data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+        uploaded_file = request.files.get('file')
+        try:
+            if uploaded_file and uploaded_file.filename:
+                prompts = parse_prompt_file(uploaded_file.filename, uploaded_file.read())
+            else:
+                prompts = parse_prompt_list(data.get('prompts'))
+        except ValueError as e:
+            # Fehler in der hochgeladenen Datei liegen beim Client
+            raise InvalidRequestError(str(e)) from e
+        if not prompts:
+            raise InvalidRequestError("No prompts provided")
+        if len(prompts) > BATCH_MAX_PROMPTS:
+            raise InvalidRequestError(f"Too many prompts ({len(prompts)}), at most {BATCH_MAX_PROMPTS} per batch")
+
+        settings = index_settings(data)
+        # Alle Fragen mit gebündelten Embeddings und einer Chroma-Abfrage je Kollektion suchen
+        hits_per_prompt = retrieve_many_federated(settings['collection_names'], prompts, n_results=5)
+        generations = [prepare_index_generation(prompt, hits, settings)
+                       for prompt, hits in zip(prompts, hits_per_prompt)]
+        logging.info(f"Batch generation of {len(generations)} prompts in {', '.join(settings['collection_names'])}")
+
+        if data.get('format') == 'csv':
+            results = sorted(run_batch_generation(generations), key=lambda result: result['index'])
+            return Response(results_to_csv(results), mimetype='text/csv',
+                            headers={'Content-Disposition': 'attachment; filename=batch_results.csv'})
+        return Response(stream_with_context(json.dumps(result) + "\n" for result in run_batch_generation(generations)),
+                        mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+    except InvalidRequestError as e:
+        logging.warning(f"Invalid batch request: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in batch_generate: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
+
+
+def batch_result(index, generation, generated_text=None, service=None, cached=None, error=None):
+    return {
+        'index': index,
+        'prompt': generation['prompt'],
+        'generated_text': generated_text,
+        'citations': generation['citations'],
+        'selected_service': service,
+        'cached': cached,
+        'token_budget': generation['token_budget'],
+        'error': error
+    }
+
+
+# Erzeugt die Antworten parallel (höchstens BATCH_CONCURRENCY gleichzeitig und BATCH_REQUESTS_PER_MINUTE Starts
+# pro Minute) und liefert die Ergebnisse, sobald sie fertig sind. Gespeichert wird im aufrufenden Thread.
+def run_batch_generation(generations):
+    limiter = RateLimiter(BATCH_REQUESTS_PER_MINUTE)
+
+    def generate(generation):
+        limiter.wait()
+        return generate_text(generation['service'], generation['messages'])
+
+    executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY)
+    try:
+        futures = {}
+        for index, generation in enumerate(generations):
+            cached = generation['cached']
+            if cached:
+                save_conversation(generation['prompt'], cached['response'], generation['system_prompt_id'])
+                yield batch_result(index, generation, cached['response'], generation['service'], cached['match'])
+            else:
+                futures[executor.submit(generate, generation)] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            generation = generations[index]
+            try:
+                generated_text, used_service = future.result()
+            except Exception as e:
+                logging.error(f"Batch generation failed for prompt {index}: {str(e)}")
+                yield batch_result(index, generation, error=str(e))
+                continue
+            save_conversation(generation['prompt'], generated_text, generation['system_prompt_id'])
+            cache_index_response(generation, generated_text, used_service)
+            yield batch_result(index, generation, generated_text, used_service)
+    finally:
+        # Bricht der Client den Stream ab, werden noch nicht gestartete Generierungen verworfen
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 # Neue Route zum Umschalten des Wartungsmodus
 @app.route('/toggle_maintenance', methods=['POST'])
 @login_required
@@ -411,25 +1306,27 @@ def clear_chat_history():
 @app.route('/list_collections')
 @login_required
 def list_collections():
-    collections = chroma_client.list_collections()
-    collection_data = []
-    for collection in collections:
-        # Hole alle Metadaten für die Collection
-        all_metadata = collection.get(include=['metadatas'])
-
-        # Extrahiere einzigartige Dateinamen und Beschreibungen
-        unique_sources = set()
-        unique_descriptions = set()
-        for metadata in all_metadata['metadatas']:
-            unique_sources.add(metadata['source'])
-            unique_descriptions.add(metadata['description'])
+    # Liest nur den Katalog, statt alle Chunk-Metadaten aus Chroma zu laden
+    chunk_counts = dict(db.session.query(File.collection_id, func.coalesce(func.sum(File.chunk_count), 0))
+                        .group_by(File.collection_id).all())
+    files_by_collection = {}
+    for collection_id, filename in db.session.query(File.collection_id, File.filename).order_by(File.filename):
+        files_by_collection.setdefault(collection_id, []).append(filename)
+
+    # Collections, die nur in Chroma existieren (z.B. aus abgebrochenen Indexierungen), ebenfalls anzeigen
+    collections = {collection.name: collection for collection in Collection.query.all()}
+    for chroma_collection in get_chroma_client().list_collections():
+        collections.setdefault(chroma_collection.name, Collection(name=chroma_collection.name))
 
+    collection_data = []
+    for _, collection in sorted(collections.items()):
+        files = files_by_collection.get(collection.id, [])
         collection_info = {
             'name': collection.name,
-            'document_count': len(unique_sources),
-            'description': list(unique_descriptions)[0] if unique_descriptions else "Keine Beschreibung verfügbar",
-            'files': list(unique_sources),
-            'chunk_count': collection.count(),
+            'document_count': len(files),
+            'description': collection.description or "Keine Beschreibung verfügbar",
+            'files': files,
+            'chunk_count': chunk_counts.get(collection.id, 0),
             'embedding_function': "Default (change if you're using a custom one)",
             'max_tokens_per_chunk': 512  # This is the default value used in your function
         }
@@ -461,7 +1358,7 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    return render_template('dashboard.html')
+    return render_template('dashboard.html', local_embeddings_available=local_embeddings.model_available())
 
 
 @app.route('/create_new_session', methods=['POST'])
@@ -490,92 +1387,42 @@ def chat():
     if request.method == 'POST':
         try:
             data = request.json
-            message = data.get('message')
-            collection_name = data.get('collection_name')
-            system_prompt_id = data.get('system_prompt_id')
-            session_id = data.get('session_id')
-
-            if not message:
-                raise ValueError("No message provided")
-
-            # Erstellen oder Abrufen einer Chat-Sitzung
-            if not session_id:
-                chat_session = ChatSession()
-                db.session.add(chat_session)
-                db.session.commit()
-                session_id = chat_session.id
-            else:
-                chat_session = ChatSession.query.get(session_id)
-                if not chat_session:
-                    raise ValueError("Invalid session ID")
-
-            # Abrufen der Chathistorie für die aktuelle Session
-            chat_history = ChatMessage.query.filter_by(session_id=session_id).order_by(ChatMessage.created_at).all()
-
-            # Vorbereiten der Chathistorie für die KI
-            messages = []
-            for msg in chat_history:
-                messages.append({"role": msg.role, "content": msg.content})
-
-            # Speichern der Benutzernachricht
-            user_message = ChatMessage(session_id=session_id, role='user', content=message)
-            db.session.add(user_message)
-            messages.append({"role": "user", "content": message})
-
-            if collection_name:
-                collection = chroma_client.get_collection(name=collection_name)
-                results = collection.query(
-                    query_embeddings=[create_embedding(message)],
-                    n_results=5,
-                    include=["documents", "metadatas", "distances"]
-                )
-                context = "\n".join(results["documents"][0])
-                citations = [f"{meta.get('source', 'Unknown')} - S. {meta.get('page_number', 'N/A')}"
-                             for meta in results["metadatas"][0]]
-            else:
-                context = ""
-                citations = []
-
-            if system_prompt_id:
-                selected_system_prompt = SystemPrompt.query.get(system_prompt_id)
-                system_message = selected_system_prompt.content if selected_system_prompt else "You are a helpful AI assistant."
-            else:
-                system_message = "You are a helpful AI assistant."
+            prepared = build_chat_request(data)
+            session_id = prepared['session_id']
+            message = prepared['message']
+            messages = prepared['messages']
+            citations = prepared['citations']
 
-            # Hinzufügen der Systemnachricht und des Kontexts
-            messages.insert(0, {"role": "system", "content": system_message})
-            if context:
-                messages.append({"role": "system", "content": f"Relevant context: {context}"})
+            if data.get('stream'):
+                return sse_response(stream_chat_response(session_id, message, messages, citations,
+                                                         prepared['token_budget'], prepared['service']))
 
             # Generieren der Antwort mit der vollständigen Chathistorie
-            response = azure_openai_client.chat.completions.create(
-                model=AZURE_MODEL,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=800,
-            )
-            generated_text = response.choices[0].message.content
-
-            # Speichern der Assistentenantwort
-            assistant_message = ChatMessage(session_id=session_id, role='assistant', content=generated_text)
-            db.session.add(assistant_message)
+            generated_text, used_service = generate_text(prepared['service'], messages,
+                                                         max_tokens=CHAT_COMPLETION_TOKENS)
 
-            db.session.commit()
+            # Speichern der Benutzernachricht und der Assistentenantwort
+            save_chat_exchange(session_id, message, generated_text)
 
             return jsonify({
                 'message': generated_text,
                 'citations': citations,
-                'session_id': session_id
+                'session_id': session_id,
+                'selected_service': used_service,
+                'token_budget': prepared['token_budget']
             })
 
+        except InvalidRequestError as e:
+            logging.warning(f"Invalid chat request: {str(e)}")
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             logging.error(f"Error in chat: {str(e)}", exc_info=True)
             return jsonify({'error': str(e)}), 500
 
     # GET request
     try:
-        collections = chroma_client.list_collections()
-        system_prompts = SystemPrompt.query.all()
+        collections = get_chroma_client().list_collections()
+        system_prompts = get_system_prompts()
         chat_sessions = ChatSession.query.order_by(ChatSession.updated_at.desc()).limit(10).all()
 
         return render_template('chat.html',
@@ -588,6 +1435,181 @@ def chat():
         return jsonify({'error': 'An error occurred while loading the page'}), 500
 
 
+# Bereitet eine Chat-Antwort vor: Sitzung anlegen oder laden, Chathistorie, Suche und System-Prompt.
+# Wird von der Flask-Route und vom ASGI-Einstiegspunkt (asgi.py) gemeinsam genutzt.
+def build_chat_request(data):
+    message = data.get('message')
+    collection_names = requested_collections(data)
+    system_prompt_id = data.get('system_prompt_id')
+    session_id = data.get('session_id')
+    service = requested_service(data)
+
+    if not message:
+        raise InvalidRequestError("No message provided")
+
+    # Erstellen oder Abrufen einer Chat-Sitzung
+    if not session_id:
+        chat_session = ChatSession()
+        db.session.add(chat_session)
+        db.session.commit()
+        session_id = chat_session.id
+    else:
+        chat_session = ChatSession.query.get(session_id)
+        if not chat_session:
+            raise InvalidRequestError("Invalid session ID")
+
+    # Nur das Ende der Chathistorie innerhalb des Token-Budgets wörtlich übernehmen,
+    # ältere Nachrichten fließen über die Zusammenfassung ein
+    history = load_chat_history(chat_session)
+    overflow, history = split_history(history)
+    if overflow:
+        # Die Zusammenfassung wird im Hintergrund aktualisiert; bis dahin gilt die bisherige
+        schedule_chat_summary(chat_session.id, overflow[-1]["id"])
+
+    # Vorbereiten der Chathistorie für die KI
+    messages = []
+    if chat_session.summary:
+        messages.append(summary_message(chat_session.summary))
+    for entry in history:
+        messages.append({"role": entry["role"], "content": entry["content"]})
+
+    messages.append({"role": "user", "content": message})
+
+    if system_prompt_id:
+        selected_system_prompt = get_system_prompt(system_prompt_id)
+        system_message = selected_system_prompt['content'] if selected_system_prompt else "You are a helpful AI assistant."
+    else:
+        system_message = "You are a helpful AI assistant."
+    messages.insert(0, {"role": "system", "content": system_message})
+
+    # Der Kontext erhält das Budget, das nach Systemnachricht, Zusammenfassung, Historie und Antwort übrig bleibt
+    hits = retrieve_federated(collection_names, message, n_results=5) if collection_names else []
+    context, hits, token_budget = assemble_prompt_context(
+        service, hits, messages + [{"role": "system", "content": "Relevant context: "}], CHAT_COMPLETION_TOKENS)
+    citations = [format_citation(hit["metadata"], hit.get("collection")) for hit in hits]
+    if context:
+        messages.append({"role": "system", "content": f"Relevant context: {context}"})
+    token_budget['prompt_tokens'] = count_message_tokens(messages, model_name(service))
+
+    return {
+        'session_id': session_id,
+        'service': service,
+        'message': message,
+        'messages': messages,
+        'citations': citations,
+        'token_budget': token_budget
+    }
+
+
+# Lädt die Chathistorie seitenweise von hinten, bis das Token-Budget überschritten ist.
+# Nachrichten, die schon in der Zusammenfassung stehen, werden nicht geladen.
+def load_chat_history(chat_session):
+    query = ChatMessage.query.filter(ChatMessage.session_id == chat_session.id)
+    if chat_session.summary_until_id:
+        query = query.filter(ChatMessage.id > chat_session.summary_until_id)
+    history = []
+    tokens = 0
+    before_id = None
+    while tokens <= CHAT_HISTORY_MAX_TOKENS:
+        page_query = query.filter(ChatMessage.id < before_id) if before_id is not None else query
+        page = page_query.order_by(ChatMessage.id.desc()).limit(CHAT_HISTORY_PAGE_SIZE).all()
+        for msg in page:
+            entry = history_entry(msg)
+            history.append(entry)
+            tokens += entry["tokens"]
+        if len(page) < CHAT_HISTORY_PAGE_SIZE:
+            break
+        before_id = page[-1].id
+    history.reverse()
+    return history
+
+
+def summarize_chat_history(previous_summary, entries):
+    summary, _ = generate_text('azure', build_summary_messages(previous_summary, entries),
+                               max_tokens=CHAT_SUMMARY_MAX_TOKENS, temperature=0.3)
+    return summary
+
+
+# Je Sitzung läuft höchstens eine Aktualisierung der Zusammenfassung im Hintergrund;
+# danach hinzugekommene Nachrichten werden bei der nächsten Anfrage eingearbeitet
+chat_summary_sessions = set()
+chat_summary_lock = threading.Lock()
+
+
+def schedule_chat_summary(session_id, until_id):
+    with chat_summary_lock:
+        if session_id in chat_summary_sessions:
+            return
+        chat_summary_sessions.add(session_id)
+    threading.Thread(target=chat_summary_worker, args=(session_id, until_id),
+                     name=f"chat-summary-{session_id}", daemon=True).start()
+
+
+def chat_summary_worker(session_id, until_id):
+    try:
+        with app.app_context():
+            chat_session = ChatSession.query.get(session_id)
+            if chat_session:
+                refresh_chat_summary(chat_session, until_id)
+    except Exception as e:
+        logging.error(f"Updating summary of chat session {session_id} failed: {e}", exc_info=True)
+    finally:
+        with chat_summary_lock:
+            chat_summary_sessions.discard(session_id)
+
+
+# Arbeitet alle noch nicht zusammengefassten Nachrichten bis einschließlich until_id in die Zusammenfassung ein
+def refresh_chat_summary(chat_session, until_id):
+    query = ChatMessage.query.filter(ChatMessage.session_id == chat_session.id, ChatMessage.id <= until_id)
+    if chat_session.summary_until_id:
+        query = query.filter(ChatMessage.id > chat_session.summary_until_id)
+    pending = [history_entry(msg) for msg in query.order_by(ChatMessage.id).all()]
+    for batch in summary_batches(pending):
+        try:
+            summary = summarize_chat_history(chat_session.summary, batch)
+        except Exception as e:
+            # Ohne neue Zusammenfassung fehlen die ältesten Nachrichten nur in dieser Anfrage
+            logging.warning(f"Could not summarize chat session {chat_session.id}: {e}")
+            return
+        chat_session.summary = summary
+        chat_session.summary_until_id = batch[-1]["id"]
+        db.session.commit()
+    logging.debug(f"Updated summary of chat session {chat_session.id} up to message {until_id}")
+
+
+def save_chat_exchange(session_id, message, generated_text):
+    with metrics.timed("persist"):
+        db.session.add(ChatMessage(session_id=session_id, role='user', content=message))
+        db.session.add(ChatMessage(session_id=session_id, role='assistant', content=generated_text))
+        db.session.commit()
+
+
+def stream_chat_response(session_id, message, messages, citations, token_budget=None, service='azure'):
+    parts = []
+    completed = False
+    route = {'service': service}
+    try:
+        yield sse_event('meta', {'citations': citations, 'session_id': session_id, 'token_budget': token_budget})
+        for token in stream_text(service, messages, max_tokens=CHAT_COMPLETION_TOKENS, route=route):
+            parts.append(token)
+            yield sse_event('token', {'text': token})
+        completed = True
+    except GeneratorExit:
+        logging.info("Client disconnected during chat streaming")
+        raise
+    except Exception as e:
+        logging.error(f"Error while streaming in chat: {str(e)}", exc_info=True)
+        yield sse_event('error', {'error': str(e)})
+    finally:
+        # Benutzernachricht und (ggf. unvollständige) Antwort erst nach Ende des Streams speichern
+        generated_text = "".join(parts)
+        if generated_text:
+            save_chat_exchange(session_id, message, generated_text)
+    if completed:
+        yield sse_event('done', {'message': generated_text, 'session_id': session_id,
+                                 'selected_service': route['service']})
+
+
 @app.route('/chat_history/<int:session_id>', methods=['GET'])
 @login_required
 def chat_history(session_id):
@@ -605,7 +1627,7 @@ def allowed_file(filename):
 
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_db()
         # Create admin user if not exists
         admin_username = os.getenv('ADMIN_USERNAME')
         admin_password = os.getenv('ADMIN_PASSWORD')
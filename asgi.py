@@ -0,0 +1,242 @@
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import quote
+
+import anyio
+import anyio.to_thread
+from flask_login import current_user
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import metrics
+from app import (app as flask_app, CHAT_COMPLETION_TOKENS, INDEX_COMPLETION_TOKENS, InvalidRequestError,
+                 build_chat_request, build_index_request, cache_index_response, cached_index_events,
+                 recent_conversations, save_chat_exchange, save_conversation, sse_event, start_ingestion_workers)
+from llm_router import llm_router
+
+# ASGI-Einstiegspunkt: Die Textgenerierung auf "/" und "/chat" (POST) läuft asynchron, sodass ein Prozess
+# viele gleichzeitige Generierungen halten kann. Suche und Datenbankzugriffe laufen im Thread-Pool,
+# alle übrigen Routen und Templates werden unverändert von der Flask-App bedient.
+# Start: uvicorn asgi:app --host 0.0.0.0 --port 5001
+
+# Threads für Suche, Datenbankzugriffe und die übrigen Flask-Routen
+ASGI_THREADPOOL_SIZE = int(os.getenv("ASGI_THREADPOOL_SIZE", "64"))
+
+
+def _call_in_app_context(func, *args):
+    with flask_app.app_context():
+        return func(*args)
+
+
+async def run_in_app_context(func, *args):
+    # Blockierende Arbeit (Chroma, Embeddings, SQLAlchemy) im Thread-Pool mit eigenem App-Kontext ausführen
+    return await run_in_threadpool(_call_in_app_context, func, *args)
+
+
+def _is_authenticated(cookie_header):
+    # Die Sitzung wird wie in Flask aus dem Session-Cookie gelesen
+    with flask_app.test_request_context(headers={"Cookie": cookie_header}):
+        return current_user.is_authenticated
+
+
+async def login_redirect(request):
+    # Entspricht login_required: nicht angemeldete Benutzer werden zur Anmeldung umgeleitet
+    if await run_in_threadpool(_is_authenticated, request.headers.get("cookie", "")):
+        return None
+    return RedirectResponse(f"/login?next={quote(request.url.path)}", status_code=302)
+
+
+def sse_streaming_response(events):
+    return StreamingResponse(events, media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def finish_request(endpoint, request, response, start):
+    # Gegenstück zu den before/after_request-Hooks der Flask-App
+    metrics.record_request(endpoint, request.method, response.status_code, time.perf_counter() - start)
+    server_timing = metrics.server_timing_header()
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+
+async def stream_index_events(service, messages, prompt, system_prompt_id, citations, generation):
+    parts = []
+    completed = False
+    route = {'service': service}
+    try:
+        yield sse_event('meta', {'citations': citations, 'selected_service': service, 'cached': None,
+                                 'token_budget': generation['token_budget']})
+        async for token in llm_router.astream(service, messages, INDEX_COMPLETION_TOKENS, route=route):
+            parts.append(token)
+            yield sse_event('token', {'text': token})
+        completed = True
+    except (GeneratorExit, anyio.get_cancelled_exc_class()):
+        logging.info("Client disconnected during streaming generation")
+        raise
+    except Exception as e:
+        logging.error(f"Error while streaming in index: {str(e)}", exc_info=True)
+        yield sse_event('error', {'error': str(e)})
+    finally:
+        # Auch bei Verbindungsabbruch wird der bis dahin erzeugte Text gespeichert
+        generated_text = "".join(parts)
+        if generated_text:
+            with anyio.CancelScope(shield=True):
+                await run_in_app_context(save_conversation, prompt, generated_text, system_prompt_id)
+    if completed:
+        await run_in_threadpool(cache_index_response, generation, generated_text, route['service'])
+        conversations = await run_in_app_context(recent_conversations)
+        yield sse_event('done', {'generated_text': generated_text, 'conversations': conversations,
+                                 'selected_service': route['service']})
+
+
+async def stream_chat_events(session_id, message, messages, citations, token_budget, service):
+    parts = []
+    completed = False
+    route = {'service': service}
+    try:
+        yield sse_event('meta', {'citations': citations, 'session_id': session_id, 'token_budget': token_budget})
+        async for token in llm_router.astream(service, messages, CHAT_COMPLETION_TOKENS, route=route):
+            parts.append(token)
+            yield sse_event('token', {'text': token})
+        completed = True
+    except (GeneratorExit, anyio.get_cancelled_exc_class()):
+        logging.info("Client disconnected during chat streaming")
+        raise
+    except Exception as e:
+        logging.error(f"Error while streaming in chat: {str(e)}", exc_info=True)
+        yield sse_event('error', {'error': str(e)})
+    finally:
+        # Benutzernachricht und (ggf. unvollständige) Antwort erst nach Ende des Streams speichern
+        generated_text = "".join(parts)
+        if generated_text:
+            with anyio.CancelScope(shield=True):
+                await run_in_app_context(save_chat_exchange, session_id, message, generated_text)
+    if completed:
+        yield sse_event('done', {'message': generated_text, 'session_id': session_id,
+                                 'selected_service': route['service']})
+
+
+async def handle_index_post(request):
+    redirect = await login_redirect(request)
+    if redirect is not None:
+        return redirect
+    try:
+        form_data = await request.form()
+        logging.info(f"Received form data: {form_data}")
+
+        generation = await run_in_app_context(build_index_request, form_data)
+        service = generation['service']
+        prompt = generation['prompt']
+        system_prompt_id = generation['system_prompt_id']
+        citations = generation['citations']
+
+        cached = generation['cached']
+        if cached:
+            logging.info(f"Serving response from cache ({cached['match']} match)")
+            await run_in_app_context(save_conversation, prompt, cached['response'], system_prompt_id)
+            conversations = await run_in_app_context(recent_conversations)
+            if form_data.get('stream') == 'true':
+                return sse_streaming_response(cached_index_events(generation, conversations))
+            return JSONResponse({
+                'generated_text': cached['response'],
+                'citations': citations,
+                'conversations': conversations,
+                'selected_service': service,
+                'cached': cached['match'],
+                'token_budget': generation['token_budget']
+            })
+
+        if form_data.get('stream') == 'true':
+            return sse_streaming_response(stream_index_events(service, generation['messages'], prompt,
+                                                              system_prompt_id, citations, generation))
+
+        generated_text, used_service = await llm_router.acomplete(service, generation['messages'],
+                                                                  INDEX_COMPLETION_TOKENS)
+        logging.info(f"Generated text: {generated_text[:100]}...")
+
+        await run_in_app_context(save_conversation, prompt, generated_text, system_prompt_id)
+        await run_in_threadpool(cache_index_response, generation, generated_text, used_service)
+        return JSONResponse({
+            'generated_text': generated_text,
+            'citations': citations,
+            'conversations': await run_in_app_context(recent_conversations),
+            'selected_service': used_service,
+            'cached': None,
+            'token_budget': generation['token_budget']
+        })
+    except InvalidRequestError as e:
+        logging.warning(f"Invalid index request: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        logging.error(f"Error in index: {str(e)}", exc_info=True)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def handle_chat_post(request):
+    redirect = await login_redirect(request)
+    if redirect is not None:
+        return redirect
+    try:
+        data = await request.json()
+        prepared = await run_in_app_context(build_chat_request, data)
+        session_id = prepared['session_id']
+        message = prepared['message']
+        citations = prepared['citations']
+
+        if data.get('stream'):
+            return sse_streaming_response(stream_chat_events(session_id, message, prepared['messages'], citations,
+                                                             prepared['token_budget'], prepared['service']))
+
+        generated_text, used_service = await llm_router.acomplete(prepared['service'], prepared['messages'],
+                                                                  CHAT_COMPLETION_TOKENS)
+
+        await run_in_app_context(save_chat_exchange, session_id, message, generated_text)
+        return JSONResponse({
+            'message': generated_text,
+            'citations': citations,
+            'session_id': session_id,
+            'selected_service': used_service,
+            'token_budget': prepared['token_budget']
+        })
+    except InvalidRequestError as e:
+        logging.warning(f"Invalid chat request: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=400)
+    except Exception as e:
+        logging.error(f"Error in chat: {str(e)}", exc_info=True)
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def index_post(request):
+    start = time.perf_counter()
+    metrics.start_request()
+    return finish_request('index', request, await handle_index_post(request), start)
+
+
+async def chat_post(request):
+    start = time.perf_counter()
+    metrics.start_request()
+    return finish_request('chat', request, await handle_chat_post(request), start)
+
+
+@asynccontextmanager
+async def lifespan(_app):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = ASGI_THREADPOOL_SIZE
+    await run_in_threadpool(start_ingestion_workers)
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route('/', index_post, methods=['POST']),
+        Route('/chat', chat_post, methods=['POST']),
+        # GET auf "/" und "/chat" sowie alle anderen Routen bedient weiterhin Flask
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
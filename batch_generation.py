@@ -0,0 +1,110 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+from typing import List, Optional
+
+# Hilfsfunktionen für /batch_generate: Einlesen der Fragen eines Fragebogens (CSV, JSONL oder Liste),
+# gleichmäßige Verteilung der Generierungen über die Zeit und Export der Ergebnisse als CSV.
+
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "200"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+# Höchstens so viele Generierungen startet ein Batch pro Minute (0 = unbegrenzt)
+BATCH_REQUESTS_PER_MINUTE = int(os.getenv("BATCH_REQUESTS_PER_MINUTE", "60"))
+
+# Spaltennamen bzw. JSON-Felder, unter denen die Frage erwartet wird
+PROMPT_FIELDS = ("prompt", "question", "frage")
+CSV_FIELDS = ["index", "prompt", "generated_text", "citations", "selected_service", "cached", "error"]
+
+
+def _prompt_from_record(record) -> Optional[str]:
+    if isinstance(record, str):
+        return record
+    if isinstance(record, dict):
+        for name, value in record.items():
+            if str(name).strip().lower() in PROMPT_FIELDS and value:
+                return str(value)
+    return None
+
+
+def _parse_csv(text: str) -> List[str]:
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    rows = list(csv.reader(io.StringIO(text), dialect))
+    if not rows:
+        return []
+    header = [column.strip().lower() for column in rows[0]]
+    column = next((header.index(name) for name in PROMPT_FIELDS if name in header), None)
+    if column is None:
+        # Ohne bekannte Kopfzeile gilt jede Zeile als eine Frage
+        return text.splitlines()
+    return [row[column] for row in rows[1:] if len(row) > column]
+
+
+def _parse_jsonl(text: str) -> List[str]:
+    prompts = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            prompt = _prompt_from_record(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON in line {line_number}: {e}")
+        if prompt is None:
+            raise ValueError(f"No prompt found in line {line_number}")
+        prompts.append(prompt)
+    return prompts
+
+
+def parse_prompt_file(filename: str, content: bytes) -> List[str]:
+    text = content.decode("utf-8-sig")
+    extension = os.path.splitext(filename.lower())[1]
+    if extension == ".csv":
+        prompts = _parse_csv(text)
+    elif extension in (".jsonl", ".ndjson"):
+        prompts = _parse_jsonl(text)
+    else:
+        raise ValueError("Unsupported file type, expected .csv or .jsonl")
+    return [prompt.strip() for prompt in prompts if prompt and prompt.strip()]
+
+
+def parse_prompt_list(value) -> List[str]:
+    # JSON-Liste (Strings oder Objekte mit "prompt") oder Text mit einer Frage pro Zeile
+    if isinstance(value, str):
+        value = value.splitlines()
+    prompts = [_prompt_from_record(record) for record in value or []]
+    return [prompt.strip() for prompt in prompts if prompt and prompt.strip()]
+
+
+class RateLimiter:
+    # Verteilt Starts gleichmäßig, sodass höchstens per_minute pro Minute beginnen
+
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def results_to_csv(results: List[dict]) -> str:
+    # Semikolon und BOM, damit Excel mit deutschen Ländereinstellungen Umlaute und Spalten richtig erkennt
+    output = io.StringIO()
+    output.write("\ufeff")
+    writer = csv.DictWriter(output, fieldnames=CSV_FIELDS, delimiter=";", extrasaction="ignore")
+    writer.writeheader()
+    for result in results:
+        writer.writerow(dict(result, citations="; ".join(result.get("citations") or [])))
+    return output.getvalue()
@@ -0,0 +1,216 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Lokale Stand-ins für Azure OpenAI und Ollama mit einstellbarer Latenz und Token-Rate,
+# damit sich die App ohne Azure-Kontingent unter Last messen lässt.
+
+EMBEDDING_DIMENSIONS = 1536
+WORDS = ("Die Anforderungen der Ausschreibung werden durch unser Leistungsangebot vollständig erfüllt "
+         "und durch zertifizierte Prozesse im Rechenzentrum sowie ein erfahrenes Projektteam abgesichert").split()
+
+
+class FakeSettings:
+    def __init__(self, latency_ms=200.0, tokens_per_second=50.0, completion_tokens=150, embedding_latency_ms=50.0):
+        self.latency_ms = latency_ms
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.embedding_latency_ms = embedding_latency_ms
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+
+def fake_embedding(text):
+    # Deterministischer, normierter Vektor, damit gleiche Texte gleiche Embeddings liefern
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(EMBEDDING_DIMENSIONS)]
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector]
+
+
+def completion_tokens(settings):
+    return [WORDS[i % len(WORDS)] + " " for i in range(settings.completion_tokens)]
+
+
+def prompt_token_estimate(messages):
+    return sum(len(str(message.get("content", "")).split()) for message in messages)
+
+
+class BaseHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def generation_delay(self):
+        time.sleep(self.settings.latency_ms / 1000)
+
+    def token_delay(self):
+        if self.settings.tokens_per_second > 0:
+            time.sleep(1 / self.settings.tokens_per_second)
+
+
+class FakeAzureOpenAIHandler(BaseHandler):
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self.read_json()
+        if path.endswith("/embeddings"):
+            self.handle_embeddings(payload)
+        elif path.endswith("/chat/completions"):
+            self.handle_chat(payload)
+        else:
+            self.send_json({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+    def handle_embeddings(self, payload):
+        self.settings.count("embeddings")
+        inputs = payload["input"] if isinstance(payload["input"], list) else [payload["input"]]
+        time.sleep(self.settings.embedding_latency_ms / 1000)
+        self.send_json({
+            "object": "list",
+            "model": payload.get("model", "fake-embedding"),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(str(text))}
+                     for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": sum(len(str(text).split()) for text in inputs),
+                      "total_tokens": sum(len(str(text).split()) for text in inputs)}
+        })
+
+    def handle_chat(self, payload):
+        self.settings.count("chat")
+        tokens = completion_tokens(self.settings)
+        usage = {"prompt_tokens": prompt_token_estimate(payload.get("messages", [])),
+                 "completion_tokens": len(tokens)}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": payload.get("model", "fake")}
+        self.generation_delay()
+
+        if not payload.get("stream"):
+            for _ in tokens:
+                self.token_delay()
+            self.send_json(dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(tokens)}
+            }]))
+            return
+
+        self.start_stream("text/event-stream")
+        for token in tokens:
+            self.token_delay()
+            chunk = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "finish_reason": None, "delta": {"content": token}
+            }])
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        final = dict(base, object="chat.completion.chunk", usage=usage,
+                     choices=[{"index": 0, "finish_reason": "stop", "delta": {}}])
+        self.write_chunk(f"data: {json.dumps(final)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.end_stream()
+
+
+class FakeOllamaHandler(BaseHandler):
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self.read_json()
+        if path == "/api/chat":
+            self.handle_chat(payload)
+        elif path in ("/api/embeddings", "/api/embed"):
+            self.settings.count("embeddings")
+            time.sleep(self.settings.embedding_latency_ms / 1000)
+            self.send_json({"embedding": fake_embedding(str(payload.get("prompt", payload.get("input", ""))))})
+        else:
+            self.send_json({"error": f"Unknown path {path}"}, status=404)
+
+    def handle_chat(self, payload):
+        self.settings.count("chat")
+        tokens = completion_tokens(self.settings)
+        model = payload.get("model", "fake")
+        prompt_tokens = prompt_token_estimate(payload.get("messages", []))
+        self.generation_delay()
+
+        if not payload.get("stream", True):
+            for _ in tokens:
+                self.token_delay()
+            self.send_json({"model": model, "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                            "message": {"role": "assistant", "content": "".join(tokens)}, "done": True,
+                            "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)})
+            return
+
+        self.start_stream("application/x-ndjson")
+        for token in tokens:
+            self.token_delay()
+            line = {"model": model, "message": {"role": "assistant", "content": token}, "done": False}
+            self.write_chunk((json.dumps(line) + "\n").encode())
+        final = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                 "prompt_eval_count": prompt_tokens, "eval_count": len(tokens)}
+        self.write_chunk((json.dumps(final) + "\n").encode())
+        self.end_stream()
+
+
+def start_server(handler_class, settings, port=0):
+    handler = type(handler_class.__name__, (handler_class,), {"settings": settings})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start fake Azure OpenAI and Ollama servers")
+    parser.add_argument("--azure-port", type=int, default=8901)
+    parser.add_argument("--ollama-port", type=int, default=8902)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    settings = FakeSettings(args.latency_ms, args.tokens_per_second, args.completion_tokens, args.embedding_latency_ms)
+    start_server(FakeAzureOpenAIHandler, settings, args.azure_port)
+    start_server(FakeOllamaHandler, settings, args.ollama_port)
+    print(f"Fake Azure OpenAI: http://127.0.0.1:{args.azure_port}")
+    print(f"Fake Ollama:       http://127.0.0.1:{args.ollama_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
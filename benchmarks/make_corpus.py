@@ -0,0 +1,67 @@
+import argparse
+import os
+import random
+
+import fitz  # PyMuPDF
+
+# Erzeugt synthetische Ausschreibungs-PDFs für Lasttests der Indexierung und Suche
+
+VOCABULARY = """Leistungsbeschreibung Anforderung Rechenzentrum Verfügbarkeit Sicherheitskonzept Datenschutz
+Betriebshandbuch Servicelevel Eskalation Ansprechpartner Projektplan Meilenstein Abnahme Migration
+Schnittstelle Authentifizierung Verschlüsselung Backup Wiederherstellung Notfallplan Zertifizierung
+ISO Audit Protokollierung Monitoring Kapazität Skalierung Lizenz Wartung Support Reaktionszeit Störung
+Änderungsmanagement Qualitätssicherung Schulung Dokumentation Vertrag Vergabe Angebot Preisblatt Bieter
+Auftraggeber Auftragnehmer Leistungszeitraum Vertragsstrafe Gewährleistung Haftung Subunternehmer""".split()
+FILLER = "der die das und mit für im auf zur bei gemäß sowie durch innerhalb werden wird ist sind".split()
+
+
+def make_sentence(rng):
+    words = []
+    for _ in range(rng.randint(8, 18)):
+        words.append(rng.choice(VOCABULARY) if rng.random() < 0.45 else rng.choice(FILLER))
+    if rng.random() < 0.1:
+        words.append(f"VG-{rng.randint(2020, 2025)}/{rng.randint(100, 999)}")
+    return " ".join(words).capitalize() + "."
+
+
+def make_page_text(rng, page_number, sentences_per_page):
+    heading = f"{page_number}. {rng.choice(VOCABULARY)}"
+    return heading + "\n\n" + " ".join(make_sentence(rng) for _ in range(sentences_per_page))
+
+
+def write_pdf(path, pages, sentences_per_page=30, seed=0):
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_number in range(1, pages + 1):
+        page = doc.new_page()
+        text = make_page_text(rng, page_number, sentences_per_page)
+        page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=9)
+    doc.save(path)
+    doc.close()
+
+
+def generate_corpus(output_dir, files=5, pages=20, sentences_per_page=30, seed=42):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for index in range(files):
+        path = os.path.join(output_dir, f"ausschreibung_{index + 1:03d}.pdf")
+        if not os.path.exists(path):
+            write_pdf(path, pages, sentences_per_page, seed + index)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic PDF corpus")
+    parser.add_argument("output_dir")
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--sentences-per-page", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    paths = generate_corpus(args.output_dir, args.files, args.pages, args.sentences_per_page, args.seed)
+    print(f"{len(paths)} PDFs in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
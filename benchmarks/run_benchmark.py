@@ -0,0 +1,304 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_servers import FakeAzureOpenAIHandler, FakeOllamaHandler, FakeSettings, start_server
+from make_corpus import generate_corpus
+
+# Lasttest der App gegen lokale Stand-ins für Azure OpenAI und Ollama.
+# Misst Latenzen (p50/p95/p99) und Durchsatz je Endpunkt sowie den Indexierungsdurchsatz.
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+COLLECTION_NAME = "benchmark"
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+QUERIES = [
+    "Welche Anforderungen gelten für die Verfügbarkeit des Rechenzentrums?",
+    "Beschreiben Sie das Sicherheitskonzept und die Verschlüsselung.",
+    "Wie ist die Eskalation bei einer Störung geregelt?",
+    "Welche Zertifizierung nach ISO wird gefordert?",
+    "Was gilt für Backup und Wiederherstellung?",
+    "Welche Reaktionszeit ist im Servicelevel vereinbart?",
+    "VG-2023/512",
+    "Wie erfolgt die Abnahme der Migration?",
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-Rank-Methode
+    index = min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def prepare_workdir(workdir):
+    # Code, Templates und Konfiguration werden verlinkt; Datenbanken, Uploads und Chroma-Daten
+    # entstehen im Arbeitsverzeichnis und lassen die echten Daten unberührt
+    os.makedirs(workdir, exist_ok=True)
+    for name in os.listdir(REPO_ROOT):
+        if name.endswith(".py") or name.startswith("labels_") or name in ("templates", "static", "config"):
+            target = os.path.join(workdir, name)
+            if not os.path.lexists(target):
+                os.symlink(os.path.join(REPO_ROOT, name), target)
+
+
+def start_app(workdir, port, azure_url, ollama_url, log_file, asgi=False):
+    env = dict(os.environ,
+               SECRET_KEY="benchmark",
+               ADMIN_USERNAME=USERNAME,
+               ADMIN_PASSWORD=PASSWORD,
+               AZURE_OPENAI_KEY="benchmark",
+               AZURE_ENDPOINT=azure_url,
+               AZURE_API_VERSION="2024-02-01",
+               AZURE_MODEL="fake-chat",
+               AZURE_EMBEDDING_MODEL="fake-embedding",
+               OLLAMA_HOST=ollama_url,
+               LABEL_OWNER=os.getenv("LABEL_OWNER", "arvato"))
+    command = [sys.executable, os.path.join(BENCHMARK_DIR, "serve_app.py"), "--port", str(port)]
+    if asgi:
+        command.append("--asgi")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 120
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App exited with code {process.returncode}, see {log_file.name}")
+        try:
+            requests.get(f"{base_url}/login", timeout=1)
+            return process, base_url
+        except requests.ConnectionError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("App did not start within 120 seconds")
+
+
+def login(base_url):
+    session = requests.Session()
+    response = session.post(f"{base_url}/login", data={"username": USERNAME, "password": PASSWORD},
+                            allow_redirects=False)
+    if response.status_code != 302:
+        raise RuntimeError(f"Login failed with status {response.status_code}")
+    return session
+
+
+def run_ingestion(session, base_url, pdf_paths):
+    start = time.perf_counter()
+    files = [("pdfs", (os.path.basename(path), open(path, "rb"), "application/pdf")) for path in pdf_paths]
+    try:
+        response = session.post(f"{base_url}/create_collection", data={"title": COLLECTION_NAME}, files=files)
+    finally:
+        for _, (_, handle, _) in files:
+            handle.close()
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        job = session.get(f"{base_url}/ingestion_jobs/{job_id}").json()
+        if job["status"] in ("done", "failed"):
+            break
+        time.sleep(0.5)
+    elapsed = time.perf_counter() - start
+    chunks = sum(f["chunks_total"] or 0 for f in job["files"])
+    pages = sum(f["total_pages"] or 0 for f in job["files"])
+    return {
+        "status": job["status"],
+        "files": len(job["files"]),
+        "failed_files": sum(1 for f in job["files"] if f["status"] == "failed"),
+        "pages": pages,
+        "chunks": chunks,
+        "seconds": elapsed,
+        "chunks_per_second": chunks / elapsed if elapsed else None,
+        "pages_per_second": pages / elapsed if elapsed else None,
+    }
+
+
+def read_stream(response):
+    # Liefert die Zeit bis zum ersten Token-Event eines SSE-Streams
+    first_token = None
+    for line in response.iter_lines():
+        if first_token is None and line.startswith(b"event: token"):
+            first_token = time.perf_counter()
+        if line.startswith(b"event: error"):
+            raise RuntimeError("stream reported an error")
+    return first_token
+
+
+def make_scenarios(service):
+    def list_collections(session, base_url, i):
+        return session.get(f"{base_url}/list_collections")
+
+    def index(session, base_url, i):
+        return session.post(f"{base_url}/", data={"prompt": QUERIES[i % len(QUERIES)],
+                                                  "collection_name": COLLECTION_NAME, "service": service})
+
+    def index_stream(session, base_url, i):
+        return session.post(f"{base_url}/", stream=True, data={"prompt": QUERIES[i % len(QUERIES)],
+                                                               "collection_name": COLLECTION_NAME,
+                                                               "service": service, "stream": "true"})
+
+    def chat(session, base_url, i):
+        return session.post(f"{base_url}/chat", json={"message": QUERIES[i % len(QUERIES)],
+                                                      "collection_name": COLLECTION_NAME})
+
+    def chat_stream(session, base_url, i):
+        return session.post(f"{base_url}/chat", stream=True, json={"message": QUERIES[i % len(QUERIES)],
+                                                                   "collection_name": COLLECTION_NAME,
+                                                                   "stream": True})
+
+    return {
+        "list_collections": list_collections,
+        "index": index,
+        "index_stream": index_stream,
+        "chat": chat,
+        "chat_stream": chat_stream,
+    }
+
+
+def run_scenario(cookies, base_url, request_fn, requests_total, concurrency):
+    latencies, first_tokens, errors = [], [], []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def worker(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+            session.cookies.update(cookies)
+        start = time.perf_counter()
+        try:
+            response = request_fn(session, base_url, i)
+            first_token = read_stream(response) if response.headers.get("Content-Type", "").startswith(
+                "text/event-stream") else None
+            if response.status_code >= 400:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+            end = time.perf_counter()
+            with lock:
+                latencies.append(end - start)
+                if first_token is not None:
+                    first_tokens.append(first_token - start)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(requests_total)))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "requests": requests_total,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "requests_per_second": len(latencies) / elapsed if elapsed else None,
+    }
+    for p in (50, 95, 99):
+        value = percentile(latencies, p)
+        result[f"p{p}_ms"] = value * 1000 if value is not None else None
+    if first_tokens:
+        result["ttft_p50_ms"] = percentile(first_tokens, 50) * 1000
+        result["ttft_p95_ms"] = percentile(first_tokens, 95) * 1000
+    if errors:
+        result["first_error"] = errors[0]
+    return result
+
+
+def format_ms(value):
+    return f"{value:9.1f}" if value is not None else "        -"
+
+
+def print_report(ingestion, results):
+    if ingestion:
+        print(f"\nIngestion: {ingestion['files']} files, {ingestion['pages']} pages, {ingestion['chunks']} chunks "
+              f"in {ingestion['seconds']:.1f}s -> {ingestion['chunks_per_second']:.1f} chunks/s "
+              f"({ingestion['status']}, {ingestion['failed_files']} failed)")
+    print(f"\n{'scenario':<18}{'req':>6}{'conc':>6}{'err':>5}{'req/s':>9}"
+          f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttft p50':>10}")
+    for name, result in results.items():
+        print(f"{name:<18}{result['requests']:>6}{result['concurrency']:>6}{result['errors']:>5}"
+              f"{result['requests_per_second']:>9.1f}{format_ms(result['p50_ms'])} {format_ms(result['p95_ms'])}"
+              f"{format_ms(result['p99_ms'])} {format_ms(result.get('ttft_p50_ms'))}")
+        if result.get("first_error"):
+            print(f"  first error: {result['first_error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app against local Azure OpenAI and Ollama stand-ins")
+    parser.add_argument("--scenarios", default="list_collections,index,index_stream,chat,chat_stream",
+                        help="comma separated list of scenarios")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--service", default="azure", choices=["azure", "ollama"])
+    parser.add_argument("--files", type=int, default=5, help="PDFs in the synthetic corpus")
+    parser.add_argument("--pages", type=int, default=20, help="pages per PDF")
+    parser.add_argument("--corpus-dir", default=os.path.join(BENCHMARK_DIR, "corpus"))
+    parser.add_argument("--workdir", help="directory for databases and Chroma data (default: temporary)")
+    parser.add_argument("--latency-ms", type=float, default=200, help="LLM latency before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--asgi", action="store_true", help="serve the app through asgi.py with uvicorn")
+    parser.add_argument("--skip-ingestion", action="store_true",
+                        help="reuse the collection of an existing --workdir")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    settings = FakeSettings(args.latency_ms, args.tokens_per_second, args.completion_tokens, args.embedding_latency_ms)
+    azure_server = start_server(FakeAzureOpenAIHandler, settings)
+    ollama_server = start_server(FakeOllamaHandler, settings)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="benchmark_")
+    prepare_workdir(workdir)
+    pdf_paths = generate_corpus(args.corpus_dir, args.files, args.pages)
+
+    log_path = os.path.join(workdir, "app.log")
+    with open(log_path, "w") as log_file:
+        process, base_url = start_app(workdir, free_port(), f"http://127.0.0.1:{azure_server.server_port}",
+                                      f"http://127.0.0.1:{ollama_server.server_port}", log_file, args.asgi)
+        try:
+            session = login(base_url)
+            ingestion = None if args.skip_ingestion else run_ingestion(session, base_url, pdf_paths)
+            scenarios = make_scenarios(args.service)
+            results = {}
+            for name in args.scenarios.split(","):
+                name = name.strip()
+                if name not in scenarios:
+                    raise SystemExit(f"Unknown scenario {name}, available: {', '.join(scenarios)}")
+                results[name] = run_scenario(session.cookies, base_url, scenarios[name],
+                                             args.requests, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    print_report(ingestion, results)
+    print(f"\nFake backend requests: {settings.requests}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"ingestion": ingestion, "scenarios": results, "backend_requests": settings.requests,
+                       "settings": vars(args)}, f, indent=2)
+    if args.workdir:
+        print(f"App log: {log_path}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import argparse
+import os
+import sys
+
+# Startet die App für Benchmarks ohne Debug-Reloader. Arbeitsverzeichnis ist das vom
+# Benchmark vorbereitete Verzeichnis, damit Datenbanken und Chroma-Daten dort landen.
+sys.path.insert(0, os.getcwd())
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from app import app, db, init_db, User  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--asgi", action="store_true", help="serve asgi:app with uvicorn instead of the Flask server")
+    args = parser.parse_args()
+
+    with app.app_context():
+        init_db()
+        username = os.getenv("ADMIN_USERNAME")
+        if not User.query.filter_by(username=username).first():
+            db.session.add(User(username=username, password=generate_password_hash(os.getenv("ADMIN_PASSWORD"))))
+            db.session.commit()
+    if args.asgi:
+        import uvicorn
+        uvicorn.run("asgi:app", host="127.0.0.1", port=args.port, log_level="warning")
+    else:
+        app.run(host="127.0.0.1", port=args.port, threaded=True, debug=False, use_reloader=False)
+
+
+if __name__ == "__main__":
+    main()
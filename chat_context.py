@@ -0,0 +1,70 @@
+import os
+from typing import Iterator, List, Optional, Tuple
+
+from context_assembly import MESSAGE_OVERHEAD_TOKENS, count_tokens
+
+# Begrenztes Kontextfenster für den Chat: Die jüngsten Nachrichten gehen bis zu einem Token-Budget wörtlich
+# an das Modell, ältere Nachrichten werden schrittweise in eine gespeicherte Zusammenfassung eingearbeitet.
+
+CHAT_HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "3000"))
+CHAT_SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "500"))
+# Überlaufende Nachrichten werden in Portionen dieser Größe zusammengefasst
+CHAT_SUMMARY_INPUT_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_INPUT_MAX_TOKENS", "6000"))
+# Anzahl der Nachrichten, die pro Datenbankabfrage vom Ende der Historie geladen werden
+CHAT_HISTORY_PAGE_SIZE = 20
+
+
+def history_entry(message) -> dict:
+    return {
+        "id": message.id,
+        "role": message.role,
+        "content": message.content,
+        "tokens": count_tokens(message.content) + MESSAGE_OVERHEAD_TOKENS
+    }
+
+
+def split_history(history: List[dict], max_tokens: int = CHAT_HISTORY_MAX_TOKENS) -> Tuple[List[dict], List[dict]]:
+    # Teilt die Historie (chronologisch) in (zusammenzufassen, wörtlich behalten).
+    # Bei Überschreitung des Budgets wird auf die Hälfte gekürzt, damit die Zusammenfassung
+    # nicht bei jeder Nachricht, sondern nur etwa alle max_tokens / 2 Tokens aktualisiert wird.
+    if sum(entry["tokens"] for entry in history) <= max_tokens:
+        return [], history
+    target = max_tokens // 2
+    start = len(history)
+    kept_tokens = 0
+    while start > 0 and kept_tokens + history[start - 1]["tokens"] <= target:
+        start -= 1
+        kept_tokens += history[start]["tokens"]
+    # Die wörtliche Historie beginnt immer mit einer Benutzernachricht
+    while start < len(history) and history[start]["role"] != "user":
+        start += 1
+    return history[:start], history[start:]
+
+
+def summary_batches(entries: List[dict], max_tokens: int = CHAT_SUMMARY_INPUT_MAX_TOKENS) -> Iterator[List[dict]]:
+    batch, batch_tokens = [], 0
+    for entry in entries:
+        if batch and batch_tokens + entry["tokens"] > max_tokens:
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(entry)
+        batch_tokens += entry["tokens"]
+    if batch:
+        yield batch
+
+
+def build_summary_messages(previous_summary: Optional[str], entries: List[dict]) -> List[dict]:
+    transcript = "\n".join(f"{entry['role']}: {entry['content']}" for entry in entries)
+    previous = previous_summary or "(noch keine)"
+    return [
+        {"role": "system", "content": "You maintain a running summary of a conversation between a user and an "
+                                      "AI assistant. Keep facts, decisions, open questions and names; drop "
+                                      f"small talk. Answer in German with at most {CHAT_SUMMARY_MAX_TOKENS} tokens."},
+        {"role": "user", "content": f"Bisherige Zusammenfassung:\n{previous}\n\n"
+                                    f"Neue Nachrichten:\n{transcript}\n\n"
+                                    "Aktualisierte Zusammenfassung:"}
+    ]
+
+
+def summary_message(summary: str) -> dict:
+    return {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
@@ -0,0 +1,263 @@
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import List, Optional
+
+import numpy as np
+
+# Kompakter Vektorindex für kleine Collections: alle Embeddings als zusammenhängendes float32-Array
+# (memory-mapped .npy) plus Tabelle mit IDs, Texten und Metadaten. Die Suche ist exakt (Skalarprodukte
+# über alle Vektoren) und braucht beim Kaltstart keinen HNSW-Index aus Chroma. Der Snapshot wird nach
+# jeder Indexierung aus Chroma neu erstellt; bis dahin wird direkt in Chroma gesucht.
+#
+# Aufbau je Collection: COMPACT_INDEX_PATH/<collection>/<snapshot>/{vectors.npy, norms.npy, chunks.db, meta.json}
+# und die Datei "current" mit dem Namen des gültigen Snapshots.
+
+COMPACT_INDEX_ENABLED = os.getenv("COMPACT_INDEX_ENABLED", "false").lower() == "true"
+COMPACT_INDEX_PATH = os.getenv("COMPACT_INDEX_PATH", "compact_index")
+# Größere Collections werden weiter über den HNSW-Index von Chroma durchsucht
+COMPACT_INDEX_MAX_CHUNKS = int(os.getenv("COMPACT_INDEX_MAX_CHUNKS", "20000"))
+
+SNAPSHOT_PAGE_SIZE = 1000
+CURRENT_FILE = "current"
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+# Zähler je Collection, der bei jeder Invalidierung steigt; ein Snapshot, dessen Erstellung vor einer
+# Invalidierung begonnen hat, wird verworfen
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+class Snapshot:
+    # Bietet query() und get() mit denselben Parametern und Ergebnisformaten wie eine Chroma-Collection
+
+    def __init__(self, directory: str, snapshot_id: str):
+        self.snapshot_id = snapshot_id
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.space = meta.get("space", "l2")
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(directory, "norms.npy"))
+        self.count = len(self.norms)
+        self.chunks_path = os.path.join(directory, "chunks.db")
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.chunks_path}?mode=ro", uri=True)
+            self._local.conn = conn
+        return conn
+
+    def _distances(self, queries: np.ndarray) -> np.ndarray:
+        # Gleiche Distanzmaße wie Chroma (hnsw:space), damit Treffer und Distanzen vergleichbar bleiben
+        dots = queries @ self.vectors.T
+        if self.space == "cosine":
+            query_norms = np.linalg.norm(queries, axis=1)[:, None]
+            norms = np.sqrt(self.norms)[None, :] * query_norms
+            return 1.0 - dots / np.where(norms == 0, 1.0, norms)
+        if self.space == "ip":
+            return 1.0 - dots
+        return self.norms[None, :] - 2.0 * dots + np.einsum("ij,ij->i", queries, queries)[:, None]
+
+    def _records(self, where: str, values: list) -> dict:
+        records = {}
+        for start in range(0, len(values), 500):
+            batch = values[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            for row, chunk_id, document, metadata in self._connection().execute(
+                    f"SELECT row, chunk_id, document, metadata FROM chunks WHERE {where} IN ({placeholders})", batch):
+                records[row] = (chunk_id, document, json.loads(metadata) if metadata else None)
+        return records
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10, include: Optional[List[str]] = None):
+        include = include or ["documents", "metadatas", "distances"]
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        k = min(n_results, self.count)
+        if k == 0:
+            rows = [np.empty(0, dtype=np.int64) for _ in range(len(queries))]
+            distances = np.empty((len(queries), 0), dtype=np.float32)
+        else:
+            distances = self._distances(queries)
+            top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            rows = [candidates[np.argsort(distances[i, candidates], kind="stable")]
+                    for i, candidates in enumerate(top)]
+        records = self._records("row", sorted({int(row) for ranked in rows for row in ranked}))
+
+        results = {"ids": [[records[int(row)][0] for row in ranked] for ranked in rows]}
+        results["documents"] = ([[records[int(row)][1] for row in ranked] for ranked in rows]
+                                if "documents" in include else None)
+        results["metadatas"] = ([[records[int(row)][2] for row in ranked] for ranked in rows]
+                                if "metadatas" in include else None)
+        results["distances"] = ([distances[i, ranked].tolist() for i, ranked in enumerate(rows)]
+                                if "distances" in include else None)
+        results["embeddings"] = ([np.array(self.vectors[ranked]) for ranked in rows]
+                                 if "embeddings" in include else None)
+        return results
+
+    def get(self, ids: List[str], include: Optional[List[str]] = None):
+        include = include or ["documents", "metadatas"]
+        records = self._records("chunk_id", list(ids))
+        rows = sorted(records)
+        return {
+            "ids": [records[row][0] for row in rows],
+            "documents": [records[row][1] for row in rows] if "documents" in include else None,
+            "metadatas": [records[row][2] for row in rows] if "metadatas" in include else None,
+            "embeddings": np.array(self.vectors[rows]) if "embeddings" in include else None,
+        }
+
+
+def _collection_dir(collection_name: str) -> str:
+    return os.path.join(COMPACT_INDEX_PATH, re.sub(r'[^\w.-]+', '_', collection_name))
+
+
+def _current_snapshot_id(collection_name: str) -> Optional[str]:
+    try:
+        with open(os.path.join(_collection_dir(collection_name), CURRENT_FILE), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def has_snapshot(collection_name: str) -> bool:
+    return _current_snapshot_id(collection_name) is not None
+
+
+def get_snapshot(collection_name: str) -> Optional[Snapshot]:
+    # Liefert den aktuellen Snapshot oder None, wenn in Chroma gesucht werden soll. Die Datei "current"
+    # wird bei jedem Aufruf gelesen, damit andere Prozesse einen neuen Snapshot sofort verwenden.
+    if not COMPACT_INDEX_ENABLED:
+        return None
+    snapshot_id = _current_snapshot_id(collection_name)
+    if snapshot_id is None:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(collection_name)
+        if snapshot is None or snapshot.snapshot_id != snapshot_id:
+            try:
+                snapshot = Snapshot(os.path.join(_collection_dir(collection_name), snapshot_id), snapshot_id)
+            except (OSError, ValueError) as e:
+                # z.B. weil der Snapshot gerade durch einen neueren ersetzt wurde
+                logging.warning(f"Compact index for collection {collection_name} unavailable: {e}")
+                return None
+            _snapshots[collection_name] = snapshot
+    if snapshot.count > COMPACT_INDEX_MAX_CHUNKS:
+        return None
+    return snapshot
+
+
+def _generation(collection_name: str) -> int:
+    with _generations_lock:
+        return _generations.get(collection_name, 0)
+
+
+def drop_collection(collection_name: str):
+    # Entfernt den Snapshot, z.B. wenn sich die Chunks der Collection geändert haben
+    with _generations_lock:
+        _generations[collection_name] = _generations.get(collection_name, 0) + 1
+    with _snapshots_lock:
+        _snapshots.pop(collection_name, None)
+    snapshot_id = _current_snapshot_id(collection_name)
+    if snapshot_id is None:
+        return
+    directory = _collection_dir(collection_name)
+    try:
+        os.remove(os.path.join(directory, CURRENT_FILE))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(os.path.join(directory, snapshot_id), ignore_errors=True)
+
+
+def _write_snapshot(collection, directory: str, count: int) -> int:
+    conn = sqlite3.connect(os.path.join(directory, "chunks.db"))
+    try:
+        conn.execute("CREATE TABLE chunks (row INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, "
+                     "document TEXT, metadata TEXT)")
+        vectors = None
+        offset = 0
+        while offset < count:
+            page = collection.get(include=["embeddings", "documents", "metadatas"],
+                                  limit=SNAPSHOT_PAGE_SIZE, offset=offset)
+            if not page["ids"]:
+                break
+            if offset + len(page["ids"]) > count:
+                raise ValueError("Collection changed while creating the snapshot")
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(directory, "vectors.npy"), mode="w+",
+                                                    dtype=np.float32, shape=(count, embeddings.shape[1]))
+            vectors[offset:offset + len(embeddings)] = embeddings
+            conn.executemany("INSERT INTO chunks (row, chunk_id, document, metadata) VALUES (?, ?, ?, ?)", [
+                (offset + i, chunk_id, document, json.dumps(metadata, ensure_ascii=False) if metadata else None)
+                for i, (chunk_id, document, metadata) in enumerate(zip(page["ids"], page["documents"],
+                                                                        page["metadatas"]))
+            ])
+            offset += len(page["ids"])
+        if offset != count:
+            raise ValueError("Collection changed while creating the snapshot")
+        conn.commit()
+    finally:
+        conn.close()
+
+    if vectors is None:
+        vectors = np.zeros((0, 0), dtype=np.float32)
+        np.save(os.path.join(directory, "vectors.npy"), vectors)
+    else:
+        vectors.flush()
+    # Quadrierte Normen vorab berechnen, für die Suche bleibt dann ein Matrix-Vektor-Produkt
+    np.save(os.path.join(directory, "norms.npy"), np.einsum("ij,ij->i", vectors, vectors))
+    return len(vectors)
+
+
+def rebuild_from_chroma(collection) -> bool:
+    # Erstellt den Snapshot einer Chroma-Collection neu; False, wenn die Collection dafür zu groß ist
+    # oder sich während der Erstellung geändert hat
+    if not COMPACT_INDEX_ENABLED:
+        return False
+    generation = _generation(collection.name)
+    count = collection.count()
+    if count > COMPACT_INDEX_MAX_CHUNKS:
+        drop_collection(collection.name)
+        logging.info(f"Collection {collection.name} has {count} chunks, skipping compact index")
+        return False
+
+    collection_dir = _collection_dir(collection.name)
+    snapshot_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    directory = os.path.join(collection_dir, snapshot_id)
+    os.makedirs(directory)
+    start = time.perf_counter()
+    try:
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"collection": collection.name, "count": count,
+                       "space": (collection.metadata or {}).get("hnsw:space", "l2"), "created_at": time.time()}, f)
+        _write_snapshot(collection, directory, count)
+        previous_id = _current_snapshot_id(collection.name)
+        with _generations_lock:
+            if _generations.get(collection.name, 0) != generation:
+                raise ValueError("Collection changed while creating the snapshot")
+            # Umschalten per os.replace, damit Leser nie einen halb geschriebenen Verweis sehen
+            pointer = os.path.join(collection_dir, f"{CURRENT_FILE}.{snapshot_id}")
+            with open(pointer, "w", encoding="utf-8") as f:
+                f.write(snapshot_id)
+            os.replace(pointer, os.path.join(collection_dir, CURRENT_FILE))
+    except ValueError as e:
+        shutil.rmtree(directory, ignore_errors=True)
+        logging.warning(f"Compact index for collection {collection.name} not updated: {e}")
+        return False
+    except Exception:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    # Bereits geöffnete Memory-Maps des alten Snapshots bleiben bis zum Schließen gültig
+    if previous_id and previous_id != snapshot_id:
+        shutil.rmtree(os.path.join(collection_dir, previous_id), ignore_errors=True)
+    logging.info(f"Built compact index for collection {collection.name}: {count} chunks "
+                 f"in {time.perf_counter() - start:.1f}s")
+    return True
@@ -0,0 +1,66 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Prozessweiter Cache für Konfigurationsdateien (Labels, Optionen) und selten geänderte Datenbankinhalte
+# (System-Prompts). Dateien werden neu gelesen, sobald sich ihre Änderungszeit ändert.
+
+# Abstand in Sekunden, in dem die Änderungszeit einer Datei höchstens geprüft wird
+CONFIG_CHECK_INTERVAL = float(os.getenv("CONFIG_CHECK_INTERVAL", "1"))
+# Obergrenze für veraltete System-Prompts, wenn sie in einem anderen Prozess geändert wurden
+SYSTEM_PROMPT_CACHE_TTL = float(os.getenv("SYSTEM_PROMPT_CACHE_TTL", "60"))
+
+_files: Dict[str, Tuple[float, float, Any]] = {}  # Pfad -> (mtime, zuletzt geprüft, Inhalt)
+_files_lock = threading.Lock()
+
+
+def load_json_file(path: str) -> Any:
+    # Liefert den geparsten Inhalt; alle Aufrufer teilen sich dasselbe Objekt und dürfen es nicht verändern
+    now = time.monotonic()
+    with _files_lock:
+        cached = _files.get(path)
+        if cached and now - cached[1] < CONFIG_CHECK_INTERVAL:
+            return cached[2]
+    mtime = os.stat(path).st_mtime
+    with _files_lock:
+        cached = _files.get(path)
+        if cached and cached[0] == mtime:
+            _files[path] = (mtime, now, cached[2])
+            return cached[2]
+    with open(path, 'r', encoding='utf-8') as file:
+        content = json.load(file)
+    with _files_lock:
+        _files[path] = (mtime, now, content)
+    return content
+
+
+class CachedValue:
+    # Hält einen berechneten Wert bis zur Invalidierung oder bis zum Ablauf der TTL
+
+    def __init__(self, loader: Callable[[], Any], ttl_seconds: float):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self._value = None
+        self._loaded_at: Optional[float] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds:
+                return self._value
+            generation = self._generation
+        value = self.loader()
+        with self._lock:
+            # Wurde während des Ladens invalidiert, ist der geladene Wert möglicherweise schon veraltet
+            if generation == self._generation:
+                self._value = value
+                self._loaded_at = time.monotonic()
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded_at = None
@@ -0,0 +1,100 @@
+import os
+import re
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import tiktoken
+
+# Stellt den Kontext aus den gefundenen Chunks innerhalb eines Token-Budgets zusammen. Das Budget ergibt sich
+# aus dem Kontextfenster des Modells abzüglich Prompt ohne Kontext und reservierter Antwortlänge und ist
+# zusätzlich durch CONTEXT_MAX_TOKENS begrenzt. Der letzte passende Chunk wird an einer Satzgrenze gekürzt.
+
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "3000"))
+# Kontextfenster der Modelle in Tokens
+AZURE_CONTEXT_TOKENS = int(os.getenv("AZURE_CONTEXT_TOKENS", "16385"))
+OLLAMA_CONTEXT_TOKENS = int(os.getenv("OLLAMA_CONTEXT_TOKENS", "8192"))
+# Ein gekürzter Chunk wird nur übernommen, wenn mindestens so viele Tokens übrig sind
+MIN_PARTIAL_TOKENS = 50
+# Zuschläge pro Nachricht und für den Beginn der Antwort im Chat-Format
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_OVERHEAD_TOKENS = 3
+CONTEXT_SEPARATOR = "\n"
+
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?:;])\s+|\n+')
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: Optional[str] = None):
+    # Azure-Deployments tragen oft eigene Namen, dann wird die Kodierung der aktuellen GPT-Modelle verwendet.
+    # Ohne Modell (z.B. für die Chathistorie oder Ollama-Zählungen) ebenfalls cl100k_base.
+    if model is None:
+        return tiktoken.get_encoding("cl100k_base")
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: Optional[str], model: Optional[str] = None) -> int:
+    return len(get_encoding(model).encode(text or "", disallowed_special=()))
+
+
+def count_message_tokens(messages: List[dict], model: str) -> int:
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS
+               for message in messages) + REPLY_OVERHEAD_TOKENS
+
+
+def context_budget(base_messages: List[dict], model: str, model_context_tokens: int,
+                   completion_tokens: int) -> int:
+    # Tokens, die für den Kontext bleiben, wenn base_messages bereits ohne Kontext gezählt werden
+    available = model_context_tokens - count_message_tokens(base_messages, model) - completion_tokens
+    return max(0, min(CONTEXT_MAX_TOKENS, available))
+
+
+def truncate_to_sentences(text: str, max_tokens: int, model: str) -> str:
+    encoding = get_encoding(model)
+    parts = []
+    used = 0
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        tokens = len(encoding.encode(sentence + " ", disallowed_special=()))
+        if used + tokens > max_tokens:
+            break
+        parts.append(sentence)
+        used += tokens
+    return " ".join(parts)
+
+
+def assemble_context(hits: List[dict], budget: int, model: str) -> Tuple[str, List[dict], dict]:
+    # hits sind nach Relevanz sortiert; liefert (Kontext, verwendete Treffer, Bericht über die Budgetnutzung)
+    encoding = get_encoding(model)
+    separator_tokens = len(encoding.encode(CONTEXT_SEPARATOR))
+    parts, used_hits = [], []
+    used = 0
+    truncated = 0
+    for hit in hits:
+        remaining = budget - used - (separator_tokens if parts else 0)
+        tokens = len(encoding.encode(hit["document"], disallowed_special=()))
+        if tokens <= remaining:
+            parts.append(hit["document"])
+            used_hits.append(hit)
+            used += tokens + (separator_tokens if len(parts) > 1 else 0)
+            continue
+        if remaining >= MIN_PARTIAL_TOKENS:
+            partial = truncate_to_sentences(hit["document"], remaining, model)
+            if partial:
+                parts.append(partial)
+                used_hits.append(hit)
+                truncated += 1
+        break
+    context = CONTEXT_SEPARATOR.join(parts)
+    report = {
+        'context_tokens': len(encoding.encode(context, disallowed_special=())),
+        'context_budget': budget,
+        'chunks_used': len(used_hits),
+        'chunks_truncated': truncated,
+        'chunks_dropped': len(hits) - len(used_hits)
+    }
+    return context, used_hits, report
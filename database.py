@@ -0,0 +1,91 @@
+import logging
+import os
+import sqlite3
+
+from sqlalchemy import MetaData, event, func, inspect, select, text
+from sqlalchemy.engine import Engine
+
+# Datenbankanbindung der App: SQLite (Standard, mit WAL und Busy-Timeout für parallele Schreiber)
+# oder PostgreSQL mit Verbindungspool, gewählt über DATABASE_URL.
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///site.db")
+# Verbindungspool für Server-Datenbanken (PostgreSQL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# So lange wartet SQLite auf eine gesperrte Datenbank, bevor "database is locked" gemeldet wird
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "30000"))
+
+COPY_BATCH_SIZE = 1000
+
+
+def database_url() -> str:
+    # Manche Anbieter liefern noch das alte Schema postgres://, das SQLAlchemy nicht mehr kennt
+    if DATABASE_URL.startswith("postgres://"):
+        return "postgresql://" + DATABASE_URL[len("postgres://"):]
+    return DATABASE_URL
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        return {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        # Abgebrochene Verbindungen (z.B. nach Neustart der Datenbank) vor der Verwendung erkennen
+        "pool_pre_ping": True,
+    }
+
+
+@event.listens_for(Engine, "connect")
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL erlaubt Lesen während eines Schreibvorgangs; gilt für jede neue SQLite-Verbindung der App
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+def copy_tables(metadata: MetaData, source_engine: Engine, target_engine: Engine) -> dict:
+    # Kopiert alle Tabellen (in Abhängigkeitsreihenfolge) in eine leere Zieldatenbank.
+    # Spalten, die es in der Quelle noch nicht gibt (ältere Schemata wie init.sql), bleiben leer.
+    source_inspector = inspect(source_engine)
+    source_tables = set(source_inspector.get_table_names())
+    copied = {}
+    with source_engine.connect() as source, target_engine.begin() as target:
+        for table in metadata.sorted_tables:
+            if table.name not in source_tables:
+                continue
+            if target.execute(select(func.count()).select_from(table)).scalar():
+                raise ValueError(f"Target table {table.name} is not empty")
+            source_columns = {column["name"] for column in source_inspector.get_columns(table.name)}
+            columns = [column for column in table.columns if column.name in source_columns]
+            result = source.execute(select(*columns))
+            copied[table.name] = 0
+            while True:
+                rows = result.fetchmany(COPY_BATCH_SIZE)
+                if not rows:
+                    break
+                target.execute(table.insert(), [dict(row._mapping) for row in rows])
+                copied[table.name] += len(rows)
+            logging.info(f"Copied {copied[table.name]} rows of {table.name}")
+        reset_sequences(metadata, target)
+    return copied
+
+
+def reset_sequences(metadata: MetaData, connection):
+    # Nach dem Kopieren mit festen IDs müssen die Sequenzen von PostgreSQL hinter der höchsten ID weiterzählen
+    if connection.dialect.name != "postgresql":
+        return
+    for table in metadata.sorted_tables:
+        if "id" not in table.columns or not table.columns["id"].primary_key:
+            continue
+        quoted = connection.dialect.identifier_preparer.quote(table.name)
+        connection.execute(text(f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                                f"COALESCE((SELECT MAX(id) FROM {quoted}), 0) + 1, false)"), {"table": quoted})
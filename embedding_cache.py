@@ -0,0 +1,140 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import List, Optional
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024"))
+
+# Nach so vielen neuen Einträgen wird die Gesamtgröße geprüft
+EVICTION_CHECK_INTERVAL = 500
+# Bei Überschreitung wird bis auf diesen Anteil der Maximalgröße geräumt
+EVICTION_TARGET_RATIO = 0.9
+
+
+def cache_key(text: str, model: str) -> str:
+    return hashlib.sha256(f"{model}\0{text}".encode()).hexdigest()
+
+
+class EmbeddingCache:
+    # Persistenter Cache für Embeddings, adressiert über sha256(Modell + Text).
+    # Vektoren werden als float32 gespeichert, verdrängt wird nach letztem Zugriff (LRU).
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inserts_since_check = 0
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, texts: List[str], model: str) -> List[Optional[List[float]]]:
+        keys = [cache_key(text, model) for text in texts]
+        found = {}
+        conn = self._connection()
+        # SQLite begrenzt die Anzahl der Parameter pro Abfrage
+        unique_keys = list(dict.fromkeys(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk)
+            for key, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[key] = vector.tolist()
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany("UPDATE embeddings SET last_access = ? WHERE key = ?",
+                                 [(now, key) for key in found])
+        results = [found.get(key) for key in keys]
+        with self._lock:
+            hit_count = sum(1 for result in results if result is not None)
+            self.hits += hit_count
+            self.misses += len(results) - hit_count
+        return results
+
+    def get(self, text: str, model: str) -> Optional[List[float]]:
+        return self.get_many([text], model)[0]
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]], model: str):
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            blob = array("f", embedding).tobytes()
+            rows.append((cache_key(text, model), model, blob, len(blob), now))
+        conn = self._connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, model, vector, size, last_access) "
+                             "VALUES (?, ?, ?, ?, ?)", rows)
+        with self._lock:
+            self._inserts_since_check += len(rows)
+            check = self._inserts_since_check >= EVICTION_CHECK_INTERVAL
+            if check:
+                self._inserts_since_check = 0
+        if check:
+            self.evict()
+
+    def put(self, text: str, embedding: List[float], model: str):
+        self.put_many([text], [embedding], model)
+
+    def total_bytes(self) -> int:
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * EVICTION_TARGET_RATIO)
+        conn = self._connection()
+        to_delete, freed = [], 0
+        for key, size in conn.execute("SELECT key, size FROM embeddings ORDER BY last_access"):
+            if total - freed <= target:
+                break
+            to_delete.append((key,))
+            freed += size
+        with conn:
+            conn.executemany("DELETE FROM embeddings WHERE key = ?", to_delete)
+        logging.info(f"Embedding cache evicted {len(to_delete)} entries ({freed} bytes)")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "size_bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes
+        }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024) \
+    if EMBEDDING_CACHE_ENABLED else None
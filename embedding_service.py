@@ -0,0 +1,162 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+import local_embeddings
+import metrics
+from embedding_cache import embedding_cache
+from vector import AZURE_EMBEDDING_MODEL, create_embeddings
+
+# Embeddings für Suchanfragen: zuletzt verwendete Vektoren im Speicher (LRU), dann der persistente
+# Embedding-Cache, und erst danach ein API-Aufruf. Gleichzeitige Anfragen mehrerer Requests werden
+# wenige Millisekunden gesammelt und gemeinsam in einem Aufruf eingebettet (Micro-Batching).
+
+# So lange wartet der erste Request eines Batches auf weitere Anfragen (0 = kein Micro-Batching)
+EMBEDDING_MICROBATCH_WINDOW_MS = float(os.getenv("EMBEDDING_MICROBATCH_WINDOW_MS", "5"))
+# Ein voller Batch wird sofort abgeschickt
+EMBEDDING_MICROBATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_MICROBATCH_MAX_ITEMS", "16"))
+EMBEDDING_MEMORY_CACHE_SIZE = int(os.getenv("EMBEDDING_MEMORY_CACHE_SIZE", "2048"))
+# Anzahl der häufigsten bisherigen Prompts, die beim Start vorab eingebettet werden (0 = aus)
+EMBEDDING_PREWARM_COUNT = int(os.getenv("EMBEDDING_PREWARM_COUNT", "200"))
+
+
+class QueryEmbeddingService:
+    # Der Speicher-Cache ist prozesslokal und gilt für ein Embedding-Modell; embed_fn bettet eine Liste von
+    # Texten ein, persistent_cache ist der Embedding-Cache auf der Platte (None = ohne)
+
+    def __init__(self, model: str, embed_fn: Callable[[List[str]], List[List[float]]], window_ms: float,
+                 max_items: int, memory_size: int, persistent_cache=None):
+        self.model = model
+        self.embed_fn = embed_fn
+        self.persistent_cache = persistent_cache
+        self.window = window_ms / 1000
+        self.max_items = max_items
+        self.memory_size = memory_size
+        self.batches = 0
+        self.batched_texts = 0
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._memory_lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._batch_full = threading.Event()
+
+    def _remember(self, texts: List[str], embeddings: List[List[float]]):
+        if self.memory_size <= 0:
+            return
+        with self._memory_lock:
+            for text, embedding in zip(texts, embeddings):
+                self._memory[text] = embedding
+                self._memory.move_to_end(text)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def _recall(self, text: str) -> Optional[List[float]]:
+        with self._memory_lock:
+            embedding = self._memory.get(text)
+            if embedding is not None:
+                self._memory.move_to_end(text)
+            return embedding
+
+    def _flush(self, batch: Dict[str, Future]):
+        texts = list(batch)
+        try:
+            embeddings = self.embed_fn(texts)
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        self._remember(texts, embeddings)
+        for text, embedding in zip(texts, embeddings):
+            batch[text].set_result(embedding)
+        with self._pending_lock:
+            self.batches += 1
+            self.batched_texts += len(texts)
+
+    def _submit(self, texts: List[str]) -> List[Future]:
+        # Der Request, der einen neuen Batch beginnt, wartet das Zeitfenster ab und schickt dann alle
+        # bis dahin gesammelten Texte ab; die übrigen warten nur auf ihr Ergebnis
+        futures = []
+        leader = False
+        with self._pending_lock:
+            if not self._pending:
+                leader = True
+                self._batch_full.clear()
+            for text in texts:
+                future = self._pending.get(text)
+                if future is None:
+                    future = self._pending[text] = Future()
+                futures.append(future)
+            if len(self._pending) >= self.max_items:
+                self._batch_full.set()
+        if leader:
+            self._batch_full.wait(self.window)
+            with self._pending_lock:
+                batch, self._pending = self._pending, {}
+            self._flush(batch)
+        return futures
+
+    def embed(self, text: str) -> List[float]:
+        return self.embed_many([text])[0]
+
+    def _recall_persistent(self, texts: List[str]) -> Dict[str, List[float]]:
+        if not texts or not self.persistent_cache:
+            return {}
+        return {text: embedding for text, embedding in zip(texts, self.persistent_cache.get_many(texts, self.model))
+                if embedding is not None}
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        embeddings = {}
+        for text in texts:
+            embedding = self._recall(text)
+            if embedding is not None:
+                embeddings[text] = embedding
+        missing = [text for text in dict.fromkeys(texts) if text not in embeddings]
+        stored = self._recall_persistent(missing)
+        if stored:
+            self._remember(list(stored), list(stored.values()))
+            embeddings.update(stored)
+            missing = [text for text in missing if text not in stored]
+        # Ein Ergebnis je Anfrage, erst nach beiden Cache-Stufen; embed_fn fragt den Cache nicht erneut ab
+        metrics.record_cache("query_embedding", "miss" if missing else "persistent" if stored else "memory")
+
+        if len(missing) > self.max_items or (missing and self.window <= 0):
+            # Große Mengen (z.B. /batch_generate) bilden bereits eigene Batches
+            computed = self.embed_fn(missing)
+            self._remember(missing, computed)
+            embeddings.update(zip(missing, computed))
+        elif missing:
+            for text, future in zip(missing, self._submit(missing)):
+                embeddings[text] = future.result()
+        return [embeddings[text] for text in texts]
+
+    def prewarm(self, texts: List[str]):
+        # Füllt den Speicher-Cache; Texte aus dem persistenten Cache kosten keinen API-Aufruf
+        texts = [text for text in dict.fromkeys(texts) if text]
+        if not texts:
+            return
+        stored = self._recall_persistent(texts)
+        missing = [text for text in texts if text not in stored]
+        self._remember(list(stored) + missing, list(stored.values()) + (self.embed_fn(missing) if missing else []))
+        logging.info(f"Prewarmed {len(texts)} query embeddings")
+
+    def stats(self) -> dict:
+        with self._memory_lock:
+            entries = len(self._memory)
+        return {"entries": entries, "batches": self.batches, "batched_texts": self.batched_texts}
+
+
+query_embedder = QueryEmbeddingService(AZURE_EMBEDDING_MODEL,
+                                       lambda texts: create_embeddings(texts, check_cache=False),
+                                       EMBEDDING_MICROBATCH_WINDOW_MS, EMBEDDING_MICROBATCH_MAX_ITEMS,
+                                       EMBEDDING_MEMORY_CACHE_SIZE, embedding_cache)
+# Lokale Inferenz profitiert ebenso vom Bündeln; der Cache auf der Platte lohnt sich dafür nicht
+local_query_embedder = QueryEmbeddingService(local_embeddings.LOCAL_EMBEDDING_MODEL_NAME,
+                                             local_embeddings.create_query_embeddings, EMBEDDING_MICROBATCH_WINDOW_MS,
+                                             EMBEDDING_MICROBATCH_MAX_ITEMS, EMBEDDING_MEMORY_CACHE_SIZE)
+
+
+def query_embedder_for(backend: str) -> QueryEmbeddingService:
+    return local_query_embedder if backend == "local" else query_embedder
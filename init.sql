@@ -1,3 +1,7 @@
+-- Ausgangsschema für SQLite. Fehlende Tabellen, Spalten und Indizes ergänzt init_db() beim Start der App;
+-- für den Umzug nach PostgreSQL siehe "flask --app app copy-database" in der README.
+PRAGMA journal_mode=WAL;
+
 -- Erstelle die Tabelle für Benutzer
 CREATE TABLE IF NOT EXISTS user (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -8,8 +12,9 @@ CREATE TABLE IF NOT EXISTS user (
 -- Erstelle die Tabelle für Kollektionen
 CREATE TABLE IF NOT EXISTS collection (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name VARCHAR(100) NOT NULL,
-    description TEXT
+    name VARCHAR(100) NOT NULL UNIQUE,
+    description TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Erstelle die Tabelle für Dateien
@@ -17,8 +22,13 @@ CREATE TABLE IF NOT EXISTS file (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     filename VARCHAR(100) NOT NULL,
     collection_id INTEGER NOT NULL,
+    hash VARCHAR(64),
+    chunk_count INTEGER DEFAULT 0,
+    page_count INTEGER DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (collection_id) REFERENCES collection(id) ON DELETE CASCADE
 );
+CREATE INDEX IF NOT EXISTS ix_file_collection_id ON file (collection_id);
 
 -- Erstelle die Tabelle für System-Prompts
 CREATE TABLE IF NOT EXISTS system_prompt (
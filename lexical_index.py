@@ -0,0 +1,216 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import List, Tuple
+
+# Lokaler Volltextindex (SQLite FTS5 mit BM25-Ranking) über dieselben Chunks wie in Chroma.
+# Pro Collection gibt es eine FTS5-Tabelle und eine Zuordnungstabelle chunk_id -> rowid.
+
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "lexical_index.db")
+# Präfixsuche ab dieser Wortlänge, damit z.B. "Sicherheit" auch "Sicherheitskonzept" findet
+PREFIX_MIN_LENGTH = 5
+MAX_QUERY_TERMS = 32
+# Begriffe, die in mehr als diesem Anteil der Chunks vorkommen, tragen kaum zum BM25-Score bei
+# und werden aus der Suche entfernt, weil sie die Abfrage stark verlangsamen
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", "0.25"))
+
+STOPWORDS = {
+    "der", "die", "das", "und", "oder", "ein", "eine", "einer", "eines", "einem", "einen", "ist", "sind",
+    "im", "in", "zu", "zum", "zur", "mit", "von", "für", "auf", "den", "dem", "des", "wie", "was", "wir",
+    "sie", "es", "ich", "du", "nicht", "auch", "an", "bei", "als", "aus", "nach", "the", "and", "or",
+    "of", "to", "a", "an", "is", "are", "for", "on", "with", "what", "how"
+}
+
+_local = threading.local()
+# Dokumenthäufigkeiten je Collection, gültig solange sich die Version der Collection nicht ändert
+_df_cache = {}
+_df_cache_lock = threading.Lock()
+
+
+def _connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(LEXICAL_INDEX_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+    return conn
+
+
+def _table_names(collection_name: str) -> Tuple[str, str]:
+    safe_name = re.sub(r'\W+', '_', collection_name)
+    return f'"fts_{safe_name}"', f'"fts_{safe_name}_ids"'
+
+
+def _vocab_table(collection_name: str) -> str:
+    safe_name = re.sub(r'\W+', '_', collection_name)
+    return f'"fts_{safe_name}_vocab"'
+
+
+def _ensure_tables(conn: sqlite3.Connection, collection_name: str):
+    fts_table, ids_table = _table_names(collection_name)
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} "
+                 f"USING fts5(text, tokenize='unicode61 remove_diacritics 0')")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {ids_table} (chunk_id TEXT PRIMARY KEY, fts_rowid INTEGER NOT NULL UNIQUE)")
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {_vocab_table(collection_name)} "
+                 f"USING fts5vocab({fts_table}, 'row')")
+    conn.execute("CREATE TABLE IF NOT EXISTS index_versions (collection TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+
+def _bump_version(conn: sqlite3.Connection, collection_name: str):
+    conn.execute("INSERT INTO index_versions (collection, version) VALUES (?, 1) "
+                 "ON CONFLICT(collection) DO UPDATE SET version = version + 1", (collection_name,))
+
+
+def has_index(collection_name: str) -> bool:
+    _, ids_table = _table_names(collection_name)
+    row = _connection().execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                (ids_table.strip('"'),)).fetchone()
+    return row is not None
+
+
+def _delete(conn: sqlite3.Connection, collection_name: str, chunk_ids: List[str]):
+    fts_table, ids_table = _table_names(collection_name)
+    for start in range(0, len(chunk_ids), 500):
+        batch = chunk_ids[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        rowids = [row[0] for row in conn.execute(
+            f"SELECT fts_rowid FROM {ids_table} WHERE chunk_id IN ({placeholders})", batch)]
+        conn.executemany(f"DELETE FROM {fts_table} WHERE rowid = ?", [(rowid,) for rowid in rowids])
+        conn.execute(f"DELETE FROM {ids_table} WHERE chunk_id IN ({placeholders})", batch)
+
+
+def add_chunks(collection_name: str, chunk_ids: List[str], texts: List[str]):
+    if not chunk_ids:
+        return
+    conn = _connection()
+    fts_table, ids_table = _table_names(collection_name)
+    with conn:
+        _ensure_tables(conn, collection_name)
+        _delete(conn, collection_name, chunk_ids)
+        for chunk_id, chunk_text in zip(chunk_ids, texts):
+            rowid = conn.execute(f"INSERT INTO {fts_table} (text) VALUES (?)", (chunk_text,)).lastrowid
+            conn.execute(f"INSERT INTO {ids_table} (chunk_id, fts_rowid) VALUES (?, ?)", (chunk_id, rowid))
+        _bump_version(conn, collection_name)
+
+
+def delete_chunks(collection_name: str, chunk_ids: List[str]):
+    if not chunk_ids or not has_index(collection_name):
+        return
+    conn = _connection()
+    with conn:
+        _delete(conn, collection_name, chunk_ids)
+        _bump_version(conn, collection_name)
+
+
+def drop_collection(collection_name: str):
+    conn = _connection()
+    fts_table, ids_table = _table_names(collection_name)
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {_vocab_table(collection_name)}")
+        conn.execute(f"DROP TABLE IF EXISTS {fts_table}")
+        conn.execute(f"DROP TABLE IF EXISTS {ids_table}")
+        conn.execute("CREATE TABLE IF NOT EXISTS index_versions (collection TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        _bump_version(conn, collection_name)
+
+
+def parse_query(query: str) -> List[Tuple[str, bool]]:
+    # Zerlegt die Anfrage in FTS5-Ausdrücke; das Flag kennzeichnet einzelne Wörter (im Gegensatz zu Phrasen).
+    # Wörter mit Bindestrich, Schrägstrich o.ä. (z.B. Vergabenummern) werden als Phrase gesucht.
+    terms = {}
+    for word in query.split():
+        parts = re.findall(r'\w+', word.lower())
+        if not parts:
+            continue
+        if len(parts) > 1:
+            terms['"' + " ".join(parts) + '"'] = False
+            continue
+        part = parts[0]
+        if part in STOPWORDS or len(part) < 2:
+            continue
+        terms[f'"{part}"*' if len(part) >= PREFIX_MIN_LENGTH else f'"{part}"'] = True
+    return list(terms.items())[:MAX_QUERY_TERMS]
+
+
+def build_match_query(query: str) -> str:
+    return " OR ".join(term for term, _ in parse_query(query))
+
+
+def _document_frequencies(conn: sqlite3.Connection, collection_name: str, terms: List[str]) -> dict:
+    version_row = conn.execute("SELECT version FROM index_versions WHERE collection = ?", (collection_name,)).fetchone()
+    version = version_row[0] if version_row else 0
+    with _df_cache_lock:
+        cached_version, cache = _df_cache.get(collection_name, (None, None))
+        if cached_version != version:
+            _, ids_table = _table_names(collection_name)
+            cache = {"": conn.execute(f"SELECT COUNT(*) FROM {ids_table}").fetchone()[0]}
+            _df_cache[collection_name] = (version, cache)
+        missing = [term for term in terms if term not in cache]
+    vocab_table = _vocab_table(collection_name)
+    frequencies = {}
+    for term in missing:
+        word = term.strip('"*')
+        if term.endswith("*"):
+            # Obergrenze für Präfixe: Summe über alle Wörter mit diesem Präfix
+            row = conn.execute(f"SELECT COALESCE(SUM(doc), 0) FROM {vocab_table} WHERE term >= ? AND term < ?",
+                               (word, word + "\uffff")).fetchone()
+        else:
+            row = conn.execute(f"SELECT COALESCE(SUM(doc), 0) FROM {vocab_table} WHERE term = ?", (word,)).fetchone()
+        frequencies[term] = row[0]
+    # Der Cache wird von allen Threads geteilt und nur unter der Sperre verändert
+    with _df_cache_lock:
+        cache.update(frequencies)
+        return {term: cache[term] for term in ["", *terms]}
+
+
+def _prune_common_terms(conn: sqlite3.Connection, collection_name: str, terms: List[Tuple[str, bool]]) -> List[str]:
+    words = [term for term, is_word in terms if is_word]
+    phrases = [term for term, is_word in terms if not is_word]
+    if not words:
+        return phrases
+    frequencies = _document_frequencies(conn, collection_name, words)
+    limit = max(1, frequencies[""] * LEXICAL_MAX_DF_RATIO)
+    # Bleibt nichts übrig, liefert die Volltextsuche keinen Mehrwert gegenüber der Vektorsuche
+    return phrases + [term for term in words if frequencies[term] <= limit]
+
+
+def search(collection_name: str, query: str, n_results: int = 20) -> List[Tuple[str, float]]:
+    # Liefert (chunk_id, bm25-Score) absteigend nach Relevanz; ohne Index eine leere Liste
+    terms = parse_query(query)
+    if not terms or not has_index(collection_name):
+        return []
+    fts_table, ids_table = _table_names(collection_name)
+    conn = _connection()
+    match_query = ""
+    try:
+        match_query = " OR ".join(_prune_common_terms(conn, collection_name, terms))
+        if not match_query:
+            return []
+        # Erst im FTS-Index ranken, dann die wenigen Treffer auf Chunk-IDs abbilden
+        rows = conn.execute(f"SELECT rowid, rank FROM {fts_table} WHERE {fts_table} MATCH ? ORDER BY rank LIMIT ?",
+                            (match_query, n_results)).fetchall()
+    except sqlite3.OperationalError as e:
+        logging.warning(f"Lexical search failed for query {match_query or query!r}: {e}")
+        return []
+    if not rows:
+        return []
+    placeholders = ",".join("?" * len(rows))
+    chunk_ids = dict(conn.execute(f"SELECT fts_rowid, chunk_id FROM {ids_table} WHERE fts_rowid IN ({placeholders})",
+                                  [rowid for rowid, _ in rows]))
+    # rank entspricht bm25() und ist negativ, kleiner ist besser
+    return [(chunk_ids[rowid], -score) for rowid, score in rows if rowid in chunk_ids]
+
+
+def rebuild_from_chroma(collection):
+    # Baut den Index einer Collection vollständig aus den in Chroma gespeicherten Dokumenten neu auf
+    drop_collection(collection.name)
+    offset, page_size = 0, 5000
+    while True:
+        batch = collection.get(include=["documents"], limit=page_size, offset=offset)
+        add_chunks(collection.name, batch["ids"], batch["documents"])
+        if len(batch["ids"]) < page_size:
+            break
+        offset += page_size
+    logging.info(f"Rebuilt lexical index for collection {collection.name}")
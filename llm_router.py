@@ -0,0 +1,524 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+import anyio
+import anyio.to_thread
+import httpx
+import ollama
+from dotenv import load_dotenv
+from openai import APIConnectionError, APITimeoutError, AsyncAzureOpenAI, AzureOpenAI
+
+import metrics
+from context_assembly import OLLAMA_CONTEXT_TOKENS, count_tokens
+
+# Gemeinsamer Zugang zu den Sprachmodellen für Startseite und Chat. Jedes Backend (Azure OpenAI, Ollama) hat
+# einen eigenen Verbindungspool, eine Obergrenze gleichzeitiger Anfragen und Timeouts. Überlastung (429) und
+# Verbindungsfehler werden mit exponentiellem Backoff wiederholt; scheitert ein Backend wiederholt, wird es für
+# eine Abkühlzeit gemieden und die Anfragen gehen an das andere Backend.
+
+load_dotenv()
+
+AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
+AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
+AZURE_API_VERSION = os.getenv("AZURE_API_VERSION")
+AZURE_MODEL = os.getenv("AZURE_MODEL", "gpt-35-turbo")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3-gradient:latest")
+
+# Gleichzeitige Anfragen je Backend (zugleich Größe des Verbindungspools)
+LLM_AZURE_MAX_CONCURRENCY = int(os.getenv("LLM_AZURE_MAX_CONCURRENCY", "16"))
+LLM_OLLAMA_MAX_CONCURRENCY = int(os.getenv("LLM_OLLAMA_MAX_CONCURRENCY", "2"))
+# Timeout in Sekunden bis zum Beginn einer Antwort bzw. zwischen zwei Teilen eines Streams
+LLM_AZURE_TIMEOUT = float(os.getenv("LLM_AZURE_TIMEOUT", "60"))
+LLM_OLLAMA_TIMEOUT = float(os.getenv("LLM_OLLAMA_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = 5.0
+# Antworten ohne Stream dürfen zusätzlich max_tokens / LLM_MIN_TOKENS_PER_SECOND Sekunden dauern
+LLM_MIN_TOKENS_PER_SECOND = float(os.getenv("LLM_MIN_TOKENS_PER_SECOND", "20"))
+# Wartezeit auf einen freien Platz, danach wird auf das andere Backend ausgewichen
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# Längere Wartezeiten (auch per Retry-After verlangte) führen direkt zum Ausweichen
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+# Nach so vielen Fehlschlägen in Folge wird ein Backend für LLM_COOLDOWN_SECONDS gemieden
+LLM_FAILURE_THRESHOLD = int(os.getenv("LLM_FAILURE_THRESHOLD", "3"))
+LLM_COOLDOWN_SECONDS = float(os.getenv("LLM_COOLDOWN_SECONDS", "30"))
+LLM_FAILOVER_ENABLED = os.getenv("LLM_FAILOVER_ENABLED", "true").lower() == "true"
+
+
+class BackendUnavailableError(Exception):
+    pass
+
+
+def is_retryable(error: Exception) -> bool:
+    # Überlastung, Zeitüberschreitungen, Verbindungs- und Serverfehler; 4xx-Fehler wie ein zu langer Prompt nicht
+    if isinstance(error, (APIConnectionError, httpx.TransportError, ConnectionError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code in (408, 409, 429) or (isinstance(status_code, int) and status_code >= 500)
+
+
+def is_response_timeout(error: Exception) -> bool:
+    # Zeitüberschreitung beim Warten auf die Antwort (nicht beim Verbindungsaufbau); das Modell hat dann
+    # womöglich schon generiert, ein neuer Versuch würde die Antwort erneut erzeugen und abrechnen
+    cause = error
+    while cause is not None:
+        if isinstance(cause, httpx.TimeoutException):
+            return not isinstance(cause, (httpx.ConnectTimeout, httpx.PoolTimeout))
+        cause = cause.__cause__ or cause.__context__
+    return isinstance(error, APITimeoutError)
+
+
+def completion_timeout(timeout: float, max_tokens: int) -> httpx.Timeout:
+    return httpx.Timeout(timeout + max_tokens / LLM_MIN_TOKENS_PER_SECOND, connect=LLM_CONNECT_TIMEOUT)
+
+
+def can_fail_over(error: Exception) -> bool:
+    return isinstance(error, BackendUnavailableError) or is_retryable(error)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(LLM_BACKOFF_MAX, 0.5 * 2 ** attempt + random.uniform(0, 0.5))
+
+
+class BackendHealth:
+    # Zählt Fehlschläge in Folge; ab LLM_FAILURE_THRESHOLD ist das Backend bis open_until gesperrt.
+    # Nach Ablauf darf eine Anfrage es erneut versuchen, ein weiterer Fehler sperrt es sofort wieder.
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+
+    def record_failure(self, error: Exception):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"
+            if self.consecutive_failures >= LLM_FAILURE_THRESHOLD:
+                self.open_until = time.monotonic() + LLM_COOLDOWN_SECONDS
+
+
+class Backend:
+    name = None
+
+    def __init__(self, model: str, max_concurrency: int):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.health = BackendHealth()
+        self.in_flight = 0
+        # Eine gemeinsame Grenze für synchrone Aufrufe (Flask, Threads) und die Event-Loop im ASGI-Betrieb
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    def _change_in_flight(self, delta: int):
+        with self._lock:
+            self.in_flight += delta
+
+    def acquire(self):
+        if not self._semaphore.acquire(timeout=LLM_QUEUE_TIMEOUT):
+            raise BackendUnavailableError(f"{self.name}: all {self.max_concurrency} slots busy")
+        self._change_in_flight(1)
+
+    def release(self):
+        self._change_in_flight(-1)
+        self._semaphore.release()
+
+    async def aacquire(self):
+        # Ist kein Platz frei, wird in einem Worker-Thread gewartet, damit die Event-Loop nicht blockiert.
+        # Der Aufruf ist nicht abbrechbar, sodass ein erhaltener Platz immer bei arelease zurückgegeben wird.
+        if not self._semaphore.acquire(blocking=False):
+            acquired = await anyio.to_thread.run_sync(self._semaphore.acquire, True, LLM_QUEUE_TIMEOUT)
+            if not acquired:
+                raise BackendUnavailableError(f"{self.name}: all {self.max_concurrency} slots busy")
+        self._change_in_flight(1)
+
+    def arelease(self):
+        self.release()
+
+    def record_stream_tokens(self, messages: List[dict], parts: List[str]):
+        # Ohne usage im Stream werden die Tokens selbst gezählt
+        if metrics.METRICS_ENABLED:
+            metrics.record_tokens(self.name, sum(count_tokens(message['content']) for message in messages),
+                                  count_tokens("".join(parts)))
+
+
+class AzureBackend(Backend):
+    name = 'azure'
+
+    def __init__(self):
+        super().__init__(AZURE_MODEL, LLM_AZURE_MAX_CONCURRENCY)
+        timeout = httpx.Timeout(LLM_AZURE_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        # Wiederholungen übernimmt der Router, damit zwischendurch ausgewichen werden kann
+        self.client = AzureOpenAI(api_key=AZURE_OPENAI_KEY, api_version=AZURE_API_VERSION,
+                                  azure_endpoint=AZURE_ENDPOINT, timeout=timeout, max_retries=0,
+                                  http_client=httpx.Client(limits=limits, timeout=timeout))
+        self.async_client = AsyncAzureOpenAI(api_key=AZURE_OPENAI_KEY, api_version=AZURE_API_VERSION,
+                                             azure_endpoint=AZURE_ENDPOINT, timeout=timeout, max_retries=0,
+                                             http_client=httpx.AsyncClient(limits=limits, timeout=timeout))
+
+    def _record_usage(self, response):
+        usage = getattr(response, 'usage', None)
+        if usage:
+            metrics.record_tokens(self.name, usage.prompt_tokens, usage.completion_tokens)
+
+    def complete(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        response = self.client.chat.completions.create(model=self.model, messages=messages,
+                                                       temperature=temperature, max_tokens=max_tokens,
+                                                       timeout=completion_timeout(LLM_AZURE_TIMEOUT, max_tokens))
+        self._record_usage(response)
+        return response.choices[0].message.content
+
+    def stream(self, messages: List[dict], max_tokens: int, temperature: float) -> Iterator[str]:
+        stream = self.client.chat.completions.create(model=self.model, messages=messages, temperature=temperature,
+                                                     max_tokens=max_tokens, stream=True)
+        parts = []
+        try:
+            for chunk in stream:
+                # Azure schickt u.a. Content-Filter-Chunks ohne choices
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+            self.record_stream_tokens(messages, parts)
+
+    async def acomplete(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=self.model, messages=messages, temperature=temperature, max_tokens=max_tokens,
+            timeout=completion_timeout(LLM_AZURE_TIMEOUT, max_tokens))
+        self._record_usage(response)
+        return response.choices[0].message.content
+
+    async def astream(self, messages: List[dict], max_tokens: int, temperature: float) -> AsyncIterator[str]:
+        stream = await self.async_client.chat.completions.create(model=self.model, messages=messages,
+                                                                 temperature=temperature, max_tokens=max_tokens,
+                                                                 stream=True)
+        parts = []
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+            self.record_stream_tokens(messages, parts)
+
+
+class OllamaBackend(Backend):
+    name = 'ollama'
+
+    def __init__(self):
+        super().__init__(OLLAMA_MODEL, LLM_OLLAMA_MAX_CONCURRENCY)
+        timeout = httpx.Timeout(LLM_OLLAMA_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        # Der Host kommt wie bisher aus OLLAMA_HOST
+        self.client = ollama.Client(timeout=timeout, limits=limits)
+        self.async_client = ollama.AsyncClient(timeout=timeout, limits=limits)
+
+    @staticmethod
+    def _options(max_tokens: int, temperature: float) -> dict:
+        return {'num_ctx': OLLAMA_CONTEXT_TOKENS, 'num_predict': max_tokens, 'temperature': temperature}
+
+    def _record_usage(self, response):
+        metrics.record_tokens(self.name, response.get('prompt_eval_count'), response.get('eval_count'))
+
+    def complete(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        # Der Ollama-Client kennt keinen Timeout je Anfrage; ohne Stream wird daher intern gestreamt, sodass
+        # LLM_OLLAMA_TIMEOUT wie bei Streams nur zwischen zwei Teilen der Antwort gilt
+        return "".join(self.stream(messages, max_tokens, temperature))
+
+    def stream(self, messages: List[dict], max_tokens: int, temperature: float) -> Iterator[str]:
+        for chunk in self.client.chat(model=self.model, messages=messages, stream=True,
+                                      options=self._options(max_tokens, temperature)):
+            if chunk.get('done'):
+                self._record_usage(chunk)
+            if chunk['message']['content']:
+                yield chunk['message']['content']
+
+    async def acomplete(self, messages: List[dict], max_tokens: int, temperature: float) -> str:
+        return "".join([token async for token in self.astream(messages, max_tokens, temperature)])
+
+    async def astream(self, messages: List[dict], max_tokens: int, temperature: float) -> AsyncIterator[str]:
+        async for chunk in await self.async_client.chat(model=self.model, messages=messages, stream=True,
+                                                        options=self._options(max_tokens, temperature)):
+            if chunk.get('done'):
+                self._record_usage(chunk)
+            if chunk['message']['content']:
+                yield chunk['message']['content']
+
+
+class LLMRouter:
+    # complete/stream liefern die Antwort und das tatsächlich genutzte Backend. Bei Streams wird nur bis zum
+    # ersten Token wiederholt oder ausgewichen; bricht ein Stream danach ab, geht der Fehler an den Aufrufer.
+
+    def __init__(self, backends: List[Backend]):
+        self.backends = {backend.name: backend for backend in backends}
+
+    def candidates(self, preferred: str) -> List[Backend]:
+        ordered = [self.backends[preferred]]
+        if LLM_FAILOVER_ENABLED:
+            ordered += [backend for name, backend in self.backends.items() if name != preferred]
+        available = [backend for backend in ordered if backend.health.available()]
+        # Sind alle gesperrt, darf das bevorzugte Backend es trotzdem versuchen
+        return available or ordered[:1]
+
+    @staticmethod
+    def _log_failover(backend: Backend, error: Exception):
+        logging.warning(f"LLM backend failed ({type(error).__name__}: {error}), falling back to {backend.name}")
+        metrics.record_llm(backend.name, "failover")
+
+    @staticmethod
+    def _should_retry(backend: Backend, error: Exception, attempt: int, retry_timeouts: bool) -> Optional[float]:
+        # Liefert die Wartezeit bis zum nächsten Versuch oder None, wenn aufgegeben wird.
+        # Ohne retry_timeouts wird nach einer Zeitüberschreitung direkt ausgewichen.
+        if not is_retryable(error):
+            return None
+        if not retry_timeouts and is_response_timeout(error):
+            backend.health.record_failure(error)
+            return None
+        delay = retry_delay(error, attempt)
+        if attempt == LLM_MAX_RETRIES or delay > LLM_BACKOFF_MAX:
+            backend.health.record_failure(error)
+            return None
+        logging.warning(f"LLM request to {backend.name} failed ({type(error).__name__}), retrying in {delay:.1f}s")
+        metrics.record_llm(backend.name, "retry")
+        return delay
+
+    def _with_retries(self, backend: Backend, call, retry_timeouts: bool = True):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                result = call()
+                backend.health.record_success()
+                return result
+            except Exception as e:
+                delay = self._should_retry(backend, e, attempt, retry_timeouts)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    async def _awith_retries(self, backend: Backend, call, retry_timeouts: bool = True):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                result = await call()
+                backend.health.record_success()
+                return result
+            except Exception as e:
+                delay = self._should_retry(backend, e, attempt, retry_timeouts)
+                if delay is None:
+                    raise
+                await anyio.sleep(delay)
+
+    def complete(self, preferred: str, messages: List[dict], max_tokens: int,
+                 temperature: float = 0.7) -> Tuple[str, str]:
+        last_error = None
+        with metrics.timed("generate"):
+            for backend in self.candidates(preferred):
+                if last_error is not None:
+                    self._log_failover(backend, last_error)
+                try:
+                    backend.acquire()
+                    try:
+                        text = self._with_retries(backend, lambda: backend.complete(messages, max_tokens,
+                                                                                    temperature),
+                                                  retry_timeouts=False)
+                    finally:
+                        backend.release()
+                except Exception as e:
+                    if not can_fail_over(e):
+                        metrics.record_llm(backend.name, "error")
+                        raise
+                    last_error = e
+                    continue
+                metrics.record_llm(backend.name, "success")
+                return text, backend.name
+        metrics.record_llm(preferred, "error")
+        raise last_error
+
+    async def acomplete(self, preferred: str, messages: List[dict], max_tokens: int,
+                        temperature: float = 0.7) -> Tuple[str, str]:
+        last_error = None
+        with metrics.timed("generate"):
+            for backend in self.candidates(preferred):
+                if last_error is not None:
+                    self._log_failover(backend, last_error)
+                try:
+                    await backend.aacquire()
+                    try:
+                        text = await self._awith_retries(backend, lambda: backend.acomplete(messages, max_tokens,
+                                                                                            temperature),
+                                                         retry_timeouts=False)
+                    finally:
+                        backend.arelease()
+                except Exception as e:
+                    if not can_fail_over(e):
+                        metrics.record_llm(backend.name, "error")
+                        raise
+                    last_error = e
+                    continue
+                metrics.record_llm(backend.name, "success")
+                return text, backend.name
+        metrics.record_llm(preferred, "error")
+        raise last_error
+
+    @staticmethod
+    def _start_stream(backend: Backend, messages: List[dict], max_tokens: int, temperature: float):
+        # Öffnet den Stream und wartet auf das erste Token; Fehler bis hierhin werden wiederholt
+        tokens = backend.stream(messages, max_tokens, temperature)
+        try:
+            return next(tokens, None), tokens
+        except BaseException:
+            tokens.close()
+            raise
+
+    @staticmethod
+    async def _astart_stream(backend: Backend, messages: List[dict], max_tokens: int, temperature: float):
+        tokens = backend.astream(messages, max_tokens, temperature)
+        try:
+            try:
+                return await tokens.__anext__(), tokens
+            except StopAsyncIteration:
+                return None, tokens
+        except BaseException:
+            await tokens.aclose()
+            raise
+
+    def stream(self, preferred: str, messages: List[dict], max_tokens: int, temperature: float = 0.7,
+               route: Optional[dict] = None) -> Iterator[str]:
+        # route erhält unter "service" das Backend, das den Stream liefert
+        start = time.perf_counter()
+        last_error = None
+        try:
+            for backend in self.candidates(preferred):
+                if last_error is not None:
+                    self._log_failover(backend, last_error)
+                try:
+                    backend.acquire()
+                except BackendUnavailableError as e:
+                    last_error = e
+                    continue
+                try:
+                    try:
+                        first, tokens = self._with_retries(
+                            backend, lambda: self._start_stream(backend, messages, max_tokens, temperature))
+                    except Exception as e:
+                        if not can_fail_over(e):
+                            metrics.record_llm(backend.name, "error")
+                            raise
+                        last_error = e
+                        continue
+                    metrics.observe_stage("first_token", time.perf_counter() - start)
+                    if route is not None:
+                        route['service'] = backend.name
+                    try:
+                        if first:
+                            yield first
+                        yield from tokens
+                    except Exception as e:
+                        backend.health.record_failure(e)
+                        metrics.record_llm(backend.name, "error")
+                        raise
+                    finally:
+                        tokens.close()
+                    metrics.record_llm(backend.name, "success")
+                    return
+                finally:
+                    backend.release()
+            metrics.record_llm(preferred, "error")
+            raise last_error
+        finally:
+            metrics.observe_stage("generate", time.perf_counter() - start)
+
+    async def astream(self, preferred: str, messages: List[dict], max_tokens: int, temperature: float = 0.7,
+                      route: Optional[dict] = None) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        last_error = None
+        try:
+            for backend in self.candidates(preferred):
+                if last_error is not None:
+                    self._log_failover(backend, last_error)
+                try:
+                    await backend.aacquire()
+                except BackendUnavailableError as e:
+                    last_error = e
+                    continue
+                try:
+                    try:
+                        first, tokens = await self._awith_retries(
+                            backend, lambda: self._astart_stream(backend, messages, max_tokens, temperature))
+                    except Exception as e:
+                        if not can_fail_over(e):
+                            metrics.record_llm(backend.name, "error")
+                            raise
+                        last_error = e
+                        continue
+                    metrics.observe_stage("first_token", time.perf_counter() - start)
+                    if route is not None:
+                        route['service'] = backend.name
+                    try:
+                        if first:
+                            yield first
+                        async for token in tokens:
+                            yield token
+                    except Exception as e:
+                        backend.health.record_failure(e)
+                        metrics.record_llm(backend.name, "error")
+                        raise
+                    finally:
+                        await tokens.aclose()
+                    metrics.record_llm(backend.name, "success")
+                    return
+                finally:
+                    backend.arelease()
+            metrics.record_llm(preferred, "error")
+            raise last_error
+        finally:
+            metrics.observe_stage("generate", time.perf_counter() - start)
+
+    def status(self) -> List[dict]:
+        return [{
+            'service': name,
+            'available': backend.health.available(),
+            'consecutive_failures': backend.health.consecutive_failures,
+            'last_error': backend.health.last_error,
+            'in_flight': backend.in_flight,
+            'max_concurrency': backend.max_concurrency
+        } for name, backend in self.backends.items()]
+
+
+llm_router = LLMRouter([AzureBackend(), OllamaBackend()])
+
+
+def backend_metrics():
+    collected = []
+    for status in llm_router.status():
+        labels = {'service': status['service']}
+        collected.append(("app_llm_backend_available", "1 if the backend accepts requests, 0 during cooldown",
+                          labels, 1.0 if status['available'] else 0.0))
+        collected.append(("app_llm_backend_in_flight", "Requests currently running on the backend",
+                          labels, float(status['in_flight'])))
+        collected.append(("app_llm_backend_consecutive_failures", "Failed requests in a row", labels,
+                          float(status['consecutive_failures'])))
+    return collected
+
+
+metrics.register_collector(backend_metrics)
@@ -0,0 +1,94 @@
+import logging
+import os
+import threading
+from typing import Callable, List, Optional
+
+import numpy as np
+
+# Lokales Embedding-Modell auf der CPU (ONNX Runtime), als Alternative zu Azure OpenAI je Collection.
+# Damit lassen sich große Archive ohne Rate-Limits und ohne Netzwerkzugriff indexieren. Welches Modell
+# eine Collection verwendet, steht in ihren Metadaten; Anfragen werden mit demselben Modell eingebettet.
+
+# Verzeichnis mit model.onnx und tokenizer.json eines Sentence-Transformers-Modells,
+# z.B. paraphrase-multilingual-MiniLM-L12-v2
+LOCAL_EMBEDDING_MODEL_PATH = os.getenv("LOCAL_EMBEDDING_MODEL_PATH", "models/embedder")
+# Name, unter dem das Modell in den Metadaten der Collection vermerkt wird
+LOCAL_EMBEDDING_MODEL_NAME = os.getenv("LOCAL_EMBEDDING_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2")
+LOCAL_EMBEDDING_THREADS = int(os.getenv("LOCAL_EMBEDDING_THREADS", "4"))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32"))
+# Präfixe für Modelle, die Anfragen und Passagen unterscheiden (z.B. "query: " und "passage: " bei E5)
+LOCAL_EMBEDDING_QUERY_PREFIX = os.getenv("LOCAL_EMBEDDING_QUERY_PREFIX", "")
+LOCAL_EMBEDDING_PASSAGE_PREFIX = os.getenv("LOCAL_EMBEDDING_PASSAGE_PREFIX", "")
+LOCAL_EMBEDDING_MAX_LENGTH = 512
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+class LocalEmbedder:
+    # Mean Pooling über die Token-Vektoren und L2-Normierung wie bei Sentence Transformers
+
+    def __init__(self, model_path: str, threads: int):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_path, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=LOCAL_EMBEDDING_MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        batch = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in batch], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in batch], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in batch], dtype=np.int64),
+        }
+        output = self.session.run(None, {name: value for name, value in inputs.items()
+                                         if name in self.input_names})[0]
+        if output.ndim == 3:
+            # Token-Vektoren (last_hidden_state); Padding zählt nicht zum Mittelwert
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.where(norms == 0, 1.0, norms)).astype(np.float32)
+
+
+def model_available() -> bool:
+    return os.path.exists(os.path.join(LOCAL_EMBEDDING_MODEL_PATH, "model.onnx"))
+
+
+def get_local_embedder() -> LocalEmbedder:
+    # Anders als beim Cross-Encoder gibt es keinen Ersatz: ohne das Modell lässt sich die Collection nicht durchsuchen
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = LocalEmbedder(LOCAL_EMBEDDING_MODEL_PATH, LOCAL_EMBEDDING_THREADS)
+            logging.info(f"Loaded local embedding model {LOCAL_EMBEDDING_MODEL_NAME} from {LOCAL_EMBEDDING_MODEL_PATH}")
+        return _embedder
+
+
+def _create_embeddings(texts: List[str], prefix: str,
+                       progress_callback: Optional[Callable[[int], None]] = None) -> List[List[float]]:
+    embedder = get_local_embedder()
+    embeddings = []
+    for start in range(0, len(texts), LOCAL_EMBEDDING_BATCH_SIZE):
+        batch = [prefix + text for text in texts[start:start + LOCAL_EMBEDDING_BATCH_SIZE]]
+        embeddings.extend(embedder.embed(batch).tolist())
+        if progress_callback:
+            progress_callback(len(embeddings))
+    return embeddings
+
+
+def create_passage_embeddings(texts: List[str],
+                              progress_callback: Optional[Callable[[int], None]] = None) -> List[List[float]]:
+    return _create_embeddings(texts, LOCAL_EMBEDDING_PASSAGE_PREFIX, progress_callback)
+
+
+def create_query_embeddings(texts: List[str]) -> List[List[float]]:
+    return _create_embeddings(texts, LOCAL_EMBEDDING_QUERY_PREFIX)
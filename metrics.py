@@ -0,0 +1,199 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Leichtgewichtige Messpunkte im Prometheus-Textformat, ohne zusätzliche Abhängigkeit.
+# Zeiten einzelner Stufen (embed, retrieve, generate, persist) werden je Anfrage gesammelt
+# und können zusätzlich als Server-Timing-Header ausgegeben werden.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "false").lower() == "true"
+# Optionales Token, das Abfragen von /metrics als "Authorization: Bearer <token>" mitschicken müssen
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Pro Label-Kombination: [Zähler je Bucket..., Summe, Anzahl]
+        self._values: Dict[Labels, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0.0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, state in sorted(self._values.items()):
+                cumulative = 0.0
+                for bound, count in zip(self.buckets, state):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', str(bound)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', '+Inf'))} {state[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(labels)} {state[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(labels)} {state[-1]}")
+        return lines
+
+
+http_request_duration = Histogram("app_http_request_duration_seconds", "Duration of HTTP requests until the response "
+                                                                       "headers are sent")
+stage_duration = Histogram("app_stage_duration_seconds", "Duration of request stages (embed, retrieve, generate, "
+                                                         "persist, ...)")
+llm_tokens = Histogram("app_llm_tokens", "Tokens per completion as reported by the model", buckets=TOKEN_BUCKETS)
+llm_tokens_total = Counter("app_llm_tokens_total", "Total tokens used for completions")
+llm_requests = Counter("app_llm_requests_total", "LLM calls by backend and result (success, retry, failover, "
+                                              "error)")
+cache_lookups = Counter("app_cache_lookups_total", "Cache lookups by cache and result")
+ingestion_files = Counter("app_ingestion_files_total", "Ingested files by status")
+ingestion_chunks = Counter("app_ingestion_chunks_total", "Chunks processed during ingestion")
+ingestion_pages = Counter("app_ingestion_pages_total", "PDF pages processed during ingestion")
+ingestion_seconds = Counter("app_ingestion_seconds_total", "Time spent ingesting files")
+
+_metrics = [http_request_duration, stage_duration, llm_tokens, llm_tokens_total, llm_requests, cache_lookups,
+            ingestion_files, ingestion_chunks, ingestion_pages, ingestion_seconds]
+# Funktionen, die beim Abruf aktuelle Werte liefern: Liste von (Name, Hilfetext, Labels, Wert)
+_collectors: List[Callable[[], List[Tuple[str, str, dict, float]]]] = []
+
+
+def start_request():
+    if METRICS_ENABLED:
+        _request_timings.set({})
+
+
+def request_timings() -> Optional[dict]:
+    return _request_timings.get()
+
+
+def observe_stage(stage: str, seconds: float):
+    if not METRICS_ENABLED:
+        return
+    stage_duration.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def record_request(endpoint: str, method: str, status: int, seconds: float):
+    if METRICS_ENABLED:
+        http_request_duration.observe(seconds, endpoint=endpoint, method=method, status=str(status))
+
+
+def record_tokens(service: str, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    if not METRICS_ENABLED:
+        return
+    for kind, count in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+        if count is not None:
+            llm_tokens.observe(count, service=service, kind=kind)
+            llm_tokens_total.inc(count, service=service, kind=kind)
+
+
+def record_llm(service: str, result: str):
+    if METRICS_ENABLED:
+        llm_requests.inc(service=service, result=result)
+
+
+def record_cache(cache: str, result: str):
+    if METRICS_ENABLED:
+        cache_lookups.inc(cache=cache, result=result)
+
+
+def record_ingestion(status: str, chunks: int = 0, pages: int = 0, seconds: float = 0.0):
+    if not METRICS_ENABLED:
+        return
+    ingestion_files.inc(status=status)
+    ingestion_chunks.inc(chunks)
+    ingestion_pages.inc(pages)
+    ingestion_seconds.inc(seconds)
+
+
+def register_collector(collector: Callable[[], List[Tuple[str, str, dict, float]]]):
+    _collectors.append(collector)
+
+
+def server_timing_header() -> Optional[str]:
+    timings = _request_timings.get()
+    if not SERVER_TIMING_ENABLED or not timings:
+        return None
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    gauges = {}
+    for collector in _collectors:
+        for name, help_text, labels, value in collector():
+            gauges.setdefault(name, (help_text, []))[1].append((tuple(sorted(labels.items())), value))
+    for name, (help_text, values) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,122 @@
+import logging
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import fitz  # PyMuPDF
+import tiktoken
+
+# Dieses Modul importiert bewusst weder Chroma noch OpenAI, damit die Parse-Prozesse schlank bleiben.
+
+# Anzahl der Prozesse zum Parsen der PDFs (0 = im aufrufenden Thread parsen)
+PDF_PARSE_WORKERS = int(os.getenv("PDF_PARSE_WORKERS", str(os.cpu_count() or 1)))
+# Große PDFs werden in Seitenbereiche dieser Größe aufgeteilt und parallel geparst
+PDF_PARSE_RANGE_PAGES = int(os.getenv("PDF_PARSE_RANGE_PAGES", "50"))
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def iter_pdf_pages(file_path: str, start_page: int = 0, end_page: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    # Liefert (Seitennummer, Text) Seite für Seite, ohne das ganze Dokument im Speicher zu halten
+    with fitz.open(file_path) as doc:
+        end_page = doc.page_count if end_page is None else min(end_page, doc.page_count)
+        for page_index in range(start_page, end_page):
+            yield page_index + 1, doc.load_page(page_index).get_text()
+
+def get_page_count(file_path: str) -> int:
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+def iter_text_chunks(pages: Iterable[Tuple[int, str]], max_tokens_per_chunk: int,
+                     overlap_tokens: int = 0) -> Iterator[dict]:
+    # Tokenisiert Seite für Seite und liefert Chunks mit exakter Start- und Endseite.
+    # Im Puffer liegen höchstens ein Chunk plus eine Seite an Tokens.
+    if not 0 <= overlap_tokens < max_tokens_per_chunk:
+        raise ValueError("overlap_tokens must be smaller than max_tokens_per_chunk")
+    encoding = tiktoken.get_encoding("cl100k_base")
+    step = max_tokens_per_chunk - overlap_tokens
+    tokens: List[int] = []
+    token_pages: List[int] = []
+    carried = 0  # Tokens am Pufferanfang, die schon im vorherigen Chunk enthalten waren
+
+    def make_chunk(end: int) -> dict:
+        return {
+            "text": encoding.decode(tokens[:end]),
+            "page_start": token_pages[0],
+            "page_end": token_pages[end - 1]
+        }
+
+    for page_number, page_text in pages:
+        page_tokens = encoding.encode(page_text)
+        tokens.extend(page_tokens)
+        token_pages.extend([page_number] * len(page_tokens))
+        while len(tokens) >= max_tokens_per_chunk:
+            yield make_chunk(max_tokens_per_chunk)
+            del tokens[:step]
+            del token_pages[:step]
+            carried = overlap_tokens
+    if len(tokens) > carried:
+        yield make_chunk(len(tokens))
+
+def parse_pdf_range(file_path: str, start_page: int, end_page: int) -> List[Tuple[int, str]]:
+    # Läuft in einem Parse-Prozess und liefert nur den Text der Seiten; gechunkt wird im aufrufenden Prozess,
+    # damit die Chunks nicht von der Bereichsgröße abhängen
+    return list(iter_pdf_pages(file_path, start_page, end_page))
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn statt fork, da der aufrufende Prozess Worker-Threads hat
+            _parse_pool = ProcessPoolExecutor(max_workers=PDF_PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+        return _parse_pool
+
+def _reset_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+            _parse_pool = None
+
+def iter_parsed_pages(file_path: str) -> Iterator[Tuple[int, str]]:
+    # Parst die Seitenbereiche einer Datei parallel im Prozess-Pool und liefert die Seiten in Dokumentreihenfolge.
+    # Mehrere Dateien, die gleichzeitig verarbeitet werden, teilen sich den Pool.
+    if PDF_PARSE_WORKERS <= 0:
+        yield from iter_pdf_pages(file_path)
+        return
+
+    page_count = get_page_count(file_path)
+    ranges = [(start, min(start + PDF_PARSE_RANGE_PAGES, page_count))
+              for start in range(0, page_count, PDF_PARSE_RANGE_PAGES)]
+    pending = deque()
+    next_range = 0
+    completed = 0
+    try:
+        pool = get_parse_pool()
+        while completed < len(ranges):
+            # Nur begrenzt viele Bereiche vorausparsen, damit sich keine Seiten im Speicher stauen
+            while next_range < len(ranges) and len(pending) < PDF_PARSE_WORKERS:
+                start, end = ranges[next_range]
+                pending.append(pool.submit(parse_pdf_range, file_path, start, end))
+                next_range += 1
+            pages = pending.popleft().result()
+            yield from pages
+            completed += 1
+    except BrokenProcessPool:
+        # Ein Parse-Prozess ist abgestürzt: Pool neu aufsetzen und den Rest im aktuellen Thread parsen
+        logging.warning(f"PDF parse pool failed while parsing {file_path}, falling back to in-process parsing")
+        _reset_parse_pool()
+        if completed < len(ranges):
+            yield from iter_pdf_pages(file_path, ranges[completed][0])
+    finally:
+        for future in pending:
+            future.cancel()
+
+def iter_parsed_chunks(file_path: str, max_tokens_per_chunk: int, overlap_tokens: int = 0) -> Iterator[dict]:
+    # Chunks über das ganze Dokument, identisch zum Parsen ohne Prozess-Pool
+    yield from iter_text_chunks(iter_parsed_pages(file_path), max_tokens_per_chunk, overlap_tokens)
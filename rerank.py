@@ -0,0 +1,156 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import List, Optional
+
+import numpy as np
+import tiktoken
+
+# Zweite Stufe der Suche: Aus den überzählig geholten Kandidaten werden Beinahe-Duplikate entfernt,
+# die übrigen neu sortiert (lokaler Cross-Encoder per ONNX Runtime oder MMR für mehr Vielfalt)
+# und optional auf ein Token-Budget gekürzt.
+
+# mmr, cross-encoder oder none
+RERANK_METHOD = os.getenv("RERANK_METHOD", "mmr").lower()
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+# Chunks mit höherer Kosinus-Ähnlichkeit zu einem besser platzierten Chunk gelten als Duplikat
+RERANK_DEDUP_SIMILARITY = float(os.getenv("RERANK_DEDUP_SIMILARITY", "0.97"))
+# Gewichtung Relevanz gegenüber Vielfalt bei MMR (1.0 = nur Relevanz)
+RERANK_MMR_LAMBDA = float(os.getenv("RERANK_MMR_LAMBDA", "0.7"))
+# Maximale Tokens aller ausgewählten Chunks zusammen (0 = unbegrenzt); das eigentliche Budget
+# vergibt context_assembly anhand des Kontextfensters
+RERANK_MAX_CONTEXT_TOKENS = int(os.getenv("RERANK_MAX_CONTEXT_TOKENS", "0"))
+# Verzeichnis mit model.onnx und tokenizer.json eines Cross-Encoders (z.B. ms-marco-MiniLM-L-6-v2)
+RERANK_MODEL_PATH = os.getenv("RERANK_MODEL_PATH", "models/reranker")
+RERANK_THREADS = int(os.getenv("RERANK_THREADS", "2"))
+RERANK_BATCH_SIZE = 16
+RERANK_MAX_LENGTH = 512
+
+_encoding = tiktoken.get_encoding("cl100k_base")
+_cross_encoder = None
+_cross_encoder_failed = False
+_cross_encoder_lock = threading.Lock()
+
+
+def needs_embeddings() -> bool:
+    return RERANK_METHOD != "none"
+
+
+class CrossEncoder:
+    # Bewertet (Anfrage, Chunk)-Paare mit einem exportierten Cross-Encoder auf der CPU
+
+    def __init__(self, model_path: str, threads: int):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_path, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=RERANK_MAX_LENGTH)
+        self.tokenizer.enable_padding()
+
+    def score(self, query: str, documents: List[str]) -> np.ndarray:
+        scores = []
+        for start in range(0, len(documents), RERANK_BATCH_SIZE):
+            pairs = [(query, document) for document in documents[start:start + RERANK_BATCH_SIZE]]
+            batch = self.tokenizer.encode_batch(pairs)
+            inputs = {
+                "input_ids": np.array([encoding.ids for encoding in batch], dtype=np.int64),
+                "attention_mask": np.array([encoding.attention_mask for encoding in batch], dtype=np.int64),
+                "token_type_ids": np.array([encoding.type_ids for encoding in batch], dtype=np.int64),
+            }
+            logits = self.session.run(None, {name: value for name, value in inputs.items()
+                                             if name in self.input_names})[0]
+            # Ein Ausgabewert (Relevanz-Score) oder zwei Klassen (irrelevant/relevant)
+            scores.append(logits[:, 0] if logits.shape[1] == 1 else logits[:, 1])
+        return np.concatenate(scores)
+
+
+def get_cross_encoder() -> Optional[CrossEncoder]:
+    global _cross_encoder, _cross_encoder_failed
+    with _cross_encoder_lock:
+        if _cross_encoder is None and not _cross_encoder_failed:
+            try:
+                _cross_encoder = CrossEncoder(RERANK_MODEL_PATH, RERANK_THREADS)
+                logging.info(f"Loaded cross-encoder from {RERANK_MODEL_PATH}")
+            except Exception as e:
+                _cross_encoder_failed = True
+                logging.warning(f"Could not load cross-encoder from {RERANK_MODEL_PATH}, using MMR instead: {e}")
+        return _cross_encoder
+
+
+def _normalized_embeddings(candidates: List[dict]) -> Optional[np.ndarray]:
+    if not candidates or any(candidate.get("embedding") is None for candidate in candidates):
+        return None
+    matrix = np.asarray([candidate["embedding"] for candidate in candidates], dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def deduplicate(candidates: List[dict]) -> List[dict]:
+    # Behält von (nahezu) gleichen Chunks den am besten platzierten
+    seen_texts = set()
+    unique = []
+    for candidate in candidates:
+        text_hash = hashlib.sha256(" ".join(candidate["document"].split()).encode()).hexdigest()
+        if text_hash not in seen_texts:
+            seen_texts.add(text_hash)
+            unique.append(candidate)
+    embeddings = _normalized_embeddings(unique)
+    if embeddings is None:
+        return unique
+    kept = []
+    for i in range(len(unique)):
+        if not kept or float(np.max(embeddings[kept] @ embeddings[i])) < RERANK_DEDUP_SIMILARITY:
+            kept.append(i)
+    return [unique[i] for i in kept]
+
+
+def mmr(candidates: List[dict], n_results: int, lambda_: float = RERANK_MMR_LAMBDA) -> List[dict]:
+    # Maximal Marginal Relevance; die Relevanz ergibt sich aus der bisherigen (fusionierten) Reihenfolge
+    embeddings = _normalized_embeddings(candidates)
+    if embeddings is None:
+        return candidates[:n_results]
+    relevance = 1.0 - np.arange(len(candidates)) / len(candidates)
+    selected = [0]
+    remaining = list(range(1, len(candidates)))
+    while remaining and len(selected) < n_results:
+        similarity = np.max(embeddings[remaining] @ embeddings[selected].T, axis=1)
+        mmr_scores = lambda_ * relevance[remaining] - (1 - lambda_) * similarity
+        best = remaining[int(np.argmax(mmr_scores))]
+        selected.append(best)
+        remaining.remove(best)
+    return [candidates[i] for i in selected]
+
+
+def trim_to_token_budget(candidates: List[dict], max_tokens: int = RERANK_MAX_CONTEXT_TOKENS) -> List[dict]:
+    if max_tokens <= 0:
+        return candidates
+    selected, used = [], 0
+    for candidate in candidates:
+        tokens = len(_encoding.encode(candidate["document"], disallowed_special=()))
+        # Der beste Chunk wird immer übernommen, auch wenn er allein das Budget überschreitet
+        if selected and used + tokens > max_tokens:
+            break
+        selected.append(candidate)
+        used += tokens
+    return selected
+
+
+def rerank(query: str, candidates: List[dict], n_results: int) -> List[dict]:
+    # candidates: nach Relevanz sortierte Treffer {id, document, metadata, distance, score, embedding}
+    if RERANK_METHOD == "none" or not candidates:
+        return trim_to_token_budget(candidates[:n_results])
+    candidates = deduplicate(candidates)
+    cross_encoder = get_cross_encoder() if RERANK_METHOD == "cross-encoder" else None
+    if cross_encoder is not None:
+        scores = cross_encoder.score(query, [candidate["document"] for candidate in candidates])
+        order = np.argsort(-scores)[:n_results]
+        ranked = [dict(candidates[i], rerank_score=float(scores[i])) for i in order]
+    else:
+        ranked = mmr(candidates, n_results)
+    return trim_to_token_budget(ranked)
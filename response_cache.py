@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.db")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "5000"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+# Semantische Stufe: Antworten auf ähnlich formulierte Anfragen mit denselben Parametern wiederverwenden
+RESPONSE_CACHE_SEMANTIC_ENABLED = os.getenv("RESPONSE_CACHE_SEMANTIC_ENABLED", "false").lower() == "true"
+RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE = float(os.getenv("RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE", "0.05"))
+# Höchstens so viele der zuletzt genutzten Einträge werden für die semantische Suche verglichen
+RESPONSE_CACHE_SEMANTIC_CANDIDATES = 500
+
+# Nach so vielen neuen Einträgen wird die Anzahl geprüft
+EVICTION_CHECK_INTERVAL = 100
+
+
+def _hash(data) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class ResponseCache:
+    # Persistenter Cache für generierte Antworten. Der exakte Schlüssel umfasst alle Parameter der Anfrage
+    # und die IDs der gefundenen Chunks; der Parameterschlüssel (ohne Prompt und Chunks) grenzt die
+    # Kandidaten der semantischen Suche ein. Verdrängt wird nach Alter (TTL) und letztem Zugriff (LRU).
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._inserts_since_check = 0
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    params_key TEXT NOT NULL,
+                    collection TEXT,
+                    system_prompt_id TEXT,
+                    query_embedding BLOB,
+                    response TEXT NOT NULL,
+                    citations TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_params_key ON responses (params_key, last_access)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_collection ON responses (collection)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_system_prompt ON responses (system_prompt_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_keys(params: dict, chunk_ids: List[str]) -> Tuple[str, str]:
+        # params enthält den Prompt unter "prompt"; der Parameterschlüssel lässt ihn weg
+        params_key = _hash({name: value for name, value in params.items() if name != "prompt"})
+        key = _hash({"params": params, "chunk_ids": list(chunk_ids)})
+        return key, params_key
+
+    def _touch(self, conn: sqlite3.Connection, key: str):
+        with conn:
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+
+    def _count(self, attribute: str):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def get(self, key: str) -> Optional[dict]:
+        conn = self._connection()
+        row = conn.execute("SELECT response, citations FROM responses WHERE key = ? AND created_at >= ?",
+                           (key, time.time() - self.ttl_seconds)).fetchone()
+        if row is None:
+            return None
+        self._touch(conn, key)
+        return {"response": row[0], "citations": json.loads(row[1]), "match": "exact", "distance": 0.0}
+
+    def get_similar(self, params_key: str, embedding: List[float],
+                    max_distance: float = RESPONSE_CACHE_SEMANTIC_MAX_DISTANCE) -> Optional[dict]:
+        conn = self._connection()
+        rows = conn.execute("SELECT key, query_embedding FROM responses WHERE params_key = ? AND created_at >= ? "
+                            "AND query_embedding IS NOT NULL ORDER BY last_access DESC LIMIT ?",
+                            (params_key, time.time() - self.ttl_seconds, RESPONSE_CACHE_SEMANTIC_CANDIDATES)).fetchall()
+        if not rows:
+            return None
+        candidates = np.frombuffer(b"".join(blob for _, blob in rows), dtype=np.float32).reshape(len(rows), -1)
+        query = np.asarray(embedding, dtype=np.float32)
+        norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(query)
+        distances = 1.0 - (candidates @ query) / np.where(norms == 0, 1.0, norms)
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        key = rows[best][0]
+        response, citations = conn.execute("SELECT response, citations FROM responses WHERE key = ?",
+                                           (key,)).fetchone()
+        self._touch(conn, key)
+        return {"response": response, "citations": json.loads(citations), "match": "semantic",
+                "distance": float(distances[best])}
+
+    def lookup(self, key: str, params_key: str, embedding_fn: Callable[[], List[float]]) -> Optional[dict]:
+        cached = self.get(key)
+        if cached is None and RESPONSE_CACHE_SEMANTIC_ENABLED:
+            cached = self.get_similar(params_key, embedding_fn())
+        if cached is None:
+            self._count("misses")
+        else:
+            self._count("exact_hits" if cached["match"] == "exact" else "semantic_hits")
+        return cached
+
+    def put(self, key: str, params_key: str, collection: str, system_prompt_id, embedding: Optional[List[float]],
+            response: str, citations: List[str]):
+        now = time.time()
+        blob = array("f", embedding).tobytes() if embedding is not None else None
+        conn = self._connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO responses (key, params_key, collection, system_prompt_id, "
+                         "query_embedding, response, citations, created_at, last_access) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (key, params_key, collection, str(system_prompt_id) if system_prompt_id else None, blob,
+                          response, json.dumps(citations), now, now))
+        with self._lock:
+            self._inserts_since_check += 1
+            check = self._inserts_since_check >= EVICTION_CHECK_INTERVAL
+            if check:
+                self._inserts_since_check = 0
+        if check:
+            self.evict()
+
+    def invalidate_collection(self, collection_name: str):
+        conn = self._connection()
+        with conn:
+            # Antworten einer Suche über mehrere Collections sind unter "a,b" gespeichert
+            deleted = conn.execute("DELETE FROM responses WHERE collection = ? "
+                                   "OR instr(',' || collection || ',', ?) > 0",
+                                   (collection_name, f",{collection_name},")).rowcount
+        if deleted:
+            logging.info(f"Response cache dropped {deleted} entries of collection {collection_name}")
+
+    def invalidate_system_prompt(self, system_prompt_id):
+        conn = self._connection()
+        with conn:
+            deleted = conn.execute("DELETE FROM responses WHERE system_prompt_id = ?", (str(system_prompt_id),)).rowcount
+        if deleted:
+            logging.info(f"Response cache dropped {deleted} entries of system prompt {system_prompt_id}")
+
+    def evict(self):
+        conn = self._connection()
+        with conn:
+            expired = conn.execute("DELETE FROM responses WHERE created_at < ?",
+                                   (time.time() - self.ttl_seconds,)).rowcount
+            excess = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM responses WHERE key IN "
+                             "(SELECT key FROM responses ORDER BY last_access LIMIT ?)", (excess,))
+        logging.info(f"Response cache evicted {expired} expired and {max(excess, 0)} least recently used entries")
+
+    def stats(self) -> dict:
+        with self._lock:
+            exact_hits, semantic_hits, misses = self.exact_hits, self.semantic_hits, self.misses
+        lookups = exact_hits + semantic_hits + misses
+        return {
+            "exact_hits": exact_hits,
+            "semantic_hits": semantic_hits,
+            "misses": misses,
+            "hit_rate": (exact_hits + semantic_hits) / lookups if lookups else 0.0,
+            "entries": self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+            "max_entries": self.max_entries
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS) \
+    if RESPONSE_CACHE_ENABLED else None
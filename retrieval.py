@@ -0,0 +1,198 @@
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import compact_index
+import lexical_index
+import metrics
+import rerank
+from embedding_service import query_embedder_for
+from vector import collection_embedding_backend
+from vector_store import get_collection
+
+# Hybride Suche: Vektorsuche in Chroma plus BM25-Volltextsuche, zusammengeführt per Reciprocal Rank Fusion
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Threads, die bei einer Suche über mehrere Collections gleichzeitig abfragen
+FEDERATED_SEARCH_WORKERS = int(os.getenv("FEDERATED_SEARCH_WORKERS", "8"))
+
+_executor = ThreadPoolExecutor(max_workers=FEDERATED_SEARCH_WORKERS, thread_name_prefix="federated-search")
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> Dict[str, float]:
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+
+def _search_settings(n_results: int):
+    # Für Fusion und Reranking mehr Kandidaten holen als am Ende gebraucht werden
+    n_candidates = n_results
+    if HYBRID_SEARCH_ENABLED:
+        n_candidates = max(n_candidates, HYBRID_CANDIDATES)
+    if rerank.RERANK_METHOD != "none":
+        n_candidates = max(n_candidates, rerank.RERANK_CANDIDATES)
+    include = ["documents", "metadatas", "distances"] + (["embeddings"] if rerank.needs_embeddings() else [])
+    return n_candidates, include
+
+
+def _select_hits(collection, collection_name: str, query: str, results: dict, row: int, n_results: int,
+                 n_candidates: int, include: List[str], keep_embeddings: bool = False) -> List[dict]:
+    # Führt die Vektortreffer einer Anfrage (Zeile row des Chroma-Ergebnisses) mit der Volltextsuche zusammen
+    ids = results["ids"][row]
+    embeddings = results["embeddings"][row] if results.get("embeddings") is not None else [None] * len(ids)
+    hits = {
+        chunk_id: {"id": chunk_id, "document": document, "metadata": metadata, "distance": distance,
+                   "embedding": embedding}
+        for chunk_id, document, metadata, distance, embedding in zip(
+            ids, results["documents"][row], results["metadatas"][row], results["distances"][row], embeddings)
+    }
+    vector_ranking = ids
+
+    lexical_ranking = []
+    if HYBRID_SEARCH_ENABLED:
+        with metrics.timed("lexical"):
+            lexical_ranking = [chunk_id for chunk_id, _ in lexical_index.search(collection_name, query, n_candidates)]
+
+    if lexical_ranking:
+        scores = reciprocal_rank_fusion([vector_ranking, lexical_ranking])
+        ranked_ids = sorted(scores, key=scores.get, reverse=True)[:n_candidates]
+
+        # Treffer, die nur die Volltextsuche gefunden hat, aus Chroma nachladen
+        missing_ids = [chunk_id for chunk_id in ranked_ids if chunk_id not in hits]
+        if missing_ids:
+            with metrics.timed("retrieve"):
+                extra = collection.get(ids=missing_ids, include=[field for field in include if field != "distances"])
+            extra_embeddings = extra["embeddings"] if extra.get("embeddings") is not None else [None] * len(extra["ids"])
+            for chunk_id, document, metadata, embedding in zip(extra["ids"], extra["documents"], extra["metadatas"],
+                                                               extra_embeddings):
+                hits[chunk_id] = {"id": chunk_id, "document": document, "metadata": metadata, "distance": None,
+                                  "embedding": embedding}
+            logging.debug(f"Hybrid search added {len(missing_ids)} lexical-only hits")
+        candidates = [dict(hits[chunk_id], score=scores[chunk_id]) for chunk_id in ranked_ids if chunk_id in hits]
+    else:
+        candidates = [dict(hits[chunk_id], score=None) for chunk_id in vector_ranking]
+
+    with metrics.timed("rerank"):
+        selected = rerank.rerank(query, candidates, n_results)
+    if not keep_embeddings:
+        for hit in selected:
+            hit.pop("embedding", None)
+    return selected
+
+
+def _search_collection(collection_name: str):
+    # Kleine Collections mit aktuellem Snapshot exakt im kompakten Index durchsuchen, sonst in Chroma;
+    # beide bieten query() und get() mit demselben Ergebnisformat
+    return compact_index.get_snapshot(collection_name) or get_collection(collection_name)
+
+
+def _query_collection(collection_name: str, queries: List[str], query_embeddings: List[List[float]],
+                      n_results: int, keep_embeddings: bool = False) -> List[List[dict]]:
+    collection = _search_collection(collection_name)
+    n_candidates, include = _search_settings(n_results)
+    if keep_embeddings and "embeddings" not in include:
+        include = include + ["embeddings"]
+
+    with metrics.timed("retrieve"):
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=n_candidates,
+            include=include
+        )
+    return [_select_hits(collection, collection_name, query, results, row, n_results, n_candidates, include,
+                         keep_embeddings)
+            for row, query in enumerate(queries)]
+
+
+def collection_query_embedder(collection_name: str):
+    # Anfragen mit demselben Modell einbetten, mit dem die Chunks der Collection eingebettet wurden
+    return query_embedder_for(collection_embedding_backend(get_collection(collection_name)))
+
+
+def retrieve(collection_name: str, query: str, n_results: int = 5) -> List[dict]:
+    # Liefert die relevantesten Chunks als Liste von {id, document, metadata, distance, score}
+    with metrics.timed("embed"):
+        query_embedding = collection_query_embedder(collection_name).embed(query)
+    return _query_collection(collection_name, [query], [query_embedding], n_results)[0]
+
+
+def retrieve_many(collection_name: str, queries: List[str], n_results: int = 5) -> List[List[dict]]:
+    # Wie retrieve für viele Anfragen: Embeddings in Batches und eine einzige Chroma-Abfrage für alle
+    if not queries:
+        return []
+    with metrics.timed("embed"):
+        query_embeddings = collection_query_embedder(collection_name).embed_many(queries)
+    return _query_collection(collection_name, queries, query_embeddings, n_results)
+
+
+def _similarity(query_embedding: np.ndarray, embedding) -> Optional[float]:
+    if embedding is None:
+        return None
+    embedding = np.asarray(embedding, dtype=np.float32)
+    norms = float(np.linalg.norm(query_embedding) * np.linalg.norm(embedding))
+    return float(query_embedding @ embedding) / norms if norms else 0.0
+
+
+def _merge_hits(hits_per_collection: Dict[str, List[dict]], query_embeddings: Dict[str, List[float]],
+                n_results: int, same_model: bool = True) -> List[dict]:
+    # RRF-Scores und Ränge sind nur innerhalb einer Collection vergleichbar. Mit einem gemeinsamen
+    # Embedding-Modell wird nach der Kosinus-Ähnlichkeit zwischen Anfrage und Chunk sortiert, die für alle
+    # auf derselben Skala liegt. Verschiedene Modelle haben unterschiedliche Ähnlichkeitsbereiche (z.B. Azure
+    # deutlich höher als lokale Modelle); dann entscheidet der Rang innerhalb der eigenen Collection (RRF).
+    # query_embeddings enthält je Collection die Anfrage im Embedding-Modell dieser Collection.
+    merged = []
+    for collection_name, hits in hits_per_collection.items():
+        query_embedding = np.asarray(query_embeddings[collection_name], dtype=np.float32)
+        for rank, hit in enumerate(hits):
+            hit["collection"] = collection_name
+            hit["similarity"] = _similarity(query_embedding, hit.pop("embedding", None))
+            if same_model:
+                hit["federated_score"] = hit["similarity"] if hit["similarity"] is not None else -1.0
+            else:
+                hit["federated_score"] = 1.0 / (RRF_K + rank + 1)
+            merged.append(hit)
+    merged.sort(key=lambda hit: hit["federated_score"], reverse=True)
+    return merged[:n_results]
+
+
+def retrieve_many_federated(collection_names: List[str], queries: List[str],
+                            n_results: int = 5) -> List[List[dict]]:
+    # Sucht jede Anfrage in mehreren Collections: Embeddings einmal je Embedding-Modell berechnen, Collections
+    # parallel abfragen und die Treffer je Anfrage zu einer Liste zusammenführen; jeder Treffer trägt seine Collection
+    if len(collection_names) == 1:
+        return retrieve_many(collection_names[0], queries, n_results)
+    if not queries:
+        return []
+    embedders = {collection_name: collection_query_embedder(collection_name) for collection_name in collection_names}
+    embeddings_by_model = {}
+    with metrics.timed("embed"):
+        for embedder in embedders.values():
+            if embedder.model not in embeddings_by_model:
+                embeddings_by_model[embedder.model] = embedder.embed_many(queries)
+    query_embeddings = {collection_name: embeddings_by_model[embedder.model]
+                        for collection_name, embedder in embedders.items()}
+    # Jede Aufgabe in einer Kopie des Kontexts ausführen, damit die Stufenzeiten der Anfrage zugeordnet bleiben
+    futures = {
+        collection_name: _executor.submit(contextvars.copy_context().run, _query_collection, collection_name,
+                                          queries, query_embeddings[collection_name], n_results, True)
+        for collection_name in collection_names
+    }
+    hits_per_collection = {collection_name: future.result() for collection_name, future in futures.items()}
+    return [_merge_hits({collection_name: hits[row] for collection_name, hits in hits_per_collection.items()},
+                        {collection_name: embeddings[row] for collection_name, embeddings in query_embeddings.items()},
+                        n_results, same_model=len(embeddings_by_model) == 1)
+            for row in range(len(queries))]
+
+
+def retrieve_federated(collection_names: List[str], query: str, n_results: int = 5) -> List[dict]:
+    if len(collection_names) == 1:
+        return retrieve(collection_names[0], query, n_results)
+    return retrieve_many_federated(collection_names, [query], n_results)[0]
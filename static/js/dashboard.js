@@ -182,6 +182,42 @@ loadMaintenanceStatus();
         currentPromptId = null;
     }
 
+    function formatIngestionProgress(job) {
+        return job.files.map(file => {
+            let line = `${file.filename}: ${file.status}`;
+            if (file.total_pages) line += ` – Seiten ${file.pages_parsed}/${file.total_pages}`;
+            if (file.chunks_total) {
+                line += `, Embeddings ${file.chunks_embedded}/${file.chunks_total}`;
+                line += `, gespeichert ${file.chunks_written}/${file.chunks_total}`;
+            }
+            if (file.error) line += ` (${file.error})`;
+            return line;
+        }).join('\n');
+    }
+
+    function pollIngestionJob(jobId) {
+        fetch(`/ingestion_jobs/${jobId}`)
+            .then(response => response.json())
+            .then(job => {
+                if (elements.messageDiv) {
+                    elements.messageDiv.style.whiteSpace = 'pre-line';
+                }
+                const finished = job.status === 'done' || job.status === 'failed';
+                showMessage(elements.messageDiv, formatIngestionProgress(job), job.status === 'failed' ? 'error' : 'success');
+                if (finished) {
+                    hideSpinner(elements.spinner);
+                    loadExistingCollections();
+                } else {
+                    setTimeout(() => pollIngestionJob(jobId), 2000);
+                }
+            })
+            .catch(error => {
+                hideSpinner(elements.spinner);
+                console.error('Error polling ingestion job:', error);
+                showMessage(elements.messageDiv, 'An error occurred while checking the upload progress.', 'error');
+            });
+    }
+
     // Event Listeners
     if (elements.collectionForm) {
         elements.collectionForm.addEventListener('submit', function(e) {
@@ -195,17 +231,16 @@ loadMaintenanceStatus();
                 method: 'POST',
                 body: formData
             })
-            .then(response => {
+            .then(response => response.json().then(data => {
                 if (!response.ok) {
-                    throw new Error('Network response was not ok');
+                    throw new Error(data.error || 'Network response was not ok');
                 }
-                return response.json();
-            })
+                return data;
+            }))
             .then(data => {
-                hideSpinner(elements.spinner);
                 showMessage(elements.messageDiv, data.message, 'success');
                 elements.collectionForm.reset();
-                loadExistingCollections();
+                pollIngestionJob(data.job_id);
             })
             .catch(error => {
                 hideSpinner(elements.spinner);
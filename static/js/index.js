@@ -42,28 +42,39 @@ document.addEventListener('DOMContentLoaded', function() {
 
     function generateText() {
         const formData = new FormData(elements.inputForm);
+        formData.append('stream', 'true');
 
         showSpinner();
         elements.copyButtonContainer.classList.add('hidden');
+        elements.outputDiv.textContent = '';
 
         fetch('/', {
             method: 'POST',
             body: formData
         })
-        .then(response => response.json())
-        .then(data => {
-            if (data.error) {
+        .then(response => readEventStream(response, (event, data) => {
+            if (event === 'meta') {
+                updateSources(data.citations);
+            } else if (event === 'token') {
+                hideSpinner();
+                elements.outputDiv.textContent += data.text;
+            } else if (event === 'done') {
+                if (data.generated_text !== undefined) {
+                    elements.outputDiv.textContent = data.generated_text;
+                }
+                if (data.citations) {
+                    updateSources(data.citations);
+                }
+                if (elements.outputDiv.textContent.trim() !== '') {
+                    elements.copyButtonContainer.classList.remove('hidden');
+                }
+                updateChatHistory(data.conversations);
+                conversationsData = data.conversations;
+                hideSpinner();
+            } else if (event === 'error') {
                 throw new Error(data.error);
             }
-            elements.outputDiv.textContent = data.generated_text;
-            if (elements.outputDiv.textContent.trim() !== '') {
-                elements.copyButtonContainer.classList.remove('hidden');
-            }
-            updateSources(data.citations);
-            updateChatHistory(data.conversations);
-            conversationsData = data.conversations;
-            hideSpinner();
-        })
+        }))
         .catch(error => {
             console.error('Error:', error);
             elements.outputDiv.textContent = 'Ein Fehler ist aufgetreten: ' + error.message;
@@ -1,29 +1,50 @@
 import re
-import chromadb
 import chromadb.utils.embedding_functions as embedding_functions
 from dotenv import load_dotenv
 import os
-import fitz  # PyMuPDF
 import hashlib
+import random
+import time
 import tiktoken
-from typing import List
-from openai import AzureOpenAI
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional
+from openai import AzureOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
 import logging
+from collections import Counter
+from embedding_cache import embedding_cache
+from vector_store import get_chroma_client
+import lexical_index
+import local_embeddings
+from pdf_parsing import iter_pdf_pages, get_page_count, iter_parsed_chunks
 
 load_dotenv()
 
 
-chroma_client = chromadb.PersistentClient(path="chroma")
-
 AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
 AZURE_ENDPOINT = os.getenv("AZURE_ENDPOINT")
 AZURE_MODEL = os.getenv("AZURE_MODEL", "gpt-35-turbo")
 AZURE_EMBEDDING_MODEL = os.getenv("AZURE_EMBEDDING_MODEL", "text-embedding-ada-002")
 
+# Grenzen für das Batching der Embedding-Anfragen
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "8000"))
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", "16"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "6"))
+CHROMA_ADD_BATCH_SIZE = int(os.getenv("CHROMA_ADD_BATCH_SIZE", "1000"))
+
+# Einstellungen für das Chunking
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))
+INGESTION_WINDOW_CHUNKS = int(os.getenv("INGESTION_WINDOW_CHUNKS", "256"))
+
+# Embedding-Backends, die beim Anlegen einer Collection gewählt werden können
+EMBEDDING_BACKENDS = ("azure", "local")
+
+# Wiederholungen übernimmt _embed_batch mit eigenem Backoff
 azure_openai_client = AzureOpenAI(
     api_key=AZURE_OPENAI_KEY,
     api_version="2024-02-15-preview",
-    azure_endpoint=AZURE_ENDPOINT
+    azure_endpoint=AZURE_ENDPOINT,
+    max_retries=0
 )
 
 def clean_collection_name(name: str) -> str:
@@ -37,7 +58,7 @@ def clean_collection_name(name: str) -> str:
     return re.sub(r'\W+', '_', name)
 
 def list_collections() -> List[str]:
-    collections = chroma_client.list_collections()
+    collections = get_chroma_client().list_collections()
     return [collection.name for collection in collections]
 
 def collection_exists(collection_name: str) -> bool:
@@ -54,52 +75,187 @@ def create_embedding_function():
     )
     return openai_ef
 
-def create_embedding(text: str) -> List[float]:
-    response = azure_openai_client.embeddings.create(
-        input=text,
-        model=AZURE_EMBEDDING_MODEL,
-    )
-    return response.data[0].embedding
-
-def create_chroma_collection(name: str, embedding_function):
-    try:
-        # Versuche, eine vorhandene Collection abzurufen
-        return chroma_client.get_collection(name=name, embedding_function=embedding_function)
-    except ValueError:
-        # Wenn die Collection nicht existiert, erstelle eine neue
-        return chroma_client.create_collection(name=name, embedding_function=embedding_function)
-
-def extract_text_from_pdf(file_path: str) -> tuple:
-    with fitz.open(file_path) as doc:
-        total_pages = doc.page_count
-        text = ""
-        for page in doc:
-            text += page.get_text()
-    return total_pages, text
+def batch_texts(texts: List[str], max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+                max_items: int = EMBEDDING_BATCH_MAX_ITEMS) -> Iterator[List[int]]:
+    # Teilt die Texte in Batches auf, die sowohl die Token- als auch die Anzahlgrenze einhalten
+    encoding = tiktoken.get_encoding("cl100k_base")
+    batch, batch_tokens = [], 0
+    for i, text in enumerate(texts):
+        token_count = len(encoding.encode(text))
+        if batch and (batch_tokens + token_count > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += token_count
+    if batch:
+        yield batch
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    # Azure liefert bei 429 meist einen Retry-After-Header mit
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return min(60.0, 2 ** attempt) + random.uniform(0, 1)
+
+def _embed_batch(texts: List[str]) -> List[List[float]]:
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            response = azure_openai_client.embeddings.create(
+                input=texts,
+                model=AZURE_EMBEDDING_MODEL,
+            )
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError) as e:
+            if attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            delay = _retry_delay(e, attempt)
+            logging.warning(f"Embedding request failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def create_embeddings(texts: List[str], progress_callback: Optional[Callable[[int], None]] = None,
+                      check_cache: bool = True) -> List[List[float]]:
+    # Erstellt Embeddings für viele Texte in Batches mit begrenzter Anzahl paralleler Anfragen.
+    # Bereits bekannte Texte kommen aus dem Cache, doppelte Texte werden nur einmal angefragt.
+    # check_cache=False, wenn der Aufrufer den Cache schon abgefragt hat; neue Embeddings werden trotzdem gespeichert.
+    if not texts:
+        return []
+    if embedding_cache and check_cache:
+        embeddings = embedding_cache.get_many(texts, AZURE_EMBEDDING_MODEL)
+    else:
+        embeddings = [None] * len(texts)
+    missing_counts = Counter(text for text, embedding in zip(texts, embeddings) if embedding is None)
+    done = len(texts) - sum(missing_counts.values())
+    if progress_callback and done:
+        progress_callback(done)
+
+    unique_texts = list(missing_counts)
+    computed = {}
+    batches = list(batch_texts(unique_texts))
+    with ThreadPoolExecutor(max_workers=EMBEDDING_CONCURRENCY) as executor:
+        results = executor.map(lambda batch: _embed_batch([unique_texts[i] for i in batch]), batches)
+        for batch, batch_embeddings in zip(batches, results):
+            batch_texts_ = [unique_texts[i] for i in batch]
+            if embedding_cache:
+                embedding_cache.put_many(batch_texts_, batch_embeddings, AZURE_EMBEDDING_MODEL)
+            for text, embedding in zip(batch_texts_, batch_embeddings):
+                computed[text] = embedding
+                done += missing_counts[text]
+            if progress_callback:
+                progress_callback(done)
+
+    # stats() summiert über die ganze Cache-Tabelle, daher nur im Debug-Modus
+    if embedding_cache and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Embedding cache stats: {embedding_cache.stats()}")
+    return [embedding if embedding is not None else computed[text] for text, embedding in zip(texts, embeddings)]
+
+def _max_write_batch_size() -> int:
+    batch_size = CHROMA_ADD_BATCH_SIZE
+    client = get_chroma_client()
+    if hasattr(client, "get_max_batch_size"):
+        batch_size = min(batch_size, client.get_max_batch_size())
+    return batch_size
+
+def add_to_collection_in_batches(collection, ids: List[str], embeddings: List[List[float]],
+                                 documents: List[str], metadatas: List[dict],
+                                 progress_callback: Optional[Callable[[int], None]] = None):
+    batch_size = _max_write_batch_size()
+    for start in range(0, len(ids), batch_size):
+        end = start + batch_size
+        collection.add(
+            ids=ids[start:end],
+            embeddings=embeddings[start:end],
+            documents=documents[start:end],
+            metadatas=metadatas[start:end]
+        )
+        if progress_callback:
+            progress_callback(min(end, len(ids)))
+
+def embedding_metadata(backend: str) -> dict:
+    model = local_embeddings.LOCAL_EMBEDDING_MODEL_NAME if backend == "local" else AZURE_EMBEDDING_MODEL
+    return {"embedding_backend": backend, "embedding_model": model}
+
+def collection_embedding_backend(collection) -> str:
+    # Collections ohne Eintrag stammen aus der Zeit vor den lokalen Embeddings und verwenden Azure
+    metadata = collection.metadata or {}
+    backend = metadata.get("embedding_backend", "azure")
+    if backend == "local" and metadata.get("embedding_model") != local_embeddings.LOCAL_EMBEDDING_MODEL_NAME:
+        raise ValueError(f"Collection {collection.name} was embedded with {metadata.get('embedding_model')}, "
+                         f"but the local embedding model is {local_embeddings.LOCAL_EMBEDDING_MODEL_NAME}")
+    return backend
+
+def create_document_embeddings(backend: str, texts: List[str],
+                               progress_callback: Optional[Callable[[int], None]] = None) -> List[List[float]]:
+    if backend == "local":
+        return local_embeddings.create_passage_embeddings(texts, progress_callback)
+    return create_embeddings(texts, progress_callback)
+
+def create_chroma_collection(name: str, embedding_backend: Optional[str] = None):
+    # Vorhandene Collection abrufen oder neu anlegen; ist auch gegenüber einem Chroma-Server ein einziger Aufruf.
+    # Das Embedding-Backend wird nur beim Anlegen übergeben und in den Metadaten der Collection vermerkt.
+    if embedding_backend is None:
+        return get_chroma_client().get_or_create_collection(name=name, embedding_function=create_embedding_function())
+    embedding_function = create_embedding_function() if embedding_backend == "azure" else None
+    return get_chroma_client().get_or_create_collection(name=name, embedding_function=embedding_function,
+                                                        metadata=embedding_metadata(embedding_backend))
+
+def read_text_prefix(file_path: str, max_chars: int) -> str:
+    parts, length = [], 0
+    for _, page_text in iter_pdf_pages(file_path):
+        parts.append(page_text)
+        length += len(page_text)
+        if length >= max_chars:
+            break
+    return "".join(parts)[:max_chars]
 
 def hash_file_content(content: str) -> str:
     return hashlib.sha256(content.encode()).hexdigest()
 
-def tokenize_and_chunk_text(text: str, max_tokens_per_chunk: int) -> tuple:
-    encoding = tiktoken.get_encoding("cl100k_base")
-    tokens = encoding.encode(text)
-    chunks = [tokens[i:i + max_tokens_per_chunk] for i in range(0, len(tokens), max_tokens_per_chunk)]
-    text_chunks = [encoding.decode(chunk) for chunk in chunks]
-    return text_chunks, len(chunks)
+def hash_file(file_path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def update_metadata_in_batches(collection, ids: List[str], metadatas: List[dict]):
+    batch_size = _max_write_batch_size()
+    for start in range(0, len(ids), batch_size):
+        collection.update(ids=ids[start:start + batch_size], metadatas=metadatas[start:start + batch_size])
+
+def delete_from_collection_in_batches(collection, ids: List[str]):
+    batch_size = _max_write_batch_size()
+    for start in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[start:start + batch_size])
+
+def make_chunk_ids(source_name: str, chunks: List[str], seen: Optional[Counter] = None) -> List[str]:
+    # Inhaltsbasierte IDs: unveränderte Chunks behalten beim erneuten Import ihre ID.
+    # seen zählt bereits vergebene IDs, wenn ein Dokument in mehreren Teilen verarbeitet wird.
+    ids = []
+    seen = Counter() if seen is None else seen
+    for chunk in chunks:
+        chunk_id = f"{source_name}_{hash_file_content(chunk)[:16]}"
+        seen[chunk_id] += 1
+        if seen[chunk_id] > 1:
+            chunk_id = f"{chunk_id}_{seen[chunk_id] - 1}"
+        ids.append(chunk_id)
+    return ids
+
+def get_source_chunks(collection, source_name: str) -> dict:
+    existing = collection.get(where={"source": source_name}, include=["metadatas"])
+    return dict(zip(existing["ids"], existing["metadatas"]))
 
 def clean_text(text: str) -> str:
     # Implement text cleaning logic here
     return text
 
-def create_embedding(text: str) -> List[float]:
-    response = azure_openai_client.embeddings.create(
-        input=text,
-        model=AZURE_EMBEDDING_MODEL,
-    )
-    return response.data[0].embedding
-
 def create_description(text: str) -> str:
-    response = azure_openai_client.chat.completions.create(
+    # Einzelne Anfrage ohne eigenen Backoff: hier bleiben die Wiederholungen des SDK aktiv
+    response = azure_openai_client.with_options(max_retries=2).chat.completions.create(
         model=AZURE_MODEL,
         messages=[
             {"role": "system", "content": "Du bist ein hilfreicher KI-Assistent, der anhand eines vorgegebenen Textes eine passende Beschreibung mit maximal 3 Sätzen erstellen soll."},
@@ -111,40 +267,101 @@ def create_description(text: str) -> str:
     return response.choices[0].message.content
 
 
-def process_pdf_and_add_to_collection(file_path: str, collection_name: str, max_tokens_per_chunk: int = 512):
+def process_pdf_and_add_to_collection(file_path: str, collection_name: str, max_tokens_per_chunk: int = 512,
+                                      progress_callback: Optional[Callable[..., None]] = None,
+                                      source_name: Optional[str] = None,
+                                      overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                                      embedding_backend: Optional[str] = None):
+    # progress_callback wird mit Zählerständen aufgerufen, z.B. progress_callback(chunks_embedded=120);
+    # embedding_backend gilt nur für neue Collections, bestehende behalten ihr Backend aus den Metadaten
+    progress = {"pages_parsed": 0, "chunks_total": 0, "chunks_embedded": 0, "chunks_written": 0}
+
+    def report(**counts):
+        progress.update(counts)
+        if progress_callback:
+            progress_callback(**counts)
+
+    source_name = source_name or os.path.basename(file_path)
     logging.info(f"Processing file: {file_path} for collection: {collection_name}")
-    collection = create_chroma_collection(collection_name, create_embedding_function())
+    collection = create_chroma_collection(collection_name, embedding_backend)
+    embedding_backend = collection_embedding_backend(collection)
 
-    total_pages, text = extract_text_from_pdf(file_path)
-    logging.info(f"Extracted {total_pages} pages from {file_path}")
+    total_pages = get_page_count(file_path)
+    report(total_pages=total_pages)
 
-    hash_value = hash_file_content(text)
-    document_description = create_description(text[:1000])
+    hash_value = hash_file(file_path)
+    existing_chunks = get_source_chunks(collection, source_name)
+    if existing_chunks and all(meta.get("hash") == hash_value for meta in existing_chunks.values()):
+        # Datei ist unverändert, nichts zu tun
+        logging.info(f"Skipping unchanged file {source_name} in collection {collection_name}")
+        report(pages_parsed=total_pages, chunks_total=len(existing_chunks),
+               chunks_embedded=len(existing_chunks), chunks_written=len(existing_chunks))
+        return {"message": f"PDF unchanged in collection {collection_name}", "skipped": True,
+                "chunks_added": 0, "chunks_deleted": 0, "chunks_unchanged": len(existing_chunks),
+                "chunk_count": len(existing_chunks), "page_count": total_pages, "hash": hash_value,
+                "description": next(iter(existing_chunks.values())).get("description")}
 
-    text_chunks, chunk_count = tokenize_and_chunk_text(text, max_tokens_per_chunk)
-    logging.info(f"Created {chunk_count} chunks from {file_path}")
+    document_description = create_description(read_text_prefix(file_path, 1000))
 
-    chunks_per_page = chunk_count / total_pages
+    seen_ids = Counter()
+    all_ids = set()
+    stats = {"chunks_added": 0, "chunks_unchanged": 0}
 
-    for i, chunk in enumerate(text_chunks):
-        clean_chunk = clean_text(chunk)
-        page_number = int(i / chunks_per_page) + 1
-        embedding = create_embedding(clean_chunk)
-        chunk_id = f"{os.path.basename(file_path)}_{i}"
+    def index_window(window: List[dict]):
+        # Ein Fenster von Chunks einbetten und schreiben, damit der Speicherbedarf begrenzt bleibt
+        texts = [clean_text(chunk["text"]) for chunk in window]
+        ids = make_chunk_ids(source_name, texts, seen_ids)
+        all_ids.update(ids)
+        metadatas = [{
+            "source": source_name,
+            "hash": hash_value,
+            "description": document_description,
+            "chunk_id": chunk_id,
+            "page_number": chunk["page_start"],
+            "page_start": chunk["page_start"],
+            "page_end": chunk["page_end"]
+        } for chunk_id, chunk in zip(ids, window)]
 
-        collection.add(
-            embeddings=[embedding],
-            documents=[clean_chunk],
-            metadatas=[{
-                "source": os.path.basename(file_path),
-                "hash": hash_value,
-                "description": document_description,
-                "chunk_id": chunk_id,
-                "page_number": page_number
-            }],
-            ids=[chunk_id]
-        )
+        # Nur neue Chunks einbetten, vorhandene nur in den Metadaten aktualisieren
+        new_indices = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing_chunks]
+        kept_indices = [i for i, chunk_id in enumerate(ids) if chunk_id in existing_chunks]
+        embedded_before = progress["chunks_embedded"] + len(kept_indices)
+        written_before = progress["chunks_written"] + len(kept_indices)
+
+        new_texts = [texts[i] for i in new_indices]
+        embeddings = create_document_embeddings(embedding_backend, new_texts,
+                                                lambda done: report(chunks_embedded=embedded_before + done))
+        report(chunks_embedded=embedded_before + len(new_texts))
+
+        update_metadata_in_batches(collection, [ids[i] for i in kept_indices], [metadatas[i] for i in kept_indices])
+        add_to_collection_in_batches(collection, [ids[i] for i in new_indices], embeddings, new_texts,
+                                     [metadatas[i] for i in new_indices],
+                                     lambda written: report(chunks_written=written_before + written))
+        lexical_index.add_chunks(collection_name, [ids[i] for i in new_indices], new_texts)
+        report(chunks_written=written_before + len(new_texts))
+        stats["chunks_added"] += len(new_indices)
+        stats["chunks_unchanged"] += len(kept_indices)
+
+    window = []
+    for chunk in iter_parsed_chunks(file_path, max_tokens_per_chunk, overlap_tokens):
+        window.append(chunk)
+        if len(window) >= INGESTION_WINDOW_CHUNKS:
+            report(pages_parsed=chunk["page_end"], chunks_total=progress["chunks_total"] + len(window))
+            index_window(window)
+            window = []
+    report(pages_parsed=total_pages, chunks_total=progress["chunks_total"] + len(window))
+    if window:
+        index_window(window)
 
+    # Veraltete Chunks der vorherigen Version entfernen
+    stale_ids = list(set(existing_chunks) - all_ids)
+    if stale_ids:
+        delete_from_collection_in_batches(collection, stale_ids)
+        lexical_index.delete_chunks(collection_name, stale_ids)
 
-    logging.info(f"Added {chunk_count} chunks to collection {collection_name} from {file_path}")
-    return {"message": f"PDF processed and added to collection {collection_name}"}
\ No newline at end of file
+    logging.info(f"{source_name}: {stats['chunks_added']} new, {stats['chunks_unchanged']} unchanged, "
+                 f"{len(stale_ids)} stale chunks in collection {collection_name}")
+    return {"message": f"PDF processed and added to collection {collection_name}", "skipped": False,
+            "chunks_added": stats["chunks_added"], "chunks_deleted": len(stale_ids),
+            "chunks_unchanged": stats["chunks_unchanged"], "chunk_count": len(all_ids),
+            "page_count": total_pages, "hash": hash_value, "description": document_description}
@@ -0,0 +1,68 @@
+import logging
+import os
+import threading
+import time
+
+import chromadb
+
+# Zugriff auf die Vektordatenbank. "embedded" öffnet die Chroma-Dateien im eigenen Prozess (Entwicklung,
+# ein einzelner Prozess); bei "http" hält ein gemeinsamer Chroma-Server die Indizes und alle Worker
+# sprechen ihn über HTTP an, sodass die HNSW-Indizes nur einmal im Speicher liegen und nur ein
+# Prozess in die Dateien schreibt.
+
+# embedded oder http
+VECTOR_STORE = os.getenv("VECTOR_STORE", "embedded").lower()
+CHROMA_PATH = os.getenv("CHROMA_PATH", "chroma")
+CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+CHROMA_SSL = os.getenv("CHROMA_SSL", "false").lower() == "true"
+# Optionales Token, falls der Chroma-Server Authentifizierung verlangt
+CHROMA_AUTH_TOKEN = os.getenv("CHROMA_AUTH_TOKEN")
+# So lange werden Collection-Objekte für Suchanfragen wiederverwendet; danach wird geprüft, ob die Collection
+# inzwischen (z.B. von einem anderen Prozess) gelöscht oder neu angelegt wurde
+COLLECTION_HANDLE_TTL = 60
+
+_client = None
+_client_lock = threading.Lock()
+_collections = {}  # Name -> (Collection, Zeitpunkt des Abrufs)
+_collections_lock = threading.Lock()
+
+
+def _create_client():
+    if VECTOR_STORE == "http":
+        headers = {"Authorization": f"Bearer {CHROMA_AUTH_TOKEN}"} if CHROMA_AUTH_TOKEN else None
+        client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, ssl=CHROMA_SSL, headers=headers)
+        logging.info(f"Using Chroma server at {CHROMA_HOST}:{CHROMA_PORT}")
+        return client
+    if VECTOR_STORE != "embedded":
+        raise ValueError(f"Unknown VECTOR_STORE {VECTOR_STORE!r}, expected 'embedded' or 'http'")
+    return chromadb.PersistentClient(path=CHROMA_PATH)
+
+
+def get_chroma_client():
+    # Der Client wird erst beim ersten Zugriff angelegt; ist der Server noch nicht erreichbar,
+    # versucht es der nächste Aufruf erneut
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _create_client()
+    return _client
+
+
+def get_collection(name: str):
+    # Collection-Objekt für Suchanfragen, ohne bei jeder Anfrage erneut beim Client nachzufragen
+    now = time.monotonic()
+    with _collections_lock:
+        cached = _collections.get(name)
+    if cached and now - cached[1] < COLLECTION_HANDLE_TTL:
+        return cached[0]
+    collection = get_chroma_client().get_collection(name=name)
+    with _collections_lock:
+        _collections[name] = (collection, now)
+    return collection
+
+
+def forget_collection(name: str):
+    with _collections_lock:
+        _collections.pop(name, None)